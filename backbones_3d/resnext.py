@@ -11,11 +11,9 @@ __all__ = ['ResNeXt', 'resnet50', 'resnet101']
 
 def downsample_basic_block(x, planes, stride):
     out = F.avg_pool3d(x, kernel_size=1, stride=stride)
-    zero_pads = torch.Tensor(
+    zero_pads = out.new_zeros(
         out.size(0), planes - out.size(1), out.size(2), out.size(3),
-        out.size(4)).zero_()
-    if isinstance(out.data, torch.cuda.FloatTensor):
-        zero_pads = zero_pads.cuda()
+        out.size(4))
 
     out = Variable(torch.cat([out.data, zero_pads], dim=1))
 
@@ -61,6 +61,16 @@ _C.TRAIN.BATCH_SIZE = 64
 # Total batch size to accumulate loss
 _C.TRAIN.TOTAL_BATCH_SIZE = 128
 
+# Run the detector training and test loops in mixed precision.
+_C.TRAIN.AMP = False
+
+# Mixed precision dtype, `float16` (with gradient scaling) or `bfloat16`.
+# The CPU always uses `bfloat16`.
+_C.TRAIN.AMP_DTYPE = "float16"
+
+# Run the 2D and 3D backbones in channels last (channels_last_3d for the clips) layout.
+_C.TRAIN.CHANNELS_LAST = False
+
 _C.TRAIN.LEARNING_RATE = 1e-4
 
 _C.TRAIN.RESUME_PATH = ""
@@ -91,6 +101,12 @@ _C.TRAIN.EVAL_PERIOD = 1
 # Save model checkpoint every checkpoint period epochs.
 _C.TRAIN.CHECKPOINT_PERIOD = 1
 
+# Number of rolling checkpoints kept next to the latest and the best one.
+_C.TRAIN.KEEP_CHECKPOINTS = 3
+
+# Write checkpoints on a background thread.
+_C.TRAIN.ASYNC_CHECKPOINT = True
+
 # Resume training from the latest checkpoint in the output directory.
 _C.TRAIN.AUTO_RESUME = True
 
@@ -308,6 +324,14 @@ _C.DATA.INV_UNIFORM_SAMPLE = False
 # If True, perform random horizontal flip on the video frames during training.
 _C.DATA.RANDOM_FLIP = True
 
+# If True, UCF24/JHMDB21 training clips are cropped, resized, flipped and color distorted
+# as one stacked tensor (datasets.clip.augment_clip) instead of frame by frame in PIL.
+_C.DATA.TENSOR_AUGMENTATION = False
+
+# If True, JPEG frames are decoded at the smallest DCT scale (1/2, 1/4 or 1/8) that still
+# covers the input size, instead of at full size before the resize.
+_C.DATA.REDUCED_DECODE = False
+
 # If True, calculdate the map as metric.
 _C.DATA.MULTI_LABEL = False
 
@@ -383,6 +407,10 @@ _C.SOLVER.NOOBJECT_SCALE = 1
 _C.SOLVER.CLASS_SCALE = 1
 _C.SOLVER.COORD_SCALE = 1
 
+# Build the AVA region loss targets with the batched on-device builder
+# instead of the per ground truth loop.
+_C.SOLVER.BATCHED_TARGETS = True
+
 # Optimization method.
 _C.SOLVER.OPTIMIZING_METHOD = "sgd"
 
@@ -488,7 +516,10 @@ _C.DEMO.SLOWMO = 1
 # Misc options
 # ---------------------------------------------------------------------------- #
 
-# Number of GPUs to use (applies to both training and testing).
+# Number of processes per machine (applies to both training and testing), one per GPU,
+# or CPU processes when DIST_BACKEND is gloo. TRAIN.BATCH_SIZE is the batch of one process.
+# main_codec.py gives every process a contiguous shard of the frames and averages the gradients of
+# the codec at each optimizer step; its mid-epoch checkpoints are only written by single processes.
 _C.NUM_GPUS = 1
 
 # Number of machine to use for the job.
@@ -513,9 +544,27 @@ _C.LOG_PERIOD = 10
 # If True, log the model info.
 _C.LOG_MODEL_INFO = True
 
-# Distributed backend.
+# Distributed backend, nccl falls back to gloo when SYSTEM.DEVICE is not a GPU.
 _C.DIST_BACKEND = "nccl"
 
+# ---------------------------------------------------------------------------- #
+# System options
+# ---------------------------------------------------------------------------- #
+_C.SYSTEM = CfgNode()
+
+# Device the model, loss and box decoding run on, e.g. "cuda", "cuda:1" or "cpu".
+# "cuda" falls back to the CPU when no GPU is available.
+_C.SYSTEM.DEVICE = "cuda"
+
+# GPUs made visible to the process (CUDA_VISIBLE_DEVICES), e.g. "0,1".
+# Empty keeps the environment as it is.
+_C.SYSTEM.VISIBLE_DEVICES = ""
+
+# Device map of the codecs that are split in two stages, e.g. ["cuda:0", "cuda:1"].
+# Empty uses the first two GPUs when SYSTEM.DEVICE is a GPU and SYSTEM.DEVICE otherwise.
+_C.SYSTEM.CODEC_DEVICES = []
+
+
 # ---------------------------------------------------------------------------- #
 # Benchmark options
 # ---------------------------------------------------------------------------- #
@@ -531,6 +580,48 @@ _C.BENCHMARK.LOG_PERIOD = 100
 _C.BENCHMARK.SHUFFLE = True
 
 
+# ---------------------------------------------------------------------------- #
+# Backbone feature cache options
+# ---------------------------------------------------------------------------- #
+_C.FEATURE_CACHE = CfgNode()
+
+# If True, freeze both backbones, store their outputs for the training set once and
+# train only cfam and conv_final on the stored features. Evaluation runs the full model.
+_C.FEATURE_CACHE.ENABLE = False
+
+# Root directory of the feature stores, one sub-directory per backbone weights and data settings.
+_C.FEATURE_CACHE.DIR = "feature_cache"
+
+# Seeds of the cached augmentation views, epoch e trains on view e % len(AUG_SEEDS).
+# If empty, a single view of the training samples with the test-time transform.
+_C.FEATURE_CACHE.AUG_SEEDS = []
+
+# Storage dtype of the features.
+_C.FEATURE_CACHE.DTYPE = "float16"
+
+
+# ---------------------------------------------------------------------------- #
+# Training step profiler options
+# ---------------------------------------------------------------------------- #
+_C.PROFILE = CfgNode()
+
+# If True, time the phases of every training step and the forward of the YOWO modules.
+# With DATA_LOADER.PREFETCH the 'h2d' phase is the copy of the prefetcher, on GPUs inside 'data'.
+_C.PROFILE.ENABLE = False
+
+# Log a summary of the phase times every LOG_PERIOD steps.
+_C.PROFILE.LOG_PERIOD = 50
+
+# Number of most recent steps the summary averages over.
+_C.PROFILE.WINDOW = 100
+
+# Number of first steps written to the Chrome trace file.
+_C.PROFILE.TRACE_STEPS = 200
+
+# Directory of the trace files profile_trace_rank<rank>.json, BACKUP_DIR if empty.
+_C.PROFILE.TRACE_DIR = ""
+
+
 # ---------------------------------------------------------------------------- #
 # Common train/test data loader options
 # ---------------------------------------------------------------------------- #
@@ -542,9 +633,30 @@ _C.DATA_LOADER.NUM_WORKERS = 8
 # Load data to pinned host memory.
 _C.DATA_LOADER.PIN_MEMORY = True
 
+# Decoded frames kept per data loader worker for the UCF24/JHMDB21 clips, 0 disables the cache.
+# Only pays off with a sampler that keeps neighbouring frames together, see CHUNK_SIZE.
+_C.DATA_LOADER.FRAME_CACHE_SIZE = 0
+
+# If > 0, the training sampler shuffles chunks of CHUNK_SIZE consecutive frames of the frame
+# list instead of single frames, so the clips of one batch share most of their frames.
+_C.DATA_LOADER.CHUNK_SIZE = 0
+
+# Prepare the next batch on the device while the current step runs, with copies on a
+# side stream on GPUs and a background thread on the CPU.
+_C.DATA_LOADER.PREFETCH = True
+
 # Enable multi thread decoding.
 _C.DATA_LOADER.ENABLE_MULTI_THREAD_DECODE = False
 
+# Number of threads per process that decode the frames of a clip concurrently with
+# ENABLE_MULTI_THREAD_DECODE.
+_C.DATA_LOADER.NUM_DECODE_THREADS = 4
+
+# Data loader workers return uint8 clips, a quarter of the float32 bytes through the worker
+# queues and pinned memory. The scaling to [0, 1] and for AVA the DATA.MEAN/STD normalization
+# run batched on the device in core.utils.clip_to_float.
+_C.DATA_LOADER.UINT8_CLIPS = False
+
 
 # ---------------------------------------------------------------------------- #
 # Detection options.
@@ -650,6 +762,11 @@ _C.AVA.GROUNDTRUTH_FILE = "ava_val_v2.1.csv"
 # Backend to process image, includes `pytorch` and `cv2`.
 _C.AVA.IMG_PROC_BACKEND = "cv2"
 
+# Directory of the compiled annotation indexes of datasets.ava_index, the frame lists,
+# boxes and evaluation ground truth are parsed from the CSVs once and memory-mapped.
+# Empty parses the CSVs every time.
+_C.AVA.INDEX_DIR = ""
+
 # -----------------------------------------------------------------------------
 # list Dataset options
 # -----------------------------------------------------------------------------
@@ -658,6 +775,12 @@ _C.LISTDATA.BASE_PTH = "/home/monet/research/dataset/ucf24"
 _C.LISTDATA.TRAIN_FILE = "/home/monet/research/dataset/ucf24/trainlist.txt"
 _C.LISTDATA.TEST_FILE = "/home/monet/research/dataset/ucf24/testlist.txt"
 _C.LISTDATA.TEST_VIDEO_FILE = "/home/monet/research/dataset/ucf24/testlist_video.txt"
+# Packed frame store written by `python -m datasets.frame_store`, read instead of
+# rgb-images/ if not empty.
+_C.LISTDATA.FRAME_STORE = ""
+# Manifest of frame counts, frame sizes and labels written by `python -m datasets.manifest`,
+# used instead of listing the frame folders and parsing the label files if not empty.
+_C.LISTDATA.MANIFEST = ""
 _C.LISTDATA.MAX_OBJS = 6
 _C.LISTDATA.CLASS_NAMES = [
     "Basketball", "BasketballDunk", "Biking", "CliffDiving", "CricketBowling", 
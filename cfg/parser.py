@@ -32,6 +32,24 @@ def parse_args():
         type=str, 
         help='Select dataset from (ucf101-24, jhmdb-21, ava)'
     )
+    parser.add_argument(
+        "--shard_id",
+        help="The shard id of current node, Starts from 0 to num_shards - 1",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--num_shards",
+        help="Number of shards using by the job",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--init_method",
+        help="Initialization method, includes TCP or shared file-system",
+        default="tcp://localhost:9999",
+        type=str,
+    )
     parser.add_argument(
         "--cfg",
         dest="cfg_file",
@@ -67,6 +85,9 @@ def load_config(args):
         cfg.merge_from_list(args.opts)
 
     # Inherit parameters from args.
+    if hasattr(args, "num_shards") and hasattr(args, "shard_id"):
+        cfg.NUM_SHARDS = args.num_shards
+        cfg.SHARD_ID = args.shard_id
 
     # Create the checkpoint dir.
     return cfg
@@ -59,7 +59,7 @@ def orthorgonal_regularizer(w,scale,cuda=False):
 	ones = torch.ones(N * C, H, H, dtype=torch.float32)
 	diag = torch.eye(H, dtype=torch.float32)
 	tmp = ones - diag
-	if cuda:tmp = tmp.cuda()
+	if cuda:tmp = tmp.to(w.device)
 	loss_orth = ((weight_squared * tmp) ** 2).sum()
 	return loss_orth*scale
 
@@ -132,7 +132,7 @@ class LightweightEncoder(nn.Module):
 		x = self.sample(x)
 		x, likelihoods, _ = self.entropy_bottleneck(x, None, False, training=self.training)
 		# calculate bpp (estimated)
-		log2 = torch.log(torch.FloatTensor([2])).squeeze(0).cuda()
+		log2 = torch.log(torch.FloatTensor([2])).squeeze(0).to(x.device)
 		bits_est = torch.sum(torch.log(likelihoods)) / (-log2)
 		# calculate bpp (actual)
 		bits_act = self.entropy_bottleneck.get_actual_bits(x, False)
@@ -10,6 +10,7 @@ from compressai.entropy_models import EntropyModel,GaussianConditional,EntropyBo
 from compressai.models import CompressionModel
 from compressai.layers import AttentionBlock
 import sys, os, math, time
+from core.utils import codec_device
 sys.path.append('..')
         
 SCALES_MIN = 0.11
@@ -46,7 +47,7 @@ class RecProbModel(CompressionModel):
 
     def loss(self):
         if self.RPM_flag:
-            return torch.FloatTensor([0]).squeeze(0).cuda(0)
+            return torch.FloatTensor([0]).squeeze(0).to(codec_device(0))
         return self.aux_loss()
 
     def forward(
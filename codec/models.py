@@ -140,7 +140,7 @@ def compress_video_group(model, frame_idx, cache, startNewClip):
             # Capture frame-by-frame
             ret, img = cap.read()
             if ret != True:break
-            clip.append(transforms.ToTensor()(img).cuda())
+            clip.append(transforms.ToTensor()(img).to(codec_device(0)))
         # When everything done, release the video capture object
         cap.release()
         assert len(clip) == len(raw_clip), 'Clip size mismatch'
@@ -154,14 +154,14 @@ def compress_video_group(model, frame_idx, cache, startNewClip):
         cache['end_of_batch'] = {}
         bpp = video_size*1.0/len(clip)/(height*width)
         for i in range(frame_idx-1,len(clip)):
-            Y1_raw = transforms.ToTensor()(raw_clip[i]).cuda().unsqueeze(0)
+            Y1_raw = transforms.ToTensor()(raw_clip[i]).to(codec_device(0)).unsqueeze(0)
             Y1_com = clip[i].unsqueeze(0)
-            cache['img_loss'][i] = torch.FloatTensor([0]).squeeze(0).cuda(0)
-            cache['bpp_est'][i] = torch.FloatTensor([0]).cuda(0)
+            cache['img_loss'][i] = torch.FloatTensor([0]).squeeze(0).to(codec_device(0))
+            cache['bpp_est'][i] = torch.FloatTensor([0]).to(codec_device(0))
             cache['psnr'][i] = PSNR(Y1_raw, Y1_com)
             cache['msssim'][i] = MSSSIM(Y1_raw, Y1_com)
             cache['bpp_act'][i] = torch.FloatTensor([bpp])
-            cache['aux'][i] = torch.FloatTensor([0]).cuda(0)
+            cache['aux'][i] = torch.FloatTensor([0]).to(codec_device(0))
             cache['end_of_batch'][i] = (i%4==0 or i==(len(clip)-1))
         cache['clip'] = clip
     cache['max_seen'] = frame_idx-1
@@ -230,13 +230,13 @@ def progressive_compression(model, i, prev, cache, P_flag, RPM_flag):
         hidden = cache['hidden']
     Y1_com,hidden,bpp_est,img_loss,aux_loss,bpp_act,psnr,msssim = model(Y0_com, Y1_raw, hidden, RPM_flag)
     cache['hidden'] = hidden
-    cache['clip'][i] = Y1_com.detach().squeeze(0).cuda(0)
-    cache['img_loss'][i] = img_loss.cuda(0)
-    cache['aux'][i] = aux_loss.cuda(0)
-    cache['bpp_est'][i] = bpp_est.cuda(0)
-    cache['psnr'][i] = psnr.cuda(0)
-    cache['msssim'][i] = msssim.cuda(0)
-    cache['bpp_act'][i] = bpp_act.cuda(0)
+    cache['clip'][i] = Y1_com.detach().squeeze(0).to(codec_device(0))
+    cache['img_loss'][i] = img_loss.to(codec_device(0))
+    cache['aux'][i] = aux_loss.to(codec_device(0))
+    cache['bpp_est'][i] = bpp_est.to(codec_device(0))
+    cache['psnr'][i] = psnr.to(codec_device(0))
+    cache['msssim'][i] = msssim.to(codec_device(0))
+    cache['bpp_act'][i] = bpp_act.to(codec_device(0))
     cache['end_of_batch'][i] = (i%4==0)
     #print(i,float(bpp_est),float(bpp_act),float(psnr))
     # we can record PSNR wrt the distance to I-frame to show error propagation)
@@ -248,13 +248,13 @@ def parallel_compression(model, ranges, cache):
     # I frame compression
     I_frame_idx = ranges[0][0]
     x_hat, bpp_est, img_loss, aux_loss, bpp_act, psnr, msssim = I_compression(cache['clip'][I_frame_idx].unsqueeze(0), model.I_level, model_name=model.name)
-    cache['clip'][I_frame_idx] = x_hat.squeeze(0).cuda()
-    cache['img_loss'][I_frame_idx] = img_loss.cuda()
-    cache['aux'][I_frame_idx] = aux_loss.cuda()
-    cache['bpp_est'][I_frame_idx] = bpp_est.cuda()
-    cache['psnr'][I_frame_idx] = psnr.cuda()
-    cache['msssim'][I_frame_idx] = msssim.cuda()
-    cache['bpp_act'][I_frame_idx] = bpp_act.cuda()
+    cache['clip'][I_frame_idx] = x_hat.squeeze(0).to(codec_device(0))
+    cache['img_loss'][I_frame_idx] = img_loss.to(codec_device(0))
+    cache['aux'][I_frame_idx] = aux_loss.to(codec_device(0))
+    cache['bpp_est'][I_frame_idx] = bpp_est.to(codec_device(0))
+    cache['psnr'][I_frame_idx] = psnr.to(codec_device(0))
+    cache['msssim'][I_frame_idx] = msssim.to(codec_device(0))
+    cache['bpp_act'][I_frame_idx] = bpp_act.to(codec_device(0))
     cache['end_of_batch'][I_frame_idx] = True
     #model.psnr[I_frame_idx%13].update(float(psnr))
     #model.msssim[I_frame_idx%13].update(float(msssim))
@@ -365,18 +365,18 @@ class IterPredVideoCodecs(nn.Module):
         self.split()
 
     def split(self):
-        self.optical_flow.cuda(0)
-        self.mv_codec.cuda(0)
-        self.MC_network.cuda(1)
-        self.res_codec.cuda(1)
+        self.optical_flow.to(codec_device(0))
+        self.mv_codec.to(codec_device(0))
+        self.MC_network.to(codec_device(1))
+        self.res_codec.to(codec_device(1))
 
     def forward(self, Y0_com, Y1_raw, hidden_states, RPM_flag, use_psnr=True):
         # Y0_com: compressed previous frame, [1,c,h,w]
         # Y1_raw: uncompressed current frame
         batch_size, _, Height, Width = Y1_raw.shape
         if self.name == 'RAW':
-            bpp_est = bpp_act = metrics = torch.FloatTensor([0]).cuda(0)
-            aux_loss = img_loss = torch.FloatTensor([0]).squeeze(0).cuda(0)
+            bpp_est = bpp_act = metrics = torch.FloatTensor([0]).to(codec_device(0))
+            aux_loss = img_loss = torch.FloatTensor([0]).squeeze(0).to(codec_device(0))
             return Y1_raw, hidden_states, bpp_est, img_loss, aux_loss, bpp_act, metrics
         if Y0_com is None:
             Y1_com, bpp_est, img_loss, aux_loss, bpp_act, psnr, msssim = I_compression(Y1_raw, self.I_level)
@@ -401,7 +401,7 @@ class IterPredVideoCodecs(nn.Module):
         loc = get_grid_locations(batch_size, Height, Width).type(Y0_com.type())
         Y1_warp = F.grid_sample(Y0_com, loc + mv_hat.permute(0,2,3,1), align_corners=True)
         MC_input = torch.cat((mv_hat, Y0_com, Y1_warp), axis=1)
-        Y1_MC = self.MC_network(MC_input.cuda(1))
+        Y1_MC = self.MC_network(MC_input.to(codec_device(1)))
         t_comp = time.perf_counter() - t_0
         if not self.noMeasure:
             self.meters['E-MC'].update(t_comp)
@@ -409,7 +409,7 @@ class IterPredVideoCodecs(nn.Module):
         warp_loss = calc_loss(Y1_raw, Y1_warp.to(Y1_raw.device), self.r, use_psnr)
         mc_loss = calc_loss(Y1_raw, Y1_MC.to(Y1_raw.device), self.r, use_psnr)
         # compress residual
-        res_tensor = Y1_raw.cuda(1) - Y1_MC
+        res_tensor = Y1_raw.to(codec_device(1)) - Y1_MC
         res_hat,rae_res_hidden,rpm_res_hidden,res_act,res_est,res_aux = self.res_codec(res_tensor, rae_res_hidden, rpm_res_hidden, RPM_flag)
         if not self.noMeasure:
             self.meters['E-RES'].update(self.res_codec.enc_t)
@@ -423,7 +423,7 @@ class IterPredVideoCodecs(nn.Module):
             self.meters['D-REC'].update(time.perf_counter() - t_0)
         ##### compute bits
         # estimated bits
-        bpp_est = (mv_est + res_est.cuda(0))/(Height * Width * batch_size)
+        bpp_est = (mv_est + res_est.to(codec_device(0)))/(Height * Width * batch_size)
         # actual bits
         bpp_act = (mv_act + res_act.to(mv_act.device))/(Height * Width * batch_size)
         # auxilary loss
@@ -436,7 +436,7 @@ class IterPredVideoCodecs(nn.Module):
         img_loss += (l0+l1+l2+l3+l4)/5*1024*self.r_flow
         # hidden states
         hidden_states = (rae_mv_hidden.detach(), rae_res_hidden.detach(), rpm_mv_hidden, rpm_res_hidden)
-        return Y1_com.cuda(0), hidden_states, bpp_est, img_loss, aux_loss, bpp_act, psnr, msssim
+        return Y1_com.to(codec_device(0)), hidden_states, bpp_est, img_loss, aux_loss, bpp_act, psnr, msssim
         
     def loss(self, pix_loss, bpp_loss, aux_loss, app_loss=None):
         loss = self.r_img*pix_loss + self.r_bpp*bpp_loss + self.r_aux*aux_loss
@@ -446,10 +446,10 @@ class IterPredVideoCodecs(nn.Module):
         return loss
     
     def init_hidden(self, h, w):
-        rae_mv_hidden = torch.zeros(1,self.channels*4,h//4,w//4).cuda()
-        rae_res_hidden = torch.zeros(1,self.channels*4,h//4,w//4).cuda()
-        rpm_mv_hidden = torch.zeros(1,self.channels*2,h//16,w//16).cuda()
-        rpm_res_hidden = torch.zeros(1,self.channels*2,h//16,w//16).cuda()
+        rae_mv_hidden = torch.zeros(1,self.channels*4,h//4,w//4).to(codec_device(0))
+        rae_res_hidden = torch.zeros(1,self.channels*4,h//4,w//4).to(codec_device(0))
+        rpm_mv_hidden = torch.zeros(1,self.channels*2,h//16,w//16).to(codec_device(0))
+        rpm_res_hidden = torch.zeros(1,self.channels*2,h//16,w//16).to(codec_device(0))
         return (rae_mv_hidden, rae_res_hidden, rpm_mv_hidden, rpm_res_hidden)
             
 # DCVC?
@@ -457,7 +457,7 @@ class IterPredVideoCodecs(nn.Module):
 class DCVC(nn.Module):
     def __init__(self, name, channels=64, channels2=96, noMeasure=True):
         super(DCVC, self).__init__()
-        device = torch.device('cuda')
+        device = codec_device(0)
         self.ctx_encoder = nn.Sequential(nn.Conv2d(channels+3, channels, kernel_size=5, stride=2, padding=2),
                                         GDN(channels),
                                         ResidualBlock(channels,channels),
@@ -509,16 +509,16 @@ class DCVC(nn.Module):
         self.noMeasure = noMeasure
 
     def split(self):
-        self.optical_flow.cuda(0)
-        self.mv_codec.cuda(0)
-        self.MC_network.cuda(1)
-        self.feature_extract.cuda(1)
-        self.ctx_refine.cuda(1)
-        self.tmp_prior_encoder.cuda(1)
-        self.ctx_encoder.cuda(1)
-        self.latent_codec.cuda(1)
-        self.ctx_decoder1.cuda(1)
-        self.ctx_decoder2.cuda(1)
+        self.optical_flow.to(codec_device(0))
+        self.mv_codec.to(codec_device(0))
+        self.MC_network.to(codec_device(1))
+        self.feature_extract.to(codec_device(1))
+        self.ctx_refine.to(codec_device(1))
+        self.tmp_prior_encoder.to(codec_device(1))
+        self.ctx_encoder.to(codec_device(1))
+        self.latent_codec.to(codec_device(1))
+        self.ctx_decoder1.to(codec_device(1))
+        self.ctx_decoder2.to(codec_device(1))
     
     def forward(self, x_hat_prev, x, hidden_states, RPM_flag, use_psnr=True):
         if not self.noMeasure:
@@ -549,11 +549,11 @@ class DCVC(nn.Module):
         
         # warping
         t_0 = time.perf_counter()
-        loc = get_grid_locations(bs, h, w).cuda(1)
+        loc = get_grid_locations(bs, h, w).to(codec_device(1))
         # motion compensation
-        x_warp = F.grid_sample(x_hat_prev.cuda(1), loc + mv_hat.permute(0,2,3,1).cuda(1), align_corners=True) # the difference
+        x_warp = F.grid_sample(x_hat_prev.to(codec_device(1)), loc + mv_hat.permute(0,2,3,1).to(codec_device(1)), align_corners=True) # the difference
         warp_loss = calc_loss(x, x_warp.to(x.device), self.r, use_psnr)
-        x_mc = self.MC_network(torch.cat((mv_hat.cuda(1), x_hat_prev.cuda(1), x_warp), axis=1).cuda(1))
+        x_mc = self.MC_network(torch.cat((mv_hat.to(codec_device(1)), x_hat_prev.to(codec_device(1)), x_warp), axis=1).to(codec_device(1)))
         mc_loss = calc_loss(x, x_mc.to(x.device), self.r, use_psnr)
         
         # feature extraction
@@ -580,7 +580,7 @@ class DCVC(nn.Module):
             self.dec_t += [t_prior]
         
         # contextual encoder
-        y = self.ctx_encoder(torch.cat((x, context.to(x.device)), axis=1).cuda(1))
+        y = self.ctx_encoder(torch.cat((x, context.to(x.device)), axis=1).to(codec_device(1)))
         
         # entropy model
         y_hat,_,_,y_act,y_est,y_aux = self.latent_codec(y, prior=prior)
@@ -593,16 +593,16 @@ class DCVC(nn.Module):
             self.dec_t += [time.perf_counter() - t_0]
         
         # estimated bits
-        bpp_est = (mv_est + y_est.cuda(0))/(h * w * bs)
+        bpp_est = (mv_est + y_est.to(codec_device(0)))/(h * w * bs)
         # actual bits
-        bpp_act = (mv_act + y_act.cuda(0))/(h * w * bs)
+        bpp_act = (mv_act + y_act.to(codec_device(0)))/(h * w * bs)
         #print(float(mv_est/(h * w * bs)), float(mv_act/(h * w * bs)), float(y_est/(h * w * bs)), float(y_act/(h * w * bs)))
         # auxilary loss
-        aux_loss = (mv_aux + y_aux.cuda(0))
+        aux_loss = (mv_aux + y_aux.to(codec_device(0)))
         # calculate metrics/loss
-        psnr = PSNR(x, x_hat.cuda(0))
-        msssim = MSSSIM(x, x_hat.cuda(0))
-        rec_loss = calc_loss(x, x_hat.cuda(0), self.r, use_psnr)
+        psnr = PSNR(x, x_hat.to(codec_device(0)))
+        msssim = MSSSIM(x, x_hat.to(codec_device(0)))
+        rec_loss = calc_loss(x, x_hat.to(codec_device(0)), self.r, use_psnr)
         if self.name == 'DCVC':
             img_loss = (self.r_rec*rec_loss + self.r_warp*warp_loss)
         else:
@@ -612,7 +612,7 @@ class DCVC(nn.Module):
         hidden_states = (rae_mv_hidden.detach(), rpm_mv_hidden)
         if not self.noMeasure:
             print(np.sum(self.enc_t),np.sum(self.dec_t),self.enc_t,self.dec_t)
-        return x_hat.cuda(0), hidden_states, bpp_est, img_loss, aux_loss, bpp_act, psnr, msssim
+        return x_hat.to(codec_device(0)), hidden_states, bpp_est, img_loss, aux_loss, bpp_act, psnr, msssim
         
     def loss(self, pix_loss, bpp_loss, aux_loss, app_loss=None):
         if app_loss is None:
@@ -621,8 +621,8 @@ class DCVC(nn.Module):
             return self.r_app*app_loss + self.r_img*pix_loss + self.r_bpp*bpp_loss + self.r_aux*aux_loss
         
     def init_hidden(self, h, w):
-        rae_mv_hidden = torch.zeros(1,self.channels*4,h//4,w//4).cuda()
-        rpm_mv_hidden = torch.zeros(1,self.channels*2,h//16,w//16).cuda()
+        rae_mv_hidden = torch.zeros(1,self.channels*4,h//4,w//4).to(codec_device(0))
+        rpm_mv_hidden = torch.zeros(1,self.channels*2,h//16,w//16).to(codec_device(0))
         return (rae_mv_hidden, rpm_mv_hidden)
         
 class StandardVideoCodecs(nn.Module):
@@ -1034,7 +1034,7 @@ class Coder2D(nn.Module):
         bs,c,h,w = x.size()
         x_est = []
         x_act = []
-        x_aux = torch.FloatTensor([0]).squeeze(0).cuda()
+        x_aux = torch.FloatTensor([0]).squeeze(0).to(codec_device(0))
         if not self.downsample:
             rpm_hidden = torch.zeros(1,self.channels*2,h,w)
         else:
@@ -1049,13 +1049,13 @@ class Coder2D(nn.Module):
             x_hat_list.append(x_hat_i.squeeze(0))
             
             # calculate bpp (estimated) if it is training else it will be set to 0
-            x_est += [x_est_i.cuda()]
+            x_est += [x_est_i.to(codec_device(0))]
             
             # calculate bpp (actual)
-            x_act += [x_act_i.cuda()]
+            x_act += [x_act_i.to(codec_device(0))]
             
             # aux
-            x_aux += x_aux_i.cuda()
+            x_aux += x_aux_i.to(codec_device(0))
             
             if not self.noMeasure:
                 enc_t += self.enc_t
@@ -1063,7 +1063,7 @@ class Coder2D(nn.Module):
         x_hat = torch.stack(x_hat_list, dim=0)
         if not self.noMeasure:
             self.enc_t,self.dec_t = enc_t,dec_t
-        return x_hat,torch.FloatTensor(x_act).cuda(),torch.FloatTensor(x_est).cuda(),x_aux
+        return x_hat,torch.FloatTensor(x_act).to(codec_device(0)),torch.FloatTensor(x_est).to(codec_device(0)),x_aux
 
 class MCNet(nn.Module):
     def __init__(self):
@@ -1215,13 +1215,13 @@ class SPVC(nn.Module):
         self.use_psnr = False if self.name == 'SPVC-M' else True
 
     def split(self):
-        self.optical_flow.cuda(0)
-        self.mv_codec.cuda(0)
-        self.MC_network.cuda(1)
-        self.res_codec.cuda(1)
+        self.optical_flow.to(codec_device(0))
+        self.mv_codec.to(codec_device(0))
+        self.MC_network.to(codec_device(1))
+        self.res_codec.to(codec_device(1))
         
     def forward(self, x):
-        x = x.cuda(0)
+        x = x.to(codec_device(0))
         bs, c, h, w = x[1:].size()
         
         # BATCH:compute optical flow
@@ -1275,7 +1275,7 @@ class SPVC(nn.Module):
                 if tar>bs:continue
                 parent = parents[tar]
                 ref += [x[:1] if parent==0 else MC_frame_list[parent-1]] # ref needed for this id
-                diff += [mv_hat[tar-1:tar].cuda(1)] # motion needed for this id
+                diff += [mv_hat[tar-1:tar].to(codec_device(1))] # motion needed for this id
             if ref:
                 ref = torch.cat(ref,dim=0)
                 diff = torch.cat(diff,dim=0)
@@ -1310,11 +1310,11 @@ class SPVC(nn.Module):
             
         ##### compute bits
         # estimated bits
-        bpp_est = (mv_est.cuda(0) + res_est.cuda(0))/(h * w)
+        bpp_est = (mv_est.to(codec_device(0)) + res_est.to(codec_device(0)))/(h * w)
         # actual bits
-        bpp_act = (mv_act.cuda(0) + res_act.cuda(0))/(h * w)
+        bpp_act = (mv_act.to(codec_device(0)) + res_act.to(codec_device(0)))/(h * w)
         # auxilary loss
-        aux_loss = (mv_aux.cuda(0) + res_aux.cuda(0))
+        aux_loss = (mv_aux.to(codec_device(0)) + res_aux.to(codec_device(0)))
         aux_loss = aux_loss.repeat(bs)
         # calculate metrics/loss
         psnr = PSNR(x_tar, com_frames, use_list=True)
@@ -1322,7 +1322,7 @@ class SPVC(nn.Module):
         mc_loss = calc_loss(x_tar, MC_frames, self.r, self.use_psnr)
         warp_loss = calc_loss(x_tar, warped_frames, self.r, self.use_psnr)
         rec_loss = calc_loss(x_tar, com_frames, self.r, self.use_psnr)
-        flow_loss = (l0+l1+l2+l3+l4).cuda(0)/5*1024
+        flow_loss = (l0+l1+l2+l3+l4).to(codec_device(0))/5*1024
         img_loss = (self.r_rec*rec_loss + \
                     self.r_warp*warp_loss + \
                     self.r_mc*mc_loss + \
@@ -1332,9 +1332,9 @@ class SPVC(nn.Module):
         return com_frames, bpp_est, img_loss, aux_loss, bpp_act, psnr, msssim
     
     def loss(self, pix_loss, bpp_loss, aux_loss, app_loss=None):
-        loss = self.r_img*pix_loss.cuda(0) + self.r_bpp*bpp_loss.cuda(0) + self.r_aux*aux_loss.cuda(0)
+        loss = self.r_img*pix_loss.to(codec_device(0)) + self.r_bpp*bpp_loss.to(codec_device(0)) + self.r_aux*aux_loss.to(codec_device(0))
         if app_loss is not None:
-            loss += self.r_app*app_loss.cuda(0)
+            loss += self.r_app*app_loss.to(codec_device(0))
         return loss
         
     def init_hidden(self, h, w):
@@ -1345,7 +1345,7 @@ class SCVC(nn.Module):
     def __init__(self, name, channels=64, channels2=96, noMeasure=True):
         super(SCVC, self).__init__()
         self.name = name 
-        device = torch.device('cuda')
+        device = codec_device(0)
         self.optical_flow = OpticalFlowNet()
         self.mv_codec = Coder2D('attn', in_channels=2, channels=channels, kernel=3, padding=1, noMeasure=noMeasure)
         self.MC_network = MCNet()
@@ -1393,15 +1393,15 @@ class SCVC(nn.Module):
         self.noMeasure = noMeasure
 
     def split(self):
-        self.optical_flow.cuda(0)
-        self.mv_codec.cuda(0)
-        self.feature_extract.cuda(0)
-        self.MC_network.cuda(0)
-        self.tmp_prior_encoder.cuda(1)
-        self.ctx_encoder.cuda(1)
-        self.latent_codec.cuda(1)
-        self.ctx_decoder1.cuda(1)
-        self.ctx_decoder2.cuda(1)
+        self.optical_flow.to(codec_device(0))
+        self.mv_codec.to(codec_device(0))
+        self.feature_extract.to(codec_device(0))
+        self.MC_network.to(codec_device(0))
+        self.tmp_prior_encoder.to(codec_device(1))
+        self.ctx_encoder.to(codec_device(1))
+        self.latent_codec.to(codec_device(1))
+        self.ctx_decoder1.to(codec_device(1))
+        self.ctx_decoder2.to(codec_device(1))
         
     def forward(self, x, use_psnr=True):
         # x=[B,C,H,W]: input sequence of frames
@@ -1437,13 +1437,13 @@ class SCVC(nn.Module):
         
         t_0 = time.perf_counter()
         # BATCH:extract context
-        context = self.feature_extract(MC_frames).cuda(1)
+        context = self.feature_extract(MC_frames).to(codec_device(1))
         
         # BATCH:temporal prior
         prior = self.tmp_prior_encoder(context)
         
         # contextual encoder
-        y = self.ctx_encoder(torch.cat((x[1:].cuda(1), context), axis=1))
+        y = self.ctx_encoder(torch.cat((x[1:].to(codec_device(1)), context), axis=1))
         t_ctx = time.perf_counter() - t_0
         #print('Context:',t_ctx)
         
@@ -1472,7 +1472,7 @@ class SCVC(nn.Module):
         mc_loss = calc_loss(x[1:], MC_frames, self.r, use_psnr)
         warp_loss = calc_loss(x[1:], warped_frames, self.r, use_psnr)
         rec_loss = calc_loss(x[1:], com_frames, self.r, use_psnr)
-        flow_loss = (l0+l1+l2+l3+l4).cuda(0)/5*1024
+        flow_loss = (l0+l1+l2+l3+l4).to(codec_device(0))/5*1024
         img_loss = self.r_warp*warp_loss + \
                     self.r_mc*mc_loss + \
                     self.r_rec*rec_loss + \
@@ -1482,9 +1482,9 @@ class SCVC(nn.Module):
         return x_hat, bpp_est, img_loss, aux_loss.repeat(bs), bpp_act, psnr, msssim
     
     def loss(self, pix_loss, bpp_loss, aux_loss, app_loss=None):
-        loss = self.r_img*pix_loss.cuda(0) + self.r_bpp*bpp_loss.cuda(0) + self.r_aux*aux_loss.cuda(0)
+        loss = self.r_img*pix_loss.to(codec_device(0)) + self.r_bpp*bpp_loss.to(codec_device(0)) + self.r_aux*aux_loss.to(codec_device(0))
         if app_loss is not None:
-            loss += self.r_app*app_loss.cuda(0)
+            loss += self.r_app*app_loss.to(codec_device(0))
         return loss
         
     def init_hidden(self, h, w):
@@ -1494,7 +1494,7 @@ class AE3D(nn.Module):
     def __init__(self, name, noMeasure=True):
         super(AE3D, self).__init__()
         self.name = name 
-        device = torch.device('cuda')
+        device = codec_device(0)
         self.conv1 = nn.Sequential(
             nn.Conv3d(3, 64, kernel_size=5, stride=(1,2,2), padding=2), 
             nn.BatchNorm3d(64),
@@ -1546,13 +1546,13 @@ class AE3D(nn.Module):
 
     def split(self):
         # too much on cuda:0
-        self.conv1.cuda(0)
-        self.conv2.cuda(0)
-        self.conv3.cuda(0)
-        self.deconv1.cuda(1)
-        self.deconv2.cuda(1)
-        self.deconv3.cuda(1)
-        self.latent_codec.cuda(0)
+        self.conv1.to(codec_device(0))
+        self.conv2.to(codec_device(0))
+        self.conv3.to(codec_device(0))
+        self.deconv1.to(codec_device(1))
+        self.deconv2.to(codec_device(1))
+        self.deconv3.to(codec_device(1))
+        self.latent_codec.to(codec_device(0))
         
     def forward(self, x, RPM_flag=False, use_psnr=True):
             
@@ -1585,7 +1585,7 @@ class AE3D(nn.Module):
         
         # decoder
         t_0 = time.perf_counter()
-        x3 = self.deconv1(latent_hat.cuda(1))
+        x3 = self.deconv1(latent_hat.to(codec_device(1)))
         x4 = self.deconv2(x3) + x3
         x_hat = self.deconv3(x4)
         if not self.noMeasure:
@@ -1609,15 +1609,15 @@ class AE3D(nn.Module):
         img_loss = calc_loss(x, x_hat.to(x.device), self.r, use_psnr)
         img_loss = img_loss.repeat(t)
         
-        return x_hat.cuda(0), bpp_est, img_loss, aux_loss, bpp_act, psnr, msssim
+        return x_hat.to(codec_device(0)), bpp_est, img_loss, aux_loss, bpp_act, psnr, msssim
     
     def init_hidden(self, h, w):
         return None
         
     def loss(self, pix_loss, bpp_loss, aux_loss, app_loss=None):
-        loss = self.r_img*pix_loss.cuda(0) + self.r_bpp*bpp_loss.cuda(0) + self.r_aux*aux_loss.cuda(0)
+        loss = self.r_img*pix_loss.to(codec_device(0)) + self.r_bpp*bpp_loss.to(codec_device(0)) + self.r_aux*aux_loss.to(codec_device(0))
         if app_loss is not None:
-            loss += self.r_app*app_loss.cuda(0)
+            loss += self.r_app*app_loss.to(codec_device(0))
         return loss
         
 class ResBlockA(nn.Module):
@@ -1655,7 +1655,7 @@ def test_batch_proc(name = 'SPVC',batch_size = 7):
     
     h = w = 224
     channels = 64
-    x = torch.randn(batch_size,3,h,w).cuda()
+    x = torch.randn(batch_size,3,h,w).to(codec_device(0))
     if 'SPVC' in name:
         model = SPVC(name,channels,noMeasure=False)
     elif name == 'SCVC':
@@ -1701,7 +1701,7 @@ def test_seq_proc(name='RLVC'):
     print('------------',name,'------------')
     batch_size = 1
     h = w = 224
-    x = torch.rand(batch_size,3,h,w).cuda()
+    x = torch.rand(batch_size,3,h,w).to(codec_device(0))
     if name == 'DCVC' or name == 'DCVC_v2':
         model = DCVC(name,noMeasure=False)
     else:
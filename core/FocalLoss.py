@@ -41,26 +41,33 @@ class FocalLoss(nn.Module):
         self.class_num = class_num
         self.size_average = size_average
 
-    def forward(self, inputs, targets):
+    def forward(self, inputs, targets, mask=None):
+        # mask: optional (N,) 0/1 weights of the observations that take part in the loss. Masked
+        # out rows are computed and weighted by zero, which avoids selecting rows on the host.
         N = inputs.size(0)
         #print(N)
         C = inputs.size(1)
-        P = F.softmax(inputs, dim=1)
-
-        class_mask = inputs.data.new(N, C).fill_(0)
-        class_mask = Variable(class_mask)
         ids = targets.view(-1, 1)
-        class_mask.scatter_(1, ids, 1.)
-        #print(class_mask)
-        
 
-        if inputs.is_cuda and not self.alpha.is_cuda:
-            self.alpha = self.alpha.cuda()
+        if self.alpha.device != inputs.device:
+            self.alpha = self.alpha.to(inputs.device)
         alpha = self.alpha[ids.data.view(-1)]
         
-        probs = (P*class_mask).sum(1).view(-1,1)
+        if mask is None:
+            P = F.softmax(inputs, dim=1)
+
+            class_mask = inputs.data.new(N, C).fill_(0)
+            class_mask = Variable(class_mask)
+            class_mask.scatter_(1, ids, 1.)
+            #print(class_mask)
 
-        log_p = probs.log()
+            probs = (P*class_mask).sum(1).view(-1,1)
+
+            log_p = probs.log()
+        else:
+            # log_softmax keeps the masked out rows finite
+            log_p = F.log_softmax(inputs, dim=1).gather(1, ids)
+            probs = log_p.exp()
         #print('probs size= {}'.format(probs.size()))
         #print(probs)
 
@@ -69,7 +76,10 @@ class FocalLoss(nn.Module):
         #print(batch_loss)
 
         
-        if self.size_average:
+        if mask is not None:
+            batch_loss = batch_loss * mask.view(-1, 1)
+            loss = batch_loss.sum()/mask.sum() if self.size_average else batch_loss.sum()
+        elif self.size_average:
             loss = batch_loss.mean()
         else:
             loss = batch_loss.sum()
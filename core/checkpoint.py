@@ -0,0 +1,118 @@
+import os
+import glob
+import shutil
+import threading
+
+import torch
+
+import core.distributed as du
+
+
+def snapshot_to_cpu(state):
+    # copy of a (nested) state dict on the CPU, so training can keep updating the originals
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, snapshot_to_cpu(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_to_cpu(v) for v in state)
+    return state
+
+
+def atomic_save(state, path):
+    # write next to the target and rename, a killed job leaves the previous file intact
+    tmp = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def atomic_link(src, dst):
+    # point dst at the content of src, hard links avoid writing the file twice
+    tmp = '%s.tmp%d' % (dst, os.getpid())
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class CheckpointManager(object):
+    """
+    Writes checkpoints of the master process on a background thread.
+
+    The state is copied to CPU memory in the training thread, then written to
+    <name>_<suffix>_e<epoch>[_b<batch>].pth and linked to <name>_<suffix>.pth
+    and, for the best score, <name>_best.pth. Only the last `keep` rolling
+    files are kept, at most one write is in flight.
+    """
+
+    def __init__(self, directory, name, suffix='checkpoint', keep=3, async_write=True):
+        self.directory = directory
+        self.name = name
+        self.suffix = suffix
+        self.keep = keep
+        self.async_write = async_write
+        self.latest_path = os.path.join(directory, '%s_%s.pth' % (name, suffix))
+        self.best_path = os.path.join(directory, '%s_best.pth' % name)
+        # continue rotating the files of an earlier run
+        self.rolling = sorted(glob.glob(os.path.join(directory, '%s_%s_e*.pth' % (name, suffix))), key=os.path.getmtime)
+        self._thread = None
+        self._error = None
+
+    def _rolling_path(self, state):
+        tag = 'e%03d' % state.get('epoch', 0)
+        if 'batch_idx' in state:
+            tag += '_b%06d' % state['batch_idx']
+        return os.path.join(self.directory, '%s_%s_%s.pth' % (self.name, self.suffix, tag))
+
+    def save(self, state, is_best=False):
+        if not du.is_master_proc():
+            return
+        self.wait()
+        snapshot = snapshot_to_cpu(state)
+        if self.async_write:
+            self._thread = threading.Thread(target=self._write, args=(snapshot, is_best))
+            self._thread.start()
+        else:
+            self._write(snapshot, is_best)
+            self._raise()
+
+    def _write(self, state, is_best):
+        try:
+            if self.keep > 0:
+                path = self._rolling_path(state)
+                atomic_save(state, path)
+                atomic_link(path, self.latest_path)
+                if path in self.rolling:
+                    self.rolling.remove(path)
+                self.rolling.append(path)
+                while len(self.rolling) > self.keep:
+                    old = self.rolling.pop(0)
+                    if os.path.exists(old):
+                        os.remove(old)
+            else:
+                atomic_save(state, self.latest_path)
+            if is_best:
+                atomic_link(self.latest_path, self.best_path)
+        except BaseException as e:
+            self._error = e
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def wait(self):
+        # block until the pending write is on disk, errors of the writer surface here
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._raise()
+
+    def close(self):
+        self.wait()
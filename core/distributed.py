@@ -0,0 +1,232 @@
+"""Multi-process helpers, the launcher follows the SlowFast layout of one process per device."""
+
+import torch
+import torch.distributed as dist
+from contextlib import nullcontext
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Sampler
+
+
+def run(local_rank, num_proc, func, init_method, shard_id, num_shards, backend, cfg):
+    """
+    Runs a function from a child process.
+    Args:
+        local_rank (int): rank of the current process on the current machine.
+        num_proc (int): number of processes per machine.
+        func (function): function to execute on each of the process.
+        init_method (string): method to initialize the distributed training.
+            TCP initialization: requiring a network address reachable from all
+            processes followed by the port.
+            Shared file-system initialization: makes use of a file system that
+            is shared and visible from all machines. The URL should start with
+            file:// and contain a path to a non-existent file on a shared file
+            system.
+        shard_id (int): the rank of the current machine.
+        num_shards (int): number of overall machines for the distributed
+            training job.
+        backend (string): three distributed backends ('nccl', 'gloo', 'mpi') are
+            supports, each with different capabilities. Details can be found
+            here:
+            https://pytorch.org/docs/stable/distributed.html
+        cfg (CfgNode): configs. Details can be found in
+            cfg/defaults.py
+    """
+    world_size = num_proc * num_shards
+    rank = shard_id * num_proc + local_rank
+    if backend == 'nccl' and not (cfg.SYSTEM.DEVICE == 'cuda' and torch.cuda.is_available()):
+        backend = 'gloo' # nccl needs GPUs, gloo runs the same job on CPU processes
+    dist.init_process_group(backend=backend, init_method=init_method, world_size=world_size, rank=rank)
+    func(cfg)
+    dist.destroy_process_group()
+
+
+def launch_job(cfg, init_method, func, daemon=False):
+    """
+    Run 'func' on one or more processes, cfg.NUM_GPUS processes on each of
+    the cfg.NUM_SHARDS machines.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            cfg/defaults.py
+        init_method (str): initialization method to launch the job with multiple
+            devices.
+        func (function): job to run on the processes, called as func(cfg).
+        daemon (bool): The spawned processes’ daemon flag. If set to True,
+            daemonic processes will be created
+    """
+    if cfg.NUM_GPUS * cfg.NUM_SHARDS > 1:
+        torch.multiprocessing.spawn(
+            run,
+            nprocs=cfg.NUM_GPUS,
+            args=(cfg.NUM_GPUS, func, init_method, cfg.SHARD_ID, cfg.NUM_SHARDS, cfg.DIST_BACKEND, cfg),
+            daemon=daemon,
+        )
+    else:
+        func(cfg)
+
+
+def is_dist_initialized():
+    return dist.is_available() and dist.is_initialized()
+
+def get_world_size():
+    return dist.get_world_size() if is_dist_initialized() else 1
+
+def get_rank():
+    return dist.get_rank() if is_dist_initialized() else 0
+
+def get_local_rank(cfg):
+    return get_rank() % cfg.NUM_GPUS
+
+def is_master_proc():
+    return get_rank() == 0
+
+def synchronize():
+    if get_world_size() > 1:
+        dist.barrier()
+
+
+def _reduce_device():
+    # nccl only reduces GPU tensors
+    if dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+def all_reduce_sum(values):
+    # sum a list of python numbers over all processes
+    if get_world_size() == 1:
+        return list(values)
+    t = torch.tensor(values, dtype=torch.float64, device=_reduce_device())
+    dist.all_reduce(t)
+    return t.tolist()
+
+def all_gather_list(items):
+    # concatenate a picklable list from all processes, in rank order
+    if get_world_size() == 1:
+        return items
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, items)
+    return [item for rank_items in gathered for item in rank_items]
+
+def all_reduce_avg(meter):
+    # average of an AverageMeter over the updates of all processes
+    total, count = all_reduce_sum([meter.sum, meter.count])
+    return total / count if count else 0
+
+def broadcast_object(obj, src=0):
+    if get_world_size() == 1:
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=src)
+    return objs[0]
+
+@torch.no_grad()
+def broadcast_model(model, src=0):
+    # same parameters and buffers on every process for models trained outside DistributedDataParallel
+    if get_world_size() == 1:
+        return
+    for t in list(model.parameters()) + list(model.buffers()):
+        data = t.data.to(_reduce_device())
+        dist.broadcast(data, src=src)
+        t.data.copy_(data)
+
+@torch.no_grad()
+def average_buffers(model):
+    # floating point buffers, e.g. batch norm statistics, drift apart because every process
+    # normalizes its own data, the parameters are kept equal by GradientSync
+    world_size = get_world_size()
+    if world_size == 1:
+        return
+    for b in model.buffers():
+        if b.is_floating_point():
+            data = b.data.to(_reduce_device())
+            dist.all_reduce(data)
+            b.data.copy_(data.div_(world_size))
+
+
+class GradientSync:
+    """
+    Synchronized data-parallel optimizer steps for models trained outside
+    DistributedDataParallel, e.g. the codec that runs inside the dataset and is
+    stepped once per video, so the processes step a different number of times.
+
+    Every process calls all_reduce before each optimizer step, which averages the
+    gradients over the processes that step. A process that runs out of data calls
+    join, which takes part in the remaining steps of the others without gradients,
+    so parameters and optimizer states stay equal on all processes.
+    """
+
+    def __init__(self, model):
+        self.model = model
+
+    @torch.no_grad()
+    def all_reduce(self, contribute=True):
+        # returns the number of processes that contributed gradients to this step
+        if get_world_size() == 1:
+            return int(contribute)
+        params = [p for p in self.model.parameters() if p.requires_grad]
+        device = _reduce_device()
+        grads, has_grad = [], []
+        for p in params:
+            has_grad.append(float(contribute and p.grad is not None))
+            if has_grad[-1]:
+                grads.append(p.grad.detach().float().flatten().to(device))
+            else:
+                grads.append(torch.zeros(p.numel(), device=device))
+        # one all-reduce for the gradients, for which parameters a process has gradients and the count
+        flags = torch.tensor(has_grad + [float(contribute)], device=device)
+        flat = torch.cat(grads + [flags])
+        dist.all_reduce(flat)
+        count = int(flat[-1].item())
+        if count == 0:
+            return 0
+        offset = 0
+        for p, n in zip(params, flat[-len(flags):-1].tolist()):
+            g = flat[offset:offset + p.numel()]
+            offset += p.numel()
+            p.grad = (g / count).view_as(p).to(p.device, p.dtype) if n > 0 else None
+        return count
+
+    def join(self, step):
+        # called once the data of this process is exhausted, step() updates the model with the
+        # averaged gradients of the processes that still train until none is left
+        while self.all_reduce(contribute=False):
+            step()
+
+
+def wrap_model(model, cfg, device):
+    # DistributedDataParallel when launched on several processes, otherwise the DataParallel wrapper,
+    # both prefix the state dict with 'module.' so checkpoints are interchangeable.
+    # Buffers are not broadcast on forward, evaluation runs a different number of batches per process.
+    if get_world_size() > 1:
+        device_ids = [device.index] if device.type == 'cuda' else None
+        return DistributedDataParallel(model, device_ids=device_ids, broadcast_buffers=False)
+    return torch.nn.DataParallel(model, device_ids=None)
+
+def no_sync(model, sync):
+    # skip the gradient all-reduce on accumulation steps that do not call the optimizer
+    if not sync and isinstance(model, DistributedDataParallel):
+        return model.no_sync()
+    return nullcontext()
+
+
+def shard_range(num_samples):
+    # contiguous [start, end) part of a sequentially processed dataset for this process
+    world_size, rank = get_world_size(), get_rank()
+    return num_samples * rank // world_size, num_samples * (rank + 1) // world_size
+
+
+class InferenceSampler(Sampler):
+    """
+    Splits the indices over the processes without padding, unlike
+    DistributedSampler, so merged evaluation results hold every sample once.
+    """
+
+    def __init__(self, dataset):
+        self._num_samples = len(dataset)
+        self._rank = get_rank()
+        self._world_size = get_world_size()
+
+    def __iter__(self):
+        return iter(range(self._rank, self._num_samples, self._world_size))
+
+    def __len__(self):
+        return len(range(self._rank, self._num_samples, self._world_size))
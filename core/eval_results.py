@@ -116,16 +116,34 @@ def link_video_one_class(vid_det, bNMS3d = False, gtlen=None):
     return vres
 
 
-def video_ap_one_class(gt, pred_videos, iou_thresh = 0.2, bTemporal = False, gtlen = None):
+def link_video(img_boxes, CLASSES, gtlen = None):
+    '''
+    linking for all classes of one video, can run as soon as the detections of the video are complete
+    img_boxes: {imgname: {cls_ind: array[x1,y1,x2,y2, cls_score]}} of the frames of the video
+    return {cls_ind: [array[frame_index, x1,y1,x2,y2, cls_score]]}
+    '''
+    keys = sorted(img_boxes.keys())
+    tubes = {}
+    for cls_ind in range(1, len(CLASSES) + 1):
+        vid_det = [[i + 1, img_boxes[k][cls_ind]] for i, k in enumerate(keys)]
+        tubes[cls_ind] = link_video_one_class(vid_det, True, gtlen)
+    return tubes
+
+
+def video_ap_one_class(gt, pred_videos, iou_thresh = 0.2, bTemporal = False, gtlen = None, linked = False):
     '''
     gt: [ video_index, array[frame_index, x1,y1,x2,y2] ]
     pred_videos: [ video_index, [ [frame_index, [[x1,y1,x2,y2, score]] ] ] ]
+    or with linked: [ video_index, [array<frame_index, x1,y1,x2,y2, cls_score>] ]
     '''
     # link for prediction
     pred = []
     for pred_v in pred_videos:
         video_index = pred_v[0]
-        pred_link_v = link_video_one_class(pred_v[1], True, gtlen) # [array<frame_index, x1,y1,x2,y2, cls_score>]
+        if linked:
+            pred_link_v = pred_v[1]
+        else:
+            pred_link_v = link_video_one_class(pred_v[1], True, gtlen) # [array<frame_index, x1,y1,x2,y2, cls_score>]
         for tube in pred_link_v:
             pred.append((video_index, tube))
 
@@ -193,10 +211,12 @@ def gt_to_videts(gt_v):
     return res
 
 
-def evaluate_videoAP(gt_videos, all_boxes, CLASSES, iou_thresh = 0.2, bTemporal = False, prior_length = None):
+def evaluate_videoAP(gt_videos, all_boxes, CLASSES, iou_thresh = 0.2, bTemporal = False, prior_length = None, video_tubes = None):
     '''
     gt_videos: {vname:{tubes: [[frame_index, x1,y1,x2,y2]], gt_classes: vlabel}} 
     all_boxes: {imgname:{cls_ind:array[x1,y1,x2,y2, cls_score]}}
+    video_tubes: {vname: link_video(...)}, tubes linked beforehand in place of all_boxes,
+        the linking does not depend on iou_thresh
     '''
     def imagebox_to_videts(img_boxes, CLASSES):
         # image names
@@ -233,7 +253,13 @@ def evaluate_videoAP(gt_videos, all_boxes, CLASSES, iou_thresh = 0.2, bTemporal
         return res
 
     gt_videos_format = gt_to_videts(gt_videos)
-    pred_videos_format = imagebox_to_videts(all_boxes, CLASSES)
+    if video_tubes is not None:
+        # video indices in sorted name order, like gt_to_videts and imagebox_to_videts
+        vnames = sorted(video_tubes.keys())
+        pred_videos_format = [[cls_ind, i + 1, video_tubes[v][cls_ind]] for cls_ind in range(1, len(CLASSES) + 1)
+                              for i, v in enumerate(vnames)]
+    else:
+        pred_videos_format = imagebox_to_videts(all_boxes, CLASSES)
     ap_all = []    
     for cls_ind, cls in enumerate(CLASSES[0:]):
         cls_ind += 1
@@ -241,7 +267,7 @@ def evaluate_videoAP(gt_videos, all_boxes, CLASSES, iou_thresh = 0.2, bTemporal
         gt = [g[1:] for g in gt_videos_format if g[0]==cls_ind]
         pred_cls = [p[1:] for p in pred_videos_format if p[0]==cls_ind]
         cls_len = None
-        ap = video_ap_one_class(gt, pred_cls, iou_thresh, bTemporal, cls_len)
+        ap = video_ap_one_class(gt, pred_cls, iou_thresh, bTemporal, cls_len, linked = video_tubes is not None)
         ap_all.append(ap)
 
     return ap_all
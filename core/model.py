@@ -1,3 +1,4 @@
+import collections
 import torch
 import torch.nn as nn
 import numpy as np
@@ -58,14 +59,13 @@ class YOWO(nn.Module):
             raise ValueError("Wrong backbone_3d model is requested. Please select it from [resnext101, resnet101, \
                              resnet50, resnet18, mobilenet_2x, mobilenetv2_1x, shufflenet_2x, shufflenetv2_2x]")
         if cfg.WEIGHTS.BACKBONE_3D:# load pretrained weights on Kinetics-600 dataset
-            self.backbone_3d = self.backbone_3d.cuda()
-            self.backbone_3d = nn.DataParallel(self.backbone_3d, device_ids=None) # Because the pretrained backbone models are saved in Dataparalled mode
-            pretrained_3d_backbone = torch.load(cfg.WEIGHTS.BACKBONE_3D)
+            pretrained_3d_backbone = torch.load(cfg.WEIGHTS.BACKBONE_3D, map_location='cpu')
             backbone_3d_dict = self.backbone_3d.state_dict()
-            pretrained_3d_backbone_dict = {k: v for k, v in pretrained_3d_backbone['state_dict'].items() if k in backbone_3d_dict} # 1. filter out unnecessary keys
+            # the pretrained backbone models are saved in DataParallel mode, drop the 'module.' prefix
+            pretrained_3d_backbone_dict = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in pretrained_3d_backbone['state_dict'].items()}
+            pretrained_3d_backbone_dict = {k: v for k, v in pretrained_3d_backbone_dict.items() if k in backbone_3d_dict} # 1. filter out unnecessary keys
             backbone_3d_dict.update(pretrained_3d_backbone_dict) # 2. overwrite entries in the existing state dict
             self.backbone_3d.load_state_dict(backbone_3d_dict) # 3. load the new state dict
-            self.backbone_3d = self.backbone_3d.module # remove the dataparallel wrapper
 
         ##### Attention & Final Conv #####
         self.cfam = CFAMBlock(num_ch_2d+num_ch_3d, 1024)
@@ -75,13 +75,20 @@ class YOWO(nn.Module):
 
 
 
-    def forward(self, input):
+    def backbone_features(self, input):
         x_3d = input # Input clip
         x_2d = input[:, :, -1, :, :] # Last frame of the clip that is read
 
         x_2d = self.backbone_2d(x_2d)
         x_3d = self.backbone_3d(x_3d)
         x_3d = torch.squeeze(x_3d, dim=2)
+        return x_2d, x_3d
+
+    def forward(self, input):
+        if isinstance(input, (tuple, list)): # backbone outputs (x_2d, x_3d) from the feature cache
+            x_2d, x_3d = input
+        else:
+            x_2d, x_3d = self.backbone_features(input)
 
         x = torch.cat((x_3d, x_2d), dim=1)
         x = self.cfam(x)
@@ -91,7 +98,7 @@ class YOWO(nn.Module):
         return out
 
 
-def get_fine_tuning_parameters(model, cfg):
+def get_fine_tuning_module_names(cfg):
     ft_module_names = ['cfam', 'conv_final'] # Always fine tune 'cfam' and 'conv_final'
     if not cfg.WEIGHTS.FREEZE_BACKBONE_2D:
         ft_module_names.append('backbone_2d') # Fine tune complete backbone_3d
@@ -103,14 +110,45 @@ def get_fine_tuning_parameters(model, cfg):
         ft_module_names.append('backbone_3d') # Fine tune complete backbone_3d
     else:
         ft_module_names.append('backbone_3d.layer4') # Fine tune only layer 4
+    return ft_module_names
+
 
-    parameters = []
+def freeze_parameters(model, cfg):
+    # Parameters outside the fine tuned modules get no gradients, autograd does not record the
+    # frozen layers in front of the first trained one and the optimizer keeps no state for them.
+    # Call before wrapping the model in DistributedDataParallel, which registers the trained parameters.
+    ft_module_names = get_fine_tuning_module_names(cfg)
     for k, v in model.named_parameters():
-        for ft_module in ft_module_names:
-            if ft_module in k:
-                parameters.append({'params': v})
-                break
-        else:
-            parameters.append({'params': v, 'lr': 0.0})
-    
-    return parameters
+        if not any(ft_module in k for ft_module in ft_module_names):
+            v.requires_grad_(False)
+    return model
+
+
+def get_fine_tuning_parameters(model, cfg):
+    # One param group per fine tuned module instead of one per tensor, so the optimizer
+    # updates each group with its multi-tensor (foreach) kernels
+    ft_module_names = get_fine_tuning_module_names(cfg)
+    groups = collections.OrderedDict()
+    for k, v in model.named_parameters():
+        name = next((ft_module for ft_module in ft_module_names if ft_module in k), None)
+        if name is not None and v.requires_grad:
+            groups.setdefault(name, []).append(v)
+
+    return [{'params': params, 'name': name} for name, params in groups.items()]
+
+
+def set_channels_last(model):
+    # 2D convolutions (Darknet, CFAM, final conv) in channels_last and the 3D backbone in channels_last_3d
+    for m in model.modules():
+        if isinstance(m, nn.Conv2d):
+            m.to(memory_format=torch.channels_last)
+        elif isinstance(m, nn.Conv3d):
+            m.to(memory_format=torch.channels_last_3d)
+    return model
+
+
+def freeze_backbones(model):
+    # backbones that only run to fill the feature cache, cfam and conv_final are trained
+    for p in list(model.backbone_2d.parameters()) + list(model.backbone_3d.parameters()):
+        p.requires_grad_(False)
+    return model
@@ -1,68 +1,107 @@
 import os
 import torch
 import time
+from contextlib import nullcontext
 from core.utils import *
+import core.distributed as du
+from core.profiler import NullProfiler
+from datasets.prefetcher import DataPrefetcher
 from datasets.meters import AVAMeter
 
 
 
-def train_ava(cfg, epoch, model, train_loader, loss_module, optimizer):
+def train_ava(cfg, epoch, model, train_loader, loss_module, optimizer, profiler=None):
+    device = get_device(cfg)
+    profiler = profiler or NullProfiler()
+    profiler.start()
+    # a DataPrefetcher hands out batches on the device and records their copies as 'h2d' itself
+    prefetched = isinstance(train_loader, DataPrefetcher)
+    scaler = amp_grad_scaler(cfg, device)
     t0 = time.time()
     loss_module.reset_meters()
     l_loader = len(train_loader)
 
     model.train()
-    for batch_idx, batch in enumerate(train_loader):
-        data = batch['clip'].cuda()
+    for batch_idx, batch in enumerate(profiler.iter(train_loader)):
+        with profiler.phase('h2d') if not prefetched else nullcontext():
+            data = clip_to_device(batch['clip'], cfg, device)
         target = {'cls': batch['cls'], 'boxes': batch['boxes']}
-        output = model(data)
-        loss = loss_module(output, target, epoch, batch_idx, l_loader)
-
-        loss.backward()
-        steps = cfg.TRAIN.TOTAL_BATCH_SIZE // cfg.TRAIN.BATCH_SIZE
+        # every process contributes TRAIN.BATCH_SIZE clips to the TRAIN.TOTAL_BATCH_SIZE of one step,
+        # gradients are only all-reduced on the steps that call the optimizer
+        steps = max(cfg.TRAIN.TOTAL_BATCH_SIZE // (cfg.TRAIN.BATCH_SIZE * du.get_world_size()), 1)
+        with du.no_sync(model, batch_idx % steps == 0):
+            with profiler.phase('forward'), amp_autocast(cfg, device):
+                output = model(data)
+            with profiler.phase('loss'):
+                loss = loss_module(output.float(), target, epoch, batch_idx, l_loader)
+
+            # gradients are accumulated in scaled form, the scale only changes when the optimizer steps
+            with profiler.phase('backward'):
+                scaler.scale(loss).backward()
         if batch_idx % steps == 0:
-            optimizer.step()
-            optimizer.zero_grad()
+            with profiler.phase('optimizer'):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+        profiler.step()
 
         # save result every 1000 batches
         if batch_idx % 2000 == 0: # From time to time, reset averagemeters to see improvements
             loss_module.reset_meters()
 
     t1 = time.time()
-    logging('trained with %f samples/s' % (len(train_loader.dataset)/(t1-t0)))
+    logging('trained with %f samples/s' % (len(train_loader.sampler)*du.get_world_size()/(t1-t0)))
     print('')
 
 
 
-def train_ucf24_jhmdb21(cfg, epoch, model, train_loader, loss_module, optimizer):
+def train_ucf24_jhmdb21(cfg, epoch, model, train_loader, loss_module, optimizer, profiler=None):
+    device = get_device(cfg)
+    profiler = profiler or NullProfiler()
+    profiler.start()
+    # a DataPrefetcher hands out batches on the device and records their copies as 'h2d' itself
+    prefetched = isinstance(train_loader, DataPrefetcher)
+    scaler = amp_grad_scaler(cfg, device)
     t0 = time.time()
     loss_module.reset_meters()
     l_loader = len(train_loader)
 
     model.train()
-    for batch_idx, (data, target) in enumerate(train_loader):
-        data = data.cuda()
-        output = model(data)
-        loss = loss_module(output, target, epoch, batch_idx, l_loader)
-
-        loss.backward()
-        steps = cfg.TRAIN.TOTAL_BATCH_SIZE // cfg.TRAIN.BATCH_SIZE
+    for batch_idx, (data, target) in enumerate(profiler.iter(train_loader)):
+        with profiler.phase('h2d') if not prefetched else nullcontext():
+            data = clip_to_device(data, cfg, device)
+        # every process contributes TRAIN.BATCH_SIZE clips to the TRAIN.TOTAL_BATCH_SIZE of one step,
+        # gradients are only all-reduced on the steps that call the optimizer
+        steps = max(cfg.TRAIN.TOTAL_BATCH_SIZE // (cfg.TRAIN.BATCH_SIZE * du.get_world_size()), 1)
+        with du.no_sync(model, batch_idx % steps == 0):
+            with profiler.phase('forward'), amp_autocast(cfg, device):
+                output = model(data)
+            with profiler.phase('loss'):
+                loss = loss_module(output.float(), target, epoch, batch_idx, l_loader)
+
+            # gradients are accumulated in scaled form, the scale only changes when the optimizer steps
+            with profiler.phase('backward'):
+                scaler.scale(loss).backward()
         if batch_idx % steps == 0:
-            optimizer.step()
-            optimizer.zero_grad()
+            with profiler.phase('optimizer'):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+        profiler.step()
 
         # save result every 1000 batches
         if batch_idx % 2000 == 0: # From time to time, reset averagemeters to see improvements
             loss_module.reset_meters()
 
     t1 = time.time()
-    logging('trained with %f samples/s' % (len(train_loader.dataset)/(t1-t0)))
+    logging('trained with %f samples/s' % (len(train_loader.sampler)*du.get_world_size()/(t1-t0)))
     print('')
 
 
 
 @torch.no_grad()
 def test_ava(cfg, epoch, model, test_loader):
+    device = get_device(cfg)
      # Test parameters
     num_classes       = cfg.MODEL.NUM_CLASSES
     anchors           = [float(i) for i in cfg.SOLVER.ANCHORS]
@@ -75,32 +114,29 @@ def test_ava(cfg, epoch, model, test_loader):
 
     model.eval()
     for batch_idx, batch in enumerate(test_loader):
-        data = batch['clip'].cuda()
+        data = clip_to_device(batch['clip'], cfg, device)
         target = {'cls': batch['cls'], 'boxes': batch['boxes']}
 
         with torch.no_grad():
-            output = model(data)
+            with amp_autocast(cfg, device):
+                output = model(data)
+            output = output.float()
             metadata = batch['metadata'].cpu().numpy()
 
             preds = []
-            all_boxes = get_region_boxes_ava(output, conf_thresh_valid, num_classes, anchors, num_anchors, 0, 1)
-            for i in range(output.size(0)):
-                boxes = all_boxes[i]
-                boxes = nms(boxes, nms_thresh)
-                
-                for box in boxes:
-                    x1 = float(box[0]-box[2]/2.0)
-                    y1 = float(box[1]-box[3]/2.0)
-                    x2 = float(box[0]+box[2]/2.0)
-                    y2 = float(box[1]+box[3]/2.0)
-                    det_conf = float(box[4])
-                    cls_out = [det_conf * x.cpu().numpy() for x in box[5]]
-                    preds.append([[x1,y1,x2,y2], cls_out, metadata[i][:2].tolist()])
+            boxes, det_confs, cls_scores, box_batch_idx = get_region_boxes_ava_arrays(output, conf_thresh_valid, num_classes, anchors, num_anchors)
+            corners = np.concatenate([boxes[:, :2] - boxes[:, 2:]/2.0, boxes[:, :2] + boxes[:, 2:]/2.0], 1).tolist()
+            keep = nms_tensor(torch.from_numpy(boxes), torch.from_numpy(det_confs), nms_thresh, torch.from_numpy(box_batch_idx))
+            for j in keep.tolist():
+                preds.append([corners[j], cls_scores[j], metadata[box_batch_idx[j]][:2].tolist()])
 
         meter.update_stats(preds)
         logging("[%d/%d]" % (batch_idx, nbatch))
 
-    mAP = meter.evaluate_ava()
+    # detections of all processes are evaluated once on the master
+    meter.all_preds = du.all_gather_list(meter.all_preds)
+    mAP = meter.evaluate_ava() if du.is_master_proc() else None
+    mAP = du.broadcast_object(mAP)
     logging("mode: {} -- mAP: {}".format(meter.mode, mAP))
 
     return mAP
@@ -109,6 +145,7 @@ def test_ava(cfg, epoch, model, test_loader):
 
 @torch.no_grad()
 def test_ucf24_jhmdb21(cfg, epoch, model, test_loader):
+    device = get_device(cfg)
 
     def truths_length(truths):
         for i in range(50):
@@ -136,27 +173,25 @@ def test_ucf24_jhmdb21(cfg, epoch, model, test_loader):
     model.eval()
 
     for batch_idx, (frame_idx, data, target) in enumerate(test_loader):
-        data = data.cuda()
+        data = clip_to_device(data, cfg, device)
+        target = target.cpu() # ground truths are matched box by box on the host
         with torch.no_grad():
-            output = model(data).data
-            all_boxes = get_region_boxes(output, conf_thresh_valid, num_classes, anchors, num_anchors, 0, 1)
+            with amp_autocast(cfg, device):
+                output = model(data)
+            output = output.float()
+            flat_boxes, box_batch_idx = get_region_boxes_flat(output, conf_thresh_valid, num_classes, anchors, num_anchors, 0, 1)
+            keep = nms_tensor(flat_boxes[:, :4], flat_boxes[:, 4], nms_thresh, box_batch_idx)
+            all_boxes = region_boxes_to_list(flat_boxes[keep], box_batch_idx[keep], output.size(0))
             for i in range(output.size(0)):
                 boxes = all_boxes[i]
-                boxes = nms(boxes, nms_thresh)
+                # every process writes the detection files of its own frames into the shared directory
                 if cfg.TRAIN.DATASET == 'ucf24':
                     detection_path = os.path.join('ucf_detections', 'detections_'+str(epoch), frame_idx[i])
                     current_dir = os.path.join('ucf_detections', 'detections_'+str(epoch))
-                    if not os.path.exists('ucf_detections'):
-                        os.mkdir('ucf_detections')
-                    if not os.path.exists(current_dir):
-                        os.mkdir(current_dir)
                 else:
                     detection_path = os.path.join('jhmdb_detections', 'detections_'+str(epoch), frame_idx[i])
                     current_dir = os.path.join('jhmdb_detections', 'detections_'+str(epoch))
-                    if not os.path.exists('jhmdb_detections'):
-                        os.mkdir('jhmdb_detections')
-                    if not os.path.exists(current_dir):
-                        os.mkdir(current_dir)
+                os.makedirs(current_dir, exist_ok=True)
 
                 with open(detection_path, 'w+') as f_detect:
                     for box in boxes:
@@ -204,6 +239,14 @@ def test_ucf24_jhmdb21(cfg, epoch, model, test_loader):
             fscore = 2.0*precision*recall/(precision+recall+eps)
             logging("[%d/%d] precision: %f, recall: %f, fscore: %f" % (batch_idx, nbatch, precision, recall, fscore))
 
+    # merge the counts of all processes
+    total, proposals, correct, correct_classification, total_detected = \
+        du.all_reduce_sum([total, proposals, correct, correct_classification, total_detected])
+    precision = 1.0*correct/(proposals+eps)
+    recall = 1.0*correct/(total+eps)
+    fscore = 2.0*precision*recall/(precision+recall+eps)
+    logging("precision: %f, recall: %f, fscore: %f" % (precision, recall, fscore))
+
     classification_accuracy = 1.0 * correct_classification / (total_detected + eps)
     locolization_recall = 1.0 * total_detected / (total + eps)
 
@@ -211,3 +254,106 @@ def test_ucf24_jhmdb21(cfg, epoch, model, test_loader):
     print("Locolization recall: %.3f" % locolization_recall)
 
     return fscore
+
+
+
+def _benchmark_train_step(cfg, steps, batch_size, queue, per_tensor_groups=False):
+    # one detector configuration per process, so that the peak memory is not shared between runs
+    import resource
+    from core.model import YOWO, set_channels_last, freeze_parameters, get_fine_tuning_parameters, get_fine_tuning_module_names
+    from core.region_loss import RegionLoss
+
+    device = get_device(cfg)
+    model = YOWO(cfg).to(device)
+    if cfg.TRAIN.CHANNELS_LAST:
+        model = set_channels_last(model)
+    loss_module = RegionLoss(cfg).to(device)
+    if per_tensor_groups: # frozen layers only have lr 0.0, they still get gradients and optimizer state
+        ft_module_names = get_fine_tuning_module_names(cfg)
+        parameters = [{'params': v} if any(m in k for m in ft_module_names) else {'params': v, 'lr': 0.0}
+                      for k, v in model.named_parameters()]
+    else:
+        parameters = get_fine_tuning_parameters(freeze_parameters(model, cfg), cfg)
+    optimizer = torch.optim.Adam(parameters, lr=cfg.TRAIN.LEARNING_RATE)
+    scaler = amp_grad_scaler(cfg, device)
+
+    size = cfg.DATA.TRAIN_CROP_SIZE
+    clip = torch.rand(batch_size, 3, cfg.DATA.NUM_FRAMES, size, size)
+    target = torch.zeros(batch_size, 250)
+    target[:, :5] = torch.tensor([1, 0.5, 0.5, 0.3, 0.6])
+
+    model.train()
+    times = []
+    for step in range(steps + 1):
+        t0 = time.perf_counter()
+        data = clip_to_device(clip, cfg, device)
+        with amp_autocast(cfg, device):
+            output = model(data)
+        loss = loss_module(output.float(), target, 0, step, steps)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        if step > 0: # the first step is a warm up
+            times.append(time.perf_counter() - t0)
+
+    if device.type == 'cuda':
+        peak_mb = torch.cuda.max_memory_allocated(device) / 2**20
+    else:
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    queue.put((sum(times) / len(times), peak_mb))
+
+
+def benchmark_precision(cfg, steps=3, batch_size=2):
+    # compare the step time and peak memory (process RSS on the CPU) of fp32 against the
+    # TRAIN.AMP and TRAIN.CHANNELS_LAST modes on cfg.SYSTEM.DEVICE
+    import multiprocessing as mp
+    ctx = mp.get_context('spawn')
+    device = get_device(cfg)
+    results = []
+    for amp, channels_last in [(False, False), (True, False), (False, True), (True, True)]:
+        run_cfg = cfg.clone()
+        run_cfg.TRAIN.AMP = amp
+        run_cfg.TRAIN.CHANNELS_LAST = channels_last
+        queue = ctx.Queue()
+        p = ctx.Process(target=_benchmark_train_step, args=(run_cfg, steps, batch_size, queue))
+        p.start()
+        step_time, peak_mb = queue.get()
+        p.join()
+        name = (str(amp_dtype(run_cfg, device)).replace('torch.', '') if amp else 'float32') + (' + channels_last' if channels_last else '')
+        results.append((name, step_time, peak_mb))
+        logging('%-28s step %7.3f s   peak memory %8.1f MB' % (name, step_time, peak_mb))
+    return results
+
+
+def benchmark_fine_tuning(cfg, steps=3, batch_size=2):
+    # step time and peak memory of one param group per tensor with lr 0.0 for the frozen layers
+    # against frozen parameters and one group per fine tuned module, for every backbone freezing choice
+    import multiprocessing as mp
+    ctx = mp.get_context('spawn')
+    results = []
+    for freeze_2d, freeze_3d in [(False, False), (True, False), (False, True), (True, True)]:
+        run_cfg = cfg.clone()
+        run_cfg.WEIGHTS.FREEZE_BACKBONE_2D = freeze_2d
+        run_cfg.WEIGHTS.FREEZE_BACKBONE_3D = freeze_3d
+        for per_tensor_groups in [True, False]:
+            queue = ctx.Queue()
+            p = ctx.Process(target=_benchmark_train_step, args=(run_cfg, steps, batch_size, queue, per_tensor_groups))
+            p.start()
+            step_time, peak_mb = queue.get()
+            p.join()
+            name = '2d %s, 3d %s, %s' % ('frozen' if freeze_2d else 'tuned', 'frozen' if freeze_3d else 'tuned',
+                                         'lr 0.0 groups' if per_tensor_groups else 'requires_grad')
+            results.append((name, step_time, peak_mb))
+            logging('%-40s step %7.3f s   peak memory %8.1f MB' % (name, step_time, peak_mb))
+    return results
+
+
+if __name__ == '__main__':
+    # python -m core.optimization --cfg cfg/ucf24.yaml SYSTEM.DEVICE cpu
+    from cfg import parser
+    cfg = parser.load_config(parser.parse_args())
+    benchmark_precision(cfg)
+    benchmark_fine_tuning(cfg)
@@ -2,12 +2,14 @@ import os
 import torch
 import time
 from core.utils import *
+import core.distributed as du
 from datasets.meters import AVAMeter
 from torch.cuda.amp import autocast as autocast
 from tqdm import tqdm
 from codec.models import update_training
 
-def train_ava_codec(cfg, epoch, model, model_codec, train_dataset, loss_module, optimizer, score):
+def train_ava_codec(cfg, epoch, model, model_codec, train_dataset, loss_module, optimizer, score, checkpointer, start_batch=0, scaler_state=None):
+    device = get_device(cfg)
     t0 = time.time()
     loss_module.reset_meters()
     aux_loss_module = AverageMeter()
@@ -17,15 +19,28 @@ def train_ava_codec(cfg, epoch, model, model_codec, train_dataset, loss_module,
     psnr_module = AverageMeter()
     msssim_module = AverageMeter()
     all_loss_module = AverageMeter()
-    scaler = torch.cuda.amp.GradScaler(enabled=True)
+    scaler = torch.cuda.amp.GradScaler(enabled=device.type == 'cuda')
+    if scaler_state is not None: # loss scale of a resumed mid-epoch checkpoint
+        scaler.load_state_dict(scaler_state)
+    # optimizer steps averaged over the processes, which step a different number of times
+    sync = du.GradientSync(model_codec)
+    def step():
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad()
     batch_size = cfg.TRAIN.BATCH_SIZE
     l_loader = len(train_dataset)//batch_size
 
     model.eval()
     model_codec.train()
     doAD = update_training(model_codec,epoch)
-    train_iter = tqdm(range(0,l_loader*batch_size,batch_size))
-    for batch_idx,_ in enumerate(train_iter):
+    # start_batch skips the batches of a resumed mid-epoch checkpoint, the data is read in order
+    train_iter = tqdm(range(start_batch, l_loader), initial=start_batch, total=l_loader, disable=not du.is_master_proc())
+    save_pending = False
+    # the processes are at different batches of their shards when they step together,
+    # a checkpoint only resumes exactly in single-process runs
+    mid_epoch_saves = du.get_world_size() == 1
+    for batch_idx in train_iter:
         # start compression
         data = []; cls = []; boxes = []; img_loss_list = []; aux_loss_list = []
         bpp_est_list = []; bpp_act_list = []; psnr_list = []; msssim_list = []
@@ -48,10 +63,10 @@ def train_ava_codec(cfg, epoch, model, model_codec, train_dataset, loss_module,
         cls = torch.stack(cls, dim=0)
         boxes = torch.stack(boxes, dim=0)
         # end of compression
-        data = data.cuda() 
+        data = data.to(device) 
         target = {'cls': cls, 'boxes': boxes}
         
-        with autocast():
+        with autocast(enabled=device.type == 'cuda'):
             reg_loss = loss_module(model(data), target, epoch, batch_idx, l_loader) if doAD else None
             be_loss = torch.stack(bpp_est_list,dim=0).mean(dim=0)
             aux_loss = torch.stack(aux_loss_list,dim=0).mean(dim=0)
@@ -71,10 +86,10 @@ def train_ava_codec(cfg, epoch, model, model_codec, train_dataset, loss_module,
         if loss.requires_grad:
             scaler.scale(loss).backward()
         steps = cfg.TRAIN.TOTAL_BATCH_SIZE // cfg.TRAIN.BATCH_SIZE
-        if batch_idx % steps == 0:
-            scaler.step(optimizer)
-            scaler.update()
-            optimizer.zero_grad()
+        stepped = batch_idx % steps == 0
+        if stepped:
+            sync.all_reduce()
+            step()
 
         # save result every 1000 batches
         if batch_idx % 2000 == 0: # From time to time, reset averagemeters to see improvements
@@ -87,14 +102,21 @@ def train_ava_codec(cfg, epoch, model, model_codec, train_dataset, loss_module,
             psnr_module.reset()
             msssim_module.reset()
             
-        # save model to prevent floating point exception
-        if batch_idx % 10000 == 0 and batch_idx > 0:
+        # save model to prevent floating point exception, at the first batch after which nothing
+        # is pending: the optimizer has just stepped and the next batch starts a new codec clip,
+        # so resuming at batch_idx + 1 continues exactly
+        save_pending = save_pending or (batch_idx % 10000 == 0 and batch_idx > 0 and mid_epoch_saves)
+        if save_pending and stepped and train_dataset.starts_new_clip((batch_idx + 1) * batch_size):
+            save_pending = False
             state = {
                 'epoch': epoch,
+                'batch_idx': batch_idx,
                 'state_dict': model_codec.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scaler': scaler.state_dict(),
                 'score': score
             }
-            save_codec_checkpoint(state, False, cfg.BACKUP_DIR, cfg.TRAIN.DATASET, cfg.DATA.NUM_FRAMES, cfg.TRAIN.CODEC_NAME)
+            checkpointer.save(state)
             
         # show result
         train_iter.set_description(
@@ -108,12 +130,14 @@ def train_ava_codec(cfg, epoch, model, model_codec, train_dataset, loss_module,
             f"P: {psnr_module.val:.2f} ({psnr_module.avg:.2f}). "
             f"M: {msssim_module.val:.2f} ({msssim_module.avg:.2f}). ")
 
+    sync.join(step)
     t1 = time.time()
     logging('trained with %f samples/s' % (len(train_dataset)/(t1-t0)))
 
 
 
-def train_ucf24_jhmdb21_codec(cfg, epoch, model, model_codec, train_dataset, loss_module, optimizer, score):
+def train_ucf24_jhmdb21_codec(cfg, epoch, model, model_codec, train_dataset, loss_module, optimizer, score, checkpointer, start_batch=0, scaler_state=None):
+    device = get_device(cfg)
     t0 = time.time()
     loss_module.reset_meters()
     aux_loss_module = AverageMeter()
@@ -122,7 +146,15 @@ def train_ucf24_jhmdb21_codec(cfg, epoch, model, model_codec, train_dataset, los
     psnr_module = AverageMeter()
     msssim_module = AverageMeter()
     all_loss_module = AverageMeter()
-    scaler = torch.cuda.amp.GradScaler(enabled=True)
+    scaler = torch.cuda.amp.GradScaler(enabled=device.type == 'cuda')
+    if scaler_state is not None: # loss scale of a resumed mid-epoch checkpoint
+        scaler.load_state_dict(scaler_state)
+    # optimizer steps averaged over the processes, which step a different number of times
+    sync = du.GradientSync(model_codec)
+    def step():
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad()
     batch_size = cfg.TRAIN.BATCH_SIZE
     l_loader = len(train_dataset)//batch_size
 
@@ -130,10 +162,15 @@ def train_ucf24_jhmdb21_codec(cfg, epoch, model, model_codec, train_dataset, los
     model_codec.train()
     # get instructions on training
     doAD = update_training(model_codec,epoch)
-    train_iter = tqdm(range(0,l_loader*batch_size,batch_size))
+    # start_batch skips the batches of a resumed mid-epoch checkpoint, the data is read in order
+    train_iter = tqdm(range(start_batch, l_loader), initial=start_batch, total=l_loader, disable=not du.is_master_proc())
+    save_pending = False
+    # the processes are at different batches of their shards when they step together,
+    # a checkpoint only resumes exactly in single-process runs
+    mid_epoch_saves = du.get_world_size() == 1
     frame_idx = []; data = []; target = []; img_loss_list = []; aux_loss_list = []
     bpp_est_list = []; psnr_list = []; msssim_list = []
-    for batch_idx,_ in enumerate(train_iter):
+    for batch_idx in train_iter:
         # align batches
         for j in range(batch_size):
             data_idx = batch_idx*batch_size+j
@@ -152,10 +189,10 @@ def train_ucf24_jhmdb21_codec(cfg, epoch, model, model_codec, train_dataset, los
             if train_dataset.last_frame or additional['end_of_batch']:
                 # we split if the batch of compression ends or if the video ends or if its a i frame
                 # if is the end of a video
-                data = torch.stack(data, dim=0).cuda()
+                data = torch.stack(data, dim=0).to(device)
                 target = torch.stack(target, dim=0)
                 l = len(frame_idx)
-                with autocast():
+                with autocast(enabled=device.type == 'cuda'):
                     reg_loss = loss_module(model(data), target, epoch, batch_idx, l_loader) if doAD else None
                     be_loss = torch.stack(bpp_est_list,dim=0).mean(dim=0)
                     aux_loss = torch.stack(aux_loss_list,dim=0).mean(dim=0)
@@ -174,9 +211,8 @@ def train_ucf24_jhmdb21_codec(cfg, epoch, model, model_codec, train_dataset, los
                     scaler.scale(loss).backward()
                 # update model after compress each video
                 if train_dataset.last_frame:
-                    scaler.step(optimizer)
-                    scaler.update()
-                    optimizer.zero_grad()
+                    sync.all_reduce()
+                    step()
                 # init batch
                 frame_idx = []; data = []; target = []; img_loss_list = []; aux_loss_list = []
                 bpp_est_list = []; psnr_list = []; msssim_list = []
@@ -202,14 +238,24 @@ def train_ucf24_jhmdb21_codec(cfg, epoch, model, model_codec, train_dataset, los
             all_loss_module.reset()
             psnr_module.reset()
             msssim_module.reset()
-            if batch_idx > 0:
-                state = {
-                    'epoch': epoch,
-                    'state_dict': model_codec.state_dict(),
-                    'score': score
-                }
-                save_codec_checkpoint(state, False, cfg.BACKUP_DIR, cfg.TRAIN.DATASET, cfg.DATA.NUM_FRAMES, cfg.TRAIN.CODEC_NAME)
+            save_pending = batch_idx > 0 and mid_epoch_saves
 
+        # the checkpoint waits for a batch that ends with a video: the optimizer has just stepped,
+        # no clips are pending and the next batch starts a new video, so resuming at batch_idx + 1
+        # continues exactly
+        if save_pending and train_dataset.last_frame and not frame_idx:
+            save_pending = False
+            state = {
+                'epoch': epoch,
+                'batch_idx': batch_idx,
+                'state_dict': model_codec.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scaler': scaler.state_dict(),
+                'score': score
+            }
+            checkpointer.save(state)
+
+    sync.join(step)
     t1 = time.time()
     logging('trained with %f samples/s' % (len(train_dataset)/(t1-t0)))
 
@@ -217,6 +263,7 @@ def train_ucf24_jhmdb21_codec(cfg, epoch, model, model_codec, train_dataset, los
 
 @torch.no_grad()
 def test_ava_codec(cfg, epoch, model, model_codec, test_dataset, loss_module):
+    device = get_device(cfg)
      # Test parameters
     num_classes       = cfg.MODEL.NUM_CLASSES
     anchors           = [float(i) for i in cfg.SOLVER.ANCHORS]
@@ -240,7 +287,7 @@ def test_ava_codec(cfg, epoch, model, model_codec, test_dataset, loss_module):
 
     model.eval()
     model_codec.eval()
-    test_iter = tqdm(range(0,nbatch*batch_size,batch_size))
+    test_iter = tqdm(range(0,nbatch*batch_size,batch_size), disable=not du.is_master_proc())
     for batch_idx,_ in enumerate(test_iter):
         # start compression
         data = []; cls = []; boxes = []; img_loss_list = []; aux_loss_list = []
@@ -264,7 +311,7 @@ def test_ava_codec(cfg, epoch, model, model_codec, test_dataset, loss_module):
         cls = torch.stack(cls, dim=0)
         boxes = torch.stack(boxes, dim=0)
         # end of compression
-        data = data.cuda() 
+        data = data.to(device) 
         target = {'cls': cls, 'boxes': boxes}
 
         with torch.no_grad():
@@ -272,19 +319,11 @@ def test_ava_codec(cfg, epoch, model, model_codec, test_dataset, loss_module):
             metadata = batch['metadata'].cpu().numpy()
 
             preds = []
-            all_boxes = get_region_boxes_ava(output, conf_thresh_valid, num_classes, anchors, num_anchors, 0, 1)
-            for i in range(output.size(0)):
-                boxes = all_boxes[i]
-                boxes = nms(boxes, nms_thresh)
-                
-                for box in boxes:
-                    x1 = float(box[0]-box[2]/2.0)
-                    y1 = float(box[1]-box[3]/2.0)
-                    x2 = float(box[0]+box[2]/2.0)
-                    y2 = float(box[1]+box[3]/2.0)
-                    det_conf = float(box[4])
-                    cls_out = [det_conf * x.cpu().numpy() for x in box[5]]
-                    preds.append([[x1,y1,x2,y2], cls_out, metadata[i][:2].tolist()])
+            boxes, det_confs, cls_scores, box_batch_idx = get_region_boxes_ava_arrays(output, conf_thresh_valid, num_classes, anchors, num_anchors)
+            corners = np.concatenate([boxes[:, :2] - boxes[:, 2:]/2.0, boxes[:, :2] + boxes[:, 2:]/2.0], 1).tolist()
+            keep = nms_tensor(torch.from_numpy(boxes), torch.from_numpy(det_confs), nms_thresh, torch.from_numpy(box_batch_idx))
+            for j in keep.tolist():
+                preds.append([corners[j], cls_scores[j], metadata[box_batch_idx[j]][:2].tolist()])
                     
             reg_loss = loss_module(output, target, epoch, batch_idx, nbatch)
             aux_loss = torch.stack(aux_loss_list,dim=0).mean(dim=0)
@@ -315,7 +354,10 @@ def test_ava_codec(cfg, epoch, model, model_codec, test_dataset, loss_module):
 
         meter.update_stats(preds)
 
-    mAP = meter.evaluate_ava()
+    # detections of all processes are evaluated once on the master
+    meter.all_preds = du.all_gather_list(meter.all_preds)
+    mAP = meter.evaluate_ava() if du.is_master_proc() else None
+    mAP = du.broadcast_object(mAP)
     logging("mode: {} -- mAP: {}".format(meter.mode, mAP))
 
     return [fscore,ba_loss_module.avg,psnr_module.avg,msssim_module.avg,loss_module.l_total.avg,mAP]
@@ -324,6 +366,7 @@ def test_ava_codec(cfg, epoch, model, model_codec, test_dataset, loss_module):
 
 @torch.no_grad()
 def test_ucf24_jhmdb21_codec(cfg, epoch, model, model_codec, test_dataset, loss_module):
+    device = get_device(cfg)
 
     def truths_length(truths):
         for i in range(50):
@@ -362,7 +405,7 @@ def test_ucf24_jhmdb21_codec(cfg, epoch, model, model_codec, test_dataset, loss_
     msssim_module = AverageMeter()
     all_loss_module = AverageMeter()
 
-    test_iter = tqdm(range(0,nbatch*batch_size,batch_size))
+    test_iter = tqdm(range(0,nbatch*batch_size,batch_size), disable=not du.is_master_proc())
     for batch_idx,_ in enumerate(test_iter):
         # process/compress each frame in a batch
         frame_idx = []; data = []; target = []; img_loss_list = []; aux_loss_list = []
@@ -385,27 +428,21 @@ def test_ucf24_jhmdb21_codec(cfg, epoch, model, model_codec, test_dataset, loss_
         data = torch.stack(data, dim=0)
         target = torch.stack(target, dim=0)
         # end of compression
-        data = data.cuda()
+        data = data.to(device)
         with torch.no_grad():
             output = model(data).data
-            all_boxes = get_region_boxes(output, conf_thresh_valid, num_classes, anchors, num_anchors, 0, 1)
+            flat_boxes, box_batch_idx = get_region_boxes_flat(output, conf_thresh_valid, num_classes, anchors, num_anchors, 0, 1)
+            keep = nms_tensor(flat_boxes[:, :4], flat_boxes[:, 4], nms_thresh, box_batch_idx)
+            all_boxes = region_boxes_to_list(flat_boxes[keep], box_batch_idx[keep], output.size(0))
             for i in range(output.size(0)):
                 boxes = all_boxes[i]
-                boxes = nms(boxes, nms_thresh)
                 if cfg.TRAIN.DATASET == 'ucf24':
                     detection_path = os.path.join('ucf_detections', 'detections_'+str(epoch), frame_idx[i])
                     current_dir = os.path.join('ucf_detections', 'detections_'+str(epoch))
-                    if not os.path.exists('ucf_detections'):
-                        os.mkdir('ucf_detections')
-                    if not os.path.exists(current_dir):
-                        os.mkdir(current_dir)
                 else:
                     detection_path = os.path.join('jhmdb_detections', 'detections_'+str(epoch), frame_idx[i])
                     current_dir = os.path.join('jhmdb_detections', 'detections_'+str(epoch))
-                    if not os.path.exists('jhmdb_detections'):
-                        os.mkdir('jhmdb_detections')
-                    if not os.path.exists(current_dir):
-                        os.mkdir(current_dir)
+                os.makedirs(current_dir, exist_ok=True)
 
                 with open(detection_path, 'w+') as f_detect:
                     for box in boxes:
@@ -477,9 +514,17 @@ def test_ucf24_jhmdb21_codec(cfg, epoch, model, model_codec, test_dataset, loss_
             f"M: {msssim_module.val:.4f} ({msssim_module.avg:.4f}). "
             f"F: {fscore:.4f} ({fscore:.4f}). ")
 
+    # merge the counts and meters of all processes
+    total, proposals, correct, correct_classification, total_detected = \
+        du.all_reduce_sum([total, proposals, correct, correct_classification, total_detected])
+    precision = 1.0*correct/(proposals+eps)
+    recall = 1.0*correct/(total+eps)
+    fscore = 2.0*precision*recall/(precision+recall+eps)
+    ba_loss, psnr, msssim, reg_loss = [du.all_reduce_avg(m) for m in [ba_loss_module, psnr_module, msssim_module, loss_module.l_total]]
+
     classification_accuracy = 1.0 * correct_classification / (total_detected + eps)
     locolization_recall = 1.0 * total_detected / (total + eps)
 
-    print("Result: %.4f, %.4f" % (fscore,ba_loss_module.avg))
+    print("Result: %.4f, %.4f" % (fscore,ba_loss))
 
-    return [fscore,ba_loss_module.avg,psnr_module.avg,msssim_module.avg,loss_module.l_total.avg]
\ No newline at end of file
+    return [fscore,ba_loss,psnr,msssim,reg_loss]
\ No newline at end of file
@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import collections
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+import core.distributed as du
+from core.utils import logging
+
+
+# modules of YOWO timed with forward hooks
+PROFILED_MODULES = ['backbone_2d', 'backbone_3d', 'cfam', 'conv_final']
+
+_NULL_CONTEXT = nullcontext()
+_ACTIVE = None # profiler that record_phase reports to
+
+
+def record_phase(name, tid='host'):
+    # time a block under the active profiler, a shared no-op context when profiling is off
+    if _ACTIVE is None:
+        return _NULL_CONTEXT
+    return _ACTIVE.phase(name, tid)
+
+
+class StepProfiler(object):
+    """
+    Per-phase wall time, and on GPUs device time from CUDA events, of every training step.
+    Logs a rolling summary every cfg.PROFILE.LOG_PERIOD steps and writes the first
+    cfg.PROFILE.TRACE_STEPS steps as a Chrome trace (chrome://tracing, Perfetto).
+
+    The training loops record 'h2d' around the copy of the clips to the device. With a
+    DataPrefetcher the batches arrive on the device and the prefetcher records 'h2d' for
+    its copies instead: on GPUs inside the 'data' wait of the step that pulls the next
+    batch, with the device time of the copy on the side stream, and on the CPU on its
+    own thread (trace row 'prefetch'), overlapping the step.
+    """
+
+    def __init__(self, cfg, device):
+        self.device = device
+        self.use_cuda = device.type == 'cuda'
+        self.log_period = cfg.PROFILE.LOG_PERIOD
+        self.trace_steps = cfg.PROFILE.TRACE_STEPS
+        trace_dir = cfg.PROFILE.TRACE_DIR or cfg.BACKUP_DIR
+        self.trace_file = os.path.join(trace_dir, 'profile_trace_rank%d.json' % du.get_rank())
+        self.window = collections.deque(maxlen=cfg.PROFILE.WINDOW)
+        self.trace = []
+        self.handles = []
+        self.num_steps = 0
+        self.t_origin = time.perf_counter()
+        self._new_step()
+
+    def _new_step(self):
+        self.t_step = time.perf_counter()
+        self.wall = collections.defaultdict(float)
+        self.events = [] # (name, start event, end event, host start) resolved at the end of the step
+
+    def activate(self):
+        global _ACTIVE
+        _ACTIVE = self
+        return self
+
+    def deactivate(self):
+        global _ACTIVE
+        if _ACTIVE is self:
+            _ACTIVE = None
+
+    def _start(self):
+        start = None
+        if self.use_cuda:
+            start = torch.cuda.Event(enable_timing=True)
+            start.record()
+        return time.perf_counter(), start
+
+    def _stop(self, name, t0, start, tid):
+        t1 = time.perf_counter()
+        self.wall[name] += t1 - t0
+        if start is not None:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            self.events.append((name, start, end, t0))
+        if self.num_steps < self.trace_steps:
+            self.trace.append({'name': name, 'ph': 'X', 'pid': du.get_rank(), 'tid': tid,
+                               'ts': (t0 - self.t_origin) * 1e6, 'dur': (t1 - t0) * 1e6})
+
+    @contextmanager
+    def phase(self, name, tid='host'):
+        t0, start = self._start()
+        try:
+            yield
+        finally:
+            self._stop(name, t0, start, tid)
+
+    def iter(self, loader):
+        # time the wait for every batch as the 'data' phase
+        it = iter(loader)
+        while True:
+            t0, start = self._start()
+            try:
+                batch = next(it)
+            except StopIteration:
+                return
+            self._stop('data', t0, start, 'host')
+            yield batch
+
+    def attach(self, model):
+        # forward hooks on the YOWO sub-modules, the model may be wrapped by (Distributed)DataParallel
+        model = getattr(model, 'module', model)
+        for name in PROFILED_MODULES:
+            module = getattr(model, name)
+            self.handles.append(module.register_forward_pre_hook(self._pre_hook(name)))
+            self.handles.append(module.register_forward_hook(self._post_hook(name)))
+        return self
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            if module.training: # evaluation forwards are not part of a training step
+                module._profile_start = self._start()
+        return hook
+
+    def _post_hook(self, name):
+        def hook(module, inputs, output):
+            if module.training:
+                t0, start = module._profile_start
+                self._stop(name, t0, start, 'modules')
+        return hook
+
+    def start(self):
+        # a training loop begins, the time since the last step (evaluation, checkpoints) and the
+        # phases recorded in it are not part of its first step
+        self._new_step()
+
+    def step(self):
+        # close the current step, device times need the queued kernels to finish
+        wall_step = time.perf_counter() - self.t_step
+        device = collections.defaultdict(float)
+        if self.use_cuda:
+            torch.cuda.synchronize(self.device)
+            for name, start, end, t0 in self.events:
+                ms = start.elapsed_time(end)
+                device[name] += ms / 1000.0
+                if self.num_steps < self.trace_steps:
+                    self.trace.append({'name': name, 'ph': 'X', 'pid': du.get_rank(), 'tid': 'cuda',
+                                       'ts': (t0 - self.t_origin) * 1e6, 'dur': ms * 1000.0})
+        self.window.append((wall_step, dict(self.wall), dict(device)))
+        self.num_steps += 1
+        if self.num_steps % self.log_period == 0:
+            self.summary()
+        if self.num_steps == self.trace_steps:
+            self.write_trace()
+        self._new_step()
+
+    def summary(self):
+        n = len(self.window)
+        if n == 0:
+            return
+        step_time = sum(w[0] for w in self.window) / n
+        names = []
+        for _, wall, _ in self.window:
+            names += [k for k in wall if k not in names]
+        lines = ['profile of the last %d steps, %.1f ms/step' % (n, step_time * 1000)]
+        for name in names:
+            wall = sum(w[1].get(name, 0.0) for w in self.window) / n
+            line = '  %-14s wall %9.2f ms %5.1f%%' % (name, wall * 1000, 100.0 * wall / max(step_time, 1e-12))
+            if self.use_cuda:
+                line += '   device %9.2f ms' % (sum(w[2].get(name, 0.0) for w in self.window) / n * 1000)
+            lines.append(line)
+        logging('\n'.join(lines))
+
+    def write_trace(self):
+        os.makedirs(os.path.dirname(self.trace_file) or '.', exist_ok=True)
+        with open(self.trace_file, 'w') as f:
+            json.dump({'traceEvents': self.trace, 'displayTimeUnit': 'ms'}, f)
+        logging('profile trace of %d steps is saved to %s' % (min(self.num_steps, self.trace_steps), self.trace_file))
+
+    def close(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        if self.num_steps < self.trace_steps:
+            self.write_trace()
+        self.deactivate()
+
+
+class NullProfiler(object):
+    # stands in when cfg.PROFILE.ENABLE is off, the training loops call it unconditionally
+
+    def phase(self, name, tid='host'):
+        return _NULL_CONTEXT
+
+    def iter(self, loader):
+        return loader
+
+    def start(self):
+        pass
+
+    def step(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def build_profiler(cfg, model, device):
+    if not cfg.PROFILE.ENABLE:
+        return NullProfiler()
+    return StepProfiler(cfg, device).attach(model).activate()
+
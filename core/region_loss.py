@@ -10,6 +10,7 @@ from core.utils import *
 from builtins import range as xrange
 import numpy as np
 from core.FocalLoss import *
+from core.profiler import record_phase
 
 # this function works for building the groud truth 
 def build_targets(pred_boxes, target, anchors, num_anchors, num_classes, nH, nW, noobject_scale, object_scale, sil_thresh):
@@ -119,6 +120,115 @@ def build_targets(pred_boxes, target, anchors, num_anchors, num_classes, nH, nW,
     # true values are returned
     return nGT, nCorrect, coord_mask, conf_mask, cls_mask, tx, ty, tw, th, tconf, tcls
 
+def assign_targets(pred_boxes, gt_boxes, valid, anchors, num_anchors, nH, nW, noobject_scale, object_scale, sil_thresh):
+    """
+    Batched core shared by build_targets_batched and build_targets_Ava_batched,
+    runs on the device of pred_boxes without host syncs.
+
+    Args:
+        pred_boxes: [nB*nA*nH*nW, 4] predicted (cx, cy, w, h) boxes in grid units.
+        gt_boxes: [nB, nT, 4] padded ground truth (cx, cy, w, h) boxes as image ratios.
+        valid: [nB, nT] bool mask of the real ground truth slots.
+    Returns:
+        nGT, nCorrect (0-d tensors), coord_mask, conf_mask, cls_mask, tx, ty, tw, th, tconf
+        as [nB, nA, nH, nW] tensors and dest, the [nB, nT] flat cell index every ground truth
+        writes its targets to. Ground truths that are padding or are overwritten by a later
+        ground truth of the same cell point at the extra slot nB*nA*nH*nW.
+    """
+    device = pred_boxes.device
+    dtype = pred_boxes.dtype
+    nB, nT = valid.shape
+    nA = num_anchors
+    anchor_step = len(anchors)//num_anchors
+    nPixels  = nH*nW
+    nAnchors = nA*nPixels
+    scale = torch.tensor([nW, nH, nW, nH], dtype=dtype, device=device)
+    gt = (gt_boxes.to(device=device, dtype=dtype) * scale).permute(2, 0, 1)    # [4, nB, nT]
+
+    # predictions overlapping any ground truth of their image by more than sil_thresh are not penalized
+    cur_pred_boxes = pred_boxes.view(nB, nAnchors, 4).permute(2, 0, 1)
+    cur_ious = bbox_ious(cur_pred_boxes.unsqueeze(3), gt.unsqueeze(2), x1y1x2y2=False)    # [nB, nAnchors, nT]
+    cur_ious = torch.where(valid.unsqueeze(1), cur_ious, torch.zeros_like(cur_ious)).max(2)[0]
+    conf_mask = torch.full((nB, nAnchors), noobject_scale, dtype=dtype, device=device)
+    conf_mask = conf_mask.masked_fill(cur_ious > sil_thresh, 0)
+
+    # best anchor of every ground truth, only the width and height are compared
+    anchor_wh = torch.tensor(anchors, dtype=dtype, device=device).view(nA, anchor_step)[:, :2]
+    zeros = torch.zeros(nB, nT, 1, dtype=dtype, device=device)
+    gt_shape = torch.stack([zeros, zeros, gt[2].unsqueeze(2), gt[3].unsqueeze(2)])
+    anchor_shape = torch.cat([torch.zeros(2, nA, dtype=dtype, device=device), anchor_wh.t()]).view(4, 1, 1, nA)
+    best_n = bbox_ious(anchor_shape, gt_shape, x1y1x2y2=False).argmax(2)    # [nB, nT]
+
+    gi = torch.where(valid, gt[0].long(), torch.zeros_like(best_n))
+    gj = torch.where(valid, gt[1].long(), torch.zeros_like(best_n))
+    cell = best_n*nPixels + gj*nW + gi
+    pred_box = cur_pred_boxes.gather(2, cell.unsqueeze(0).expand(4, nB, nT))
+    iou = bbox_ious(gt, pred_box, x1y1x2y2=False)
+
+    # the loop version writes the ground truths in order, so a later one wins a shared cell
+    slots = torch.arange(nT, device=device)
+    overwritten = (cell.unsqueeze(2) == cell.unsqueeze(1)) & valid.unsqueeze(1) & (slots.view(1, 1, nT) > slots.view(1, nT, 1))
+    owner = valid & ~overwritten.any(2)
+    dest = torch.where(owner, cell + torch.arange(nB, device=device).unsqueeze(1)*nAnchors, torch.full_like(cell, nB*nAnchors))
+    dest_flat = dest.view(-1)
+
+    def scatter(values, base):
+        # write one value per ground truth into a copy of base, the extra slot absorbs the losers
+        out = torch.cat([base.view(-1), base.new_zeros(1)])
+        out.index_put_((dest_flat,), values.reshape(-1))
+        return out[:-1].view(nB, nA, nH, nW)
+
+    empty = iou.new_zeros(nB, nA, nH, nW)
+    ones = torch.ones_like(iou)
+    coord_mask = scatter(ones, empty)
+    cls_mask   = scatter(ones, empty)
+    conf_mask  = scatter(ones * object_scale, conf_mask)
+    tx         = scatter(gt[0] - gi.to(dtype), empty)
+    ty         = scatter(gt[1] - gj.to(dtype), empty)
+    tw         = scatter(torch.log(gt[2]/anchor_wh[best_n, 0]), empty)
+    th         = scatter(torch.log(gt[3]/anchor_wh[best_n, 1]), empty)
+    tconf      = scatter(iou, empty)
+
+    nGT = valid.sum()
+    nCorrect = ((iou > 0.5) & valid).sum()
+    return nGT, nCorrect, coord_mask, conf_mask, cls_mask, tx, ty, tw, th, tconf, dest
+
+
+def build_targets_batched(pred_boxes, target, anchors, num_anchors, num_classes, nH, nW, noobject_scale, object_scale, sil_thresh):
+    # same outputs as build_targets, computed on the device of pred_boxes
+    # target: [nB, 50*5] padded (class, x, y, w, h) rows, a zero x ends the ground truth list
+    nB = target.size(0)
+    target = target.to(pred_boxes.device).view(nB, -1, 5)
+    valid = torch.cumprod((target[:, :, 1] != 0).long(), 1).bool()
+    nGT, nCorrect, coord_mask, conf_mask, cls_mask, tx, ty, tw, th, tconf, dest = assign_targets(pred_boxes, target[:, :, 1:5], valid, \
+                                                           anchors, num_anchors, nH, nW, noobject_scale, object_scale, sil_thresh)
+    tcls = coord_mask.new_zeros(coord_mask.numel()+1)
+    tcls.index_put_((dest.view(-1),), target[:, :, 0].reshape(-1).to(tcls.dtype))
+    tcls = tcls[:-1].view_as(coord_mask)
+    return nGT, nCorrect, coord_mask, conf_mask, cls_mask, tx, ty, tw, th, tconf, tcls
+
+
+def split_region_output(output, anchors, num_anchors, num_classes):
+    # one view of the head output into x, y, w, h, conf as [nB, nA, nH, nW], the class logits
+    # as [nB*nA*nH*nW, nC] and the detached predicted boxes as [nB*nA*nH*nW, 4] in float32
+    nB, nH, nW = output.size(0), output.size(2), output.size(3)
+    output = output.view(nB, num_anchors, 5+num_classes, nH, nW)
+    x    = torch.sigmoid(output[:, :, 0])
+    y    = torch.sigmoid(output[:, :, 1])
+    w    = output[:, :, 2]
+    h    = output[:, :, 3]
+    conf = torch.sigmoid(output[:, :, 4])
+    cls  = output[:, :, 5:].permute(0, 1, 3, 4, 2).reshape(-1, num_classes)
+
+    with torch.no_grad():
+        grid_x, grid_y, anchor_w, anchor_h = region_grid(anchors, num_anchors, nH, nW, output.device)
+        pred_boxes = torch.stack([x.float() + grid_x,
+                                  y.float() + grid_y,
+                                  torch.exp(w.float()) * anchor_w,
+                                  torch.exp(h.float()) * anchor_h], 4).view(-1, 4)
+    return x, y, w, h, conf, cls, pred_boxes
+
+
 class RegionLoss(nn.Module):
     # for our model anchors has 10 values and number of anchors is 5
     # parameters: 24, 10 float values, 24, 5
@@ -135,13 +245,13 @@ class RegionLoss(nn.Module):
         self.coord_scale    = cfg.SOLVER.COORD_SCALE
         self.focalloss      = FocalLoss(class_num=self.num_classes, gamma=2, size_average=False)
         self.thresh = 0.6
-        self.l_x = AverageMeter()
-        self.l_y = AverageMeter()
-        self.l_w = AverageMeter()
-        self.l_h = AverageMeter()
-        self.l_conf = AverageMeter()
-        self.l_cls = AverageMeter()
-        self.l_total = AverageMeter()
+        self.l_x = DeviceAverageMeter()
+        self.l_y = DeviceAverageMeter()
+        self.l_w = DeviceAverageMeter()
+        self.l_h = DeviceAverageMeter()
+        self.l_conf = DeviceAverageMeter()
+        self.l_cls = DeviceAverageMeter()
+        self.l_total = DeviceAverageMeter()
 
     def reset_meters(self):
         self.l_x.reset()
@@ -163,81 +273,22 @@ class RegionLoss(nn.Module):
         # H: height of the image (in grids)
         # W: width of the image (in grids)
         # for each grid cell, there are A*(4+1+num_classes) parameters
-        t0 = time.time()
-        nB = output.data.size(0)
+        # everything below stays on the device of output, there is no host sync in the step
         nA = self.num_anchors
         nC = self.num_classes
-        nH = output.data.size(2)
-        nW = output.data.size(3)
-
-        # resize the output (all parameters for each anchor can be reached)
-        output   = output.view(nB, nA, (5+nC), nH, nW)
-        # anchor's parameter tx
-        x    = torch.sigmoid(output.index_select(2, Variable(torch.cuda.LongTensor([0]))).view(nB, nA, nH, nW))
-        # anchor's parameter ty
-        y    = torch.sigmoid(output.index_select(2, Variable(torch.cuda.LongTensor([1]))).view(nB, nA, nH, nW))
-        # anchor's parameter tw
-        w    = output.index_select(2, Variable(torch.cuda.LongTensor([2]))).view(nB, nA, nH, nW)
-        # anchor's parameter th
-        h    = output.index_select(2, Variable(torch.cuda.LongTensor([3]))).view(nB, nA, nH, nW)
-        # confidence score for each anchor
-        conf = torch.sigmoid(output.index_select(2, Variable(torch.cuda.LongTensor([4]))).view(nB, nA, nH, nW))
-        # anchor's parameter class label
-        cls  = output.index_select(2, Variable(torch.linspace(5,5+nC-1,nC).long().cuda()))
-        # resize the data structure so that for every anchor there is a class label in the last dimension
-        cls  = cls.view(nB*nA, nC, nH*nW).transpose(1,2).contiguous().view(nB*nA*nH*nW, nC)
-        t1 = time.time()
-
-        # for the prediction of localization of each bounding box, there exist 4 parameters (tx, ty, tw, th)
-        pred_boxes = torch.cuda.FloatTensor(4, nB*nA*nH*nW)
-        # tx and ty
-        grid_x = torch.linspace(0, nW-1, nW).repeat(nH,1).repeat(nB*nA, 1, 1).view(nB*nA*nH*nW).cuda()
-        grid_y = torch.linspace(0, nH-1, nH).repeat(nW,1).t().repeat(nB*nA, 1, 1).view(nB*nA*nH*nW).cuda()
-        # for each anchor there are anchor_step variables (with the structure num_anchor*anchor_step)
-        # for each row(anchor), the first variable is anchor's width, second is anchor's height
-        # pw and ph
-        anchor_w = torch.Tensor(self.anchors).view(nA, self.anchor_step).index_select(1, torch.LongTensor([0])).cuda()
-        anchor_h = torch.Tensor(self.anchors).view(nA, self.anchor_step).index_select(1, torch.LongTensor([1])).cuda()
-        # for each pixel (grid) repeat the above process (obtain width and height of each grid)
-        anchor_w = anchor_w.repeat(nB, 1).repeat(1, 1, nH*nW).view(nB*nA*nH*nW)
-        anchor_h = anchor_h.repeat(nB, 1).repeat(1, 1, nH*nW).view(nB*nA*nH*nW)
-        # prediction of bounding box localization
-        # x.data and y.data: top left corner of the anchor
-        # grid_x, grid_y: tx and ty predictions made by yowo
-
-        x_data = x.data.view(-1)
-        y_data = y.data.view(-1)
-        w_data = w.data.view(-1)
-        h_data = h.data.view(-1)
-
-        pred_boxes[0] = x_data + grid_x    # bx
-        pred_boxes[1] = y_data + grid_y    # by
-        pred_boxes[2] = torch.exp(w_data) * anchor_w    # bw
-        pred_boxes[3] = torch.exp(h_data) * anchor_h    # bh
-        # the size -1 is inferred from other dimensions
-        # pred_boxes (nB*nA*nH*nW, 4)
-        pred_boxes = convert2cpu(pred_boxes.transpose(0,1).contiguous().view(-1,4))
-        t2 = time.time()
-
-        nGT, nCorrect, coord_mask, conf_mask, cls_mask, tx, ty, tw, th, tconf, tcls = build_targets(pred_boxes, target.data, self.anchors, nA, nC, \
-                                                               nH, nW, self.noobject_scale, self.object_scale, self.thresh)
-        cls_mask = (cls_mask == 1)
-        #  keep those with high box confidence scores (greater than 0.25) as our final predictions
-        nProposals = int((conf > 0.25).sum().data.item())
+        nH = output.size(2)
+        nW = output.size(3)
 
-        tx    = Variable(tx.cuda())
-        ty    = Variable(ty.cuda())
-        tw    = Variable(tw.cuda())
-        th    = Variable(th.cuda())
-        tconf = Variable(tconf.cuda())
-        tcls = Variable(tcls.view(-1)[cls_mask.view(-1)].long().cuda())
+        # anchor's parameters tx, ty, tw, th, the confidence score and the class logits of every anchor
+        x, y, w, h, conf, cls, pred_boxes = split_region_output(output, self.anchors, nA, nC)
 
-        coord_mask = Variable(coord_mask.cuda())
-        conf_mask  = Variable(conf_mask.cuda().sqrt())
-        cls_mask   = Variable(cls_mask.view(-1, 1).repeat(1,nC).cuda())
-        cls        = cls[cls_mask].view(-1, nC)  
-
-        t3 = time.time()
+        # targets are built in one batched pass on the device of the predictions
+        with record_phase('loss_targets'):
+            nGT, nCorrect, coord_mask, conf_mask, cls_mask, tx, ty, tw, th, tconf, tcls = build_targets_batched(pred_boxes, target, self.anchors, nA, nC, \
+                                                                   nH, nW, self.noobject_scale, self.object_scale, self.thresh)
+        #  keep those with high box confidence scores (greater than 0.25) as our final predictions
+        nProposals = (conf > 0.25).sum()
+        conf_mask = conf_mask.sqrt()
 
         # losses between predictions and targets (ground truth)
         # In total 6 aspects are considered as losses: 
@@ -248,21 +299,20 @@ class RegionLoss(nn.Module):
         loss_h = self.coord_scale * nn.SmoothL1Loss(reduction='sum')(h*coord_mask, th*coord_mask)/2.0
         loss_conf = nn.MSELoss(reduction='sum')(conf*conf_mask, tconf*conf_mask)/2.0
 
-        # try focal loss with gamma = 2
-        loss_cls = self.class_scale * self.focalloss(cls, tcls)
+        # try focal loss with gamma = 2, only the cells with an assigned ground truth contribute
+        loss_cls = self.class_scale * self.focalloss(cls, tcls.view(-1).long(), mask=cls_mask.view(-1))
 
         # sum of loss
         loss = loss_x + loss_y + loss_w + loss_h + loss_conf + loss_cls
-        #print(loss)
-        t4 = time.time()
 
-        self.l_x.update(loss_x.data.item(), self.batch)
-        self.l_y.update(loss_y.data.item(), self.batch)
-        self.l_w.update(loss_w.data.item(), self.batch)
-        self.l_h.update(loss_h.data.item(), self.batch)
-        self.l_conf.update(loss_conf.data.item(), self.batch)
-        self.l_cls.update(loss_cls.data.item(), self.batch)
-        self.l_total.update(loss.data.item(), self.batch)
+        # the meters keep device tensors and only sync when they are read for logging
+        self.l_x.update(loss_x.detach(), self.batch)
+        self.l_y.update(loss_y.detach(), self.batch)
+        self.l_w.update(loss_w.detach(), self.batch)
+        self.l_h.update(loss_h.detach(), self.batch)
+        self.l_conf.update(loss_conf.detach(), self.batch)
+        self.l_cls.update(loss_cls.detach(), self.batch)
+        self.l_total.update(loss.detach(), self.batch)
 
 
         # if batch_idx % 20 == 0: 
@@ -300,29 +350,40 @@ class binary_FocalLoss(nn.Module):
             # n = self.class_ratio[str(i)]
             # self.class_weight[i - 1] = (1 - self.beta) / (1 - self.beta ** n)
 
-    def forward(self, inputs, targets):
+    def forward(self, inputs, targets, mask=None):
         '''
         inputs: (N, C) -- result of sigmoid
         targets: (N, C) -- one-hot variable
+        mask: (N,) -- optional 0/1 weights of the rows that take part in the loss, masked
+                      out rows are weighted by zero instead of being selected on the host
         '''
         assert self.class_num == targets.size(1)
         assert self.class_num == inputs.size(1)
         assert inputs.size(0) == targets.size(0)
 
         weight_matrix = self.class_weight.expand(inputs.size(0), self.class_num)
-        weight_p1 = torch.exp(weight_matrix[targets == 1])
-        weight_p0 = torch.exp(1 - weight_matrix[targets == 0])
-        # weight_p1 = weight_matrix[targets == 1]
-        # weight_p0 = 1 - weight_matrix[targets == 0]
-        p_1 = inputs[targets == 1]
-        p_0 = inputs[targets == 0]
-
-        # loss = torch.sum(torch.log(p_1)) + torch.sum(torch.log(1 - p_0))  # origin bce loss
-        loss1 = torch.pow(1 - p_1, self.gamma) * torch.log(p_1) * weight_p1
-        loss2 = torch.pow(p_0, self.gamma) * torch.log(1 - p_0) * weight_p0
+        if mask is None:
+            weight_p1 = torch.exp(weight_matrix[targets == 1])
+            weight_p0 = torch.exp(1 - weight_matrix[targets == 0])
+            # weight_p1 = weight_matrix[targets == 1]
+            # weight_p0 = 1 - weight_matrix[targets == 0]
+            p_1 = inputs[targets == 1]
+            p_0 = inputs[targets == 0]
+
+            # loss = torch.sum(torch.log(p_1)) + torch.sum(torch.log(1 - p_0))  # origin bce loss
+            loss1 = torch.pow(1 - p_1, self.gamma) * torch.log(p_1) * weight_p1
+            loss2 = torch.pow(p_0, self.gamma) * torch.log(1 - p_0) * weight_p0
+            num = inputs.size(0)
+        else:
+            rows = mask.view(-1, 1).to(inputs.dtype)
+            loss1 = torch.pow(1 - inputs, self.gamma) * torch.log(inputs) * torch.exp(weight_matrix)
+            loss2 = torch.pow(inputs, self.gamma) * torch.log(1 - inputs) * torch.exp(1 - weight_matrix)
+            loss1 = loss1 * (targets == 1).to(inputs.dtype) * rows
+            loss2 = loss2 * (targets == 0).to(inputs.dtype) * rows
+            num = mask.sum()
         loss = -torch.sum(loss1) - torch.sum(loss2)
         if self.size_average:
-            loss /= inputs.size(0)
+            loss /= num
 
         return loss
 
@@ -446,6 +507,21 @@ def build_targets_Ava(pred_boxes, target, anchors, num_anchors, num_classes, nH,
 
 
 
+def build_targets_Ava_batched(pred_boxes, target, anchors, num_anchors, num_classes, nH, nW, noobject_scale, object_scale, sil_thresh):
+    # same outputs as build_targets_Ava, computed on the device of pred_boxes
+    # target: {'cls': [nB, nT, num_classes] multi-hot, 'boxes': [nB, nT, 4]}, a zero width ends the ground truth list
+    target_cls = target['cls'].to(pred_boxes.device)
+    target_boxes = target['boxes'].to(pred_boxes.device)
+    valid = torch.cumprod((target_boxes[:, :, 2] != 0).long(), 1).bool()
+    nGT, nCorrect, coord_mask, conf_mask, cls_mask, tx, ty, tw, th, tconf, dest = assign_targets(pred_boxes, target_boxes, valid, \
+                                                           anchors, num_anchors, nH, nW, noobject_scale, object_scale, sil_thresh)
+    tcls = coord_mask.new_zeros(coord_mask.numel()+1, num_classes)
+    tcls.index_put_((dest.view(-1),), target_cls.reshape(-1, num_classes).to(tcls.dtype))
+    tcls = tcls[:-1].view(*coord_mask.shape, num_classes)
+    return nGT, nCorrect, coord_mask, conf_mask, cls_mask, tx, ty, tw, th, tconf, tcls
+
+
+
 class RegionLoss_Ava(nn.Module):
     # for our model anchors has 10 values and number of anchors is 5
     # parameters: 24, 10 float values, 24, 5
@@ -462,13 +538,14 @@ class RegionLoss_Ava(nn.Module):
         self.coord_scale    = cfg.SOLVER.COORD_SCALE
         self.loss_func      = binary_FocalLoss(0.5, self.num_classes, cfg.TRAIN.CLASS_RATIO_FILE)
         self.thresh = 0.6
-        self.l_x = AverageMeter()
-        self.l_y = AverageMeter()
-        self.l_w = AverageMeter()
-        self.l_h = AverageMeter()
-        self.l_conf = AverageMeter()
-        self.l_cls = AverageMeter()
-        self.l_total = AverageMeter()
+        self.batched_targets = cfg.SOLVER.BATCHED_TARGETS
+        self.l_x = DeviceAverageMeter()
+        self.l_y = DeviceAverageMeter()
+        self.l_w = DeviceAverageMeter()
+        self.l_h = DeviceAverageMeter()
+        self.l_conf = DeviceAverageMeter()
+        self.l_cls = DeviceAverageMeter()
+        self.l_total = DeviceAverageMeter()
 
     def reset_meters(self):
         self.l_x.reset()
@@ -490,81 +567,27 @@ class RegionLoss_Ava(nn.Module):
         # H: height of the image (in grids)
         # W: width of the image (in grids)
         # for each grid cell, there are A*(4+1+num_classes) parameters
-        t0 = time.time()
-        nB = output.data.size(0)
+        # everything below stays on the device of output, there is no host sync in the step
         nA = self.num_anchors
         nC = self.num_classes
-        nH = output.data.size(2)
-        nW = output.data.size(3)
-
-        # resize the output (all parameters for each anchor can be reached)
-        output   = output.view(nB, nA, (5+nC), nH, nW)
-        # anchor's parameter tx
-        x    = torch.sigmoid(output.index_select(2, Variable(torch.cuda.LongTensor([0]))).view(nB, nA, nH, nW))
-        # anchor's parameter ty
-        y    = torch.sigmoid(output.index_select(2, Variable(torch.cuda.LongTensor([1]))).view(nB, nA, nH, nW))
-        # anchor's parameter tw
-        w    = output.index_select(2, Variable(torch.cuda.LongTensor([2]))).view(nB, nA, nH, nW)
-        # anchor's parameter th
-        h    = output.index_select(2, Variable(torch.cuda.LongTensor([3]))).view(nB, nA, nH, nW)
-        # confidence score for each anchor
-        conf = torch.sigmoid(output.index_select(2, Variable(torch.cuda.LongTensor([4]))).view(nB, nA, nH, nW))
-        # anchor's parameter class label
-        cls  = output.index_select(2, Variable(torch.linspace(5,5+nC-1,nC).long().cuda()))
-        # resize the data structure so that for every anchor there is a class label in the last dimension
-        cls  = cls.view(nB*nA, nC, nH*nW).transpose(1,2).contiguous().view(nB*nA*nH*nW, nC)
-        t1 = time.time()
-
-        # for the prediction of localization of each bounding box, there exist 4 parameters (tx, ty, tw, th)
-        pred_boxes = torch.cuda.FloatTensor(4, nB*nA*nH*nW)
-        # tx and ty
-        grid_x = torch.linspace(0, nW-1, nW).repeat(nH,1).repeat(nB*nA, 1, 1).view(nB*nA*nH*nW).cuda()
-        grid_y = torch.linspace(0, nH-1, nH).repeat(nW,1).t().repeat(nB*nA, 1, 1).view(nB*nA*nH*nW).cuda()
-        # for each anchor there are anchor_step variables (with the structure num_anchor*anchor_step)
-        # for each row(anchor), the first variable is anchor's width, second is anchor's height
-        # pw and ph
-        anchor_w = torch.Tensor(self.anchors).view(nA, self.anchor_step).index_select(1, torch.LongTensor([0])).cuda()
-        anchor_h = torch.Tensor(self.anchors).view(nA, self.anchor_step).index_select(1, torch.LongTensor([1])).cuda()
-        # for each pixel (grid) repeat the above process (obtain width and height of each grid)
-        anchor_w = anchor_w.repeat(nB, 1).repeat(1, 1, nH*nW).view(nB*nA*nH*nW)
-        anchor_h = anchor_h.repeat(nB, 1).repeat(1, 1, nH*nW).view(nB*nA*nH*nW)
-        # prediction of bounding box localization
-        # x.data and y.data: top left corner of the anchor
-        # grid_x, grid_y: tx and ty predictions made by yowo
-
-        x_data = x.data.view(-1)
-        y_data = y.data.view(-1)
-        w_data = w.data.view(-1)
-        h_data = h.data.view(-1)
-
-        pred_boxes[0] = x_data + grid_x    # bx
-        pred_boxes[1] = y_data + grid_y    # by
-        pred_boxes[2] = torch.exp(w_data) * anchor_w    # bw
-        pred_boxes[3] = torch.exp(h_data) * anchor_h    # bh
-        # the size -1 is inferred from other dimensions
-        # pred_boxes (nB*nA*nH*nW, 4)
-        pred_boxes = convert2cpu(pred_boxes.transpose(0,1).contiguous().view(-1,4))
-        t2 = time.time()
-
-        nGT, nCorrect, coord_mask, conf_mask, cls_mask, tx, ty, tw, th, tconf, tcls = build_targets_Ava(pred_boxes, target, self.anchors, nA, nC, \
-                                                               nH, nW, self.noobject_scale, self.object_scale, self.thresh)
-        cls_mask = (cls_mask == 1)
+        nH = output.size(2)
+        nW = output.size(3)
+
+        # anchor's parameters tx, ty, tw, th, the confidence score and the class logits of every anchor
+        x, y, w, h, conf, cls, pred_boxes = split_region_output(output, self.anchors, nA, nC)
+
+        with record_phase('loss_targets'):
+            if self.batched_targets:
+                nGT, nCorrect, coord_mask, conf_mask, cls_mask, tx, ty, tw, th, tconf, tcls = build_targets_Ava_batched(pred_boxes, target, self.anchors, nA, nC, \
+                                                                       nH, nW, self.noobject_scale, self.object_scale, self.thresh)
+            else:
+                nGT, nCorrect, coord_mask, conf_mask, cls_mask, tx, ty, tw, th, tconf, tcls = build_targets_Ava(pred_boxes.cpu(), {k: v.cpu() for k, v in target.items()}, self.anchors, nA, nC, \
+                                                                       nH, nW, self.noobject_scale, self.object_scale, self.thresh)
+                coord_mask, conf_mask, cls_mask, tx, ty, tw, th, tconf, tcls = [t.to(output.device) for t in \
+                                                                       (coord_mask, conf_mask, cls_mask, tx, ty, tw, th, tconf, tcls)]
         #  keep those with high box confidence scores (greater than 0.25) as our final predictions
-        nProposals = int((conf > 0.25).sum().data.item())
-
-        tx    = Variable(tx.cuda())
-        ty    = Variable(ty.cuda())
-        tw    = Variable(tw.cuda())
-        th    = Variable(th.cuda())
-        tconf = Variable(tconf.cuda())
-        tcls = Variable(tcls.view(-1, nC)[cls_mask.view(-1), :].long().cuda()) # TODO: CHECKOUT THIS ONE
-
-        coord_mask = Variable(coord_mask.cuda())
-        conf_mask  = Variable(conf_mask.cuda().sqrt())
-        cls_mask   = Variable(cls_mask.view(-1, 1).repeat(1,nC).cuda())
-        cls        = cls[cls_mask].view(-1, nC)  
-
-        t3 = time.time()
+        nProposals = (conf > 0.25).sum()
+        conf_mask = conf_mask.sqrt()
 
         # losses between predictions and targets (ground truth)
         # In total 6 aspects are considered as losses: 
@@ -575,24 +598,23 @@ class RegionLoss_Ava(nn.Module):
         loss_h = self.coord_scale * nn.SmoothL1Loss(reduction='sum')(h*coord_mask, th*coord_mask)/2.0
         loss_conf = nn.MSELoss(reduction='sum')(conf*conf_mask, tconf*conf_mask)/2.0
 
-        # try binary_FocalLoss
+        # try binary_FocalLoss, only the cells with an assigned ground truth contribute
         pose_output = _softmax(cls[:, :14])
         inter_output = _sigmoid(cls[:, 14:])
         total_output = torch.cat([pose_output, inter_output], dim=1)
-        loss_cls = self.class_scale * self.loss_func(total_output, tcls)  # cls_loss
+        loss_cls = self.class_scale * self.loss_func(total_output, tcls.view(-1, nC), mask=cls_mask.view(-1))  # cls_loss
 
         # sum of loss
         loss = loss_x + loss_y + loss_w + loss_h + loss_conf + loss_cls
-        #print(loss)
-        t4 = time.time()
 
-        self.l_x.update(loss_x.data.item(), self.batch)
-        self.l_y.update(loss_y.data.item(), self.batch)
-        self.l_w.update(loss_w.data.item(), self.batch)
-        self.l_h.update(loss_h.data.item(), self.batch)
-        self.l_conf.update(loss_conf.data.item(), self.batch)
-        self.l_cls.update(loss_cls.data.item(), self.batch)
-        self.l_total.update(loss.data.item(), self.batch)
+        # the meters keep device tensors and only sync when they are read for logging
+        self.l_x.update(loss_x.detach(), self.batch)
+        self.l_y.update(loss_y.detach(), self.batch)
+        self.l_w.update(loss_w.detach(), self.batch)
+        self.l_h.update(loss_h.detach(), self.batch)
+        self.l_conf.update(loss_conf.detach(), self.batch)
+        self.l_cls.update(loss_cls.detach(), self.batch)
+        self.l_total.update(loss.detach(), self.batch)
 
 
         # if batch_idx % 20 == 0: 
@@ -603,5 +625,59 @@ class RegionLoss_Ava(nn.Module):
         #             self.l_y.val, self.l_y.avg, self.l_w.val, self.l_w.avg,
         #             self.l_h.val, self.l_h.avg, self.l_conf.val, self.l_conf.avg,
         #             self.l_cls.val, self.l_cls.avg, self.l_total.val, self.l_total.avg))
-
         return loss
+
+
+def test_build_targets(trials=20, nB=4, nA=5, nH=7, nW=7, num_classes=24, device='cpu'):
+    # compare build_targets_batched against the loop version on random padded targets
+    torch.manual_seed(0)
+    anchors = [0.70458, 1.18803, 1.26654, 2.55121, 1.59382, 4.08321, 2.30548, 4.94180, 3.52332, 5.91979]
+    names = ['coord_mask', 'conf_mask', 'cls_mask', 'tx', 'ty', 'tw', 'th', 'tconf', 'tcls']
+    for trial in range(trials):
+        pred_boxes = torch.rand(nB*nA*nH*nW, 4) * torch.tensor([nW, nH, nW/2.0, nH/2.0])
+        target = torch.zeros(nB, 50, 5)
+        for b in range(nB):
+            n = int(torch.randint(0, 50, (1,)))
+            target[b, :n, 0] = torch.randint(0, num_classes, (n,)).float()
+            target[b, :n, 1:3] = torch.rand(n, 2) * 0.98 + 0.01
+            target[b, :n, 3:5] = torch.rand(n, 2) * 0.8 + 0.05
+            if n > 1:
+                # a repeated ground truth cell checks that the later box wins
+                target[b, n-1, 1:5] = target[b, 0, 1:5]
+        target = target.view(nB, -1)
+        ref = build_targets(pred_boxes, target, anchors, nA, num_classes, nH, nW, 1, 5, 0.6)
+        out = build_targets_batched(pred_boxes.to(device), target.to(device), anchors, nA, num_classes, nH, nW, 1, 5, 0.6)
+        assert ref[0] == int(out[0]) and ref[1] == int(out[1]), 'trial %d: nGT/nCorrect differ' % trial
+        for name, r, o in zip(names, ref[2:], out[2:]):
+            assert torch.allclose(r, o.cpu(), atol=1e-5), 'trial %d: %s differs' % (trial, name)
+    print('build_targets_batched matches build_targets on %d random batches' % trials)
+
+
+def test_build_targets_Ava(trials=20, nB=4, nA=5, nH=7, nW=7, num_classes=80, device='cpu'):
+    # compare build_targets_Ava_batched against the loop version on random padded targets
+    torch.manual_seed(0)
+    anchors = [0.70458, 1.18803, 1.26654, 2.55121, 1.59382, 4.08321, 2.30548, 4.94180, 3.52332, 5.91979]
+    names = ['coord_mask', 'conf_mask', 'cls_mask', 'tx', 'ty', 'tw', 'th', 'tconf', 'tcls']
+    for trial in range(trials):
+        pred_boxes = torch.rand(nB*nA*nH*nW, 4) * torch.tensor([nW, nH, nW/2.0, nH/2.0])
+        target = {'cls': torch.zeros(nB, 50, num_classes), 'boxes': torch.zeros(nB, 50, 4)}
+        for b in range(nB):
+            n = int(torch.randint(0, 50, (1,)))
+            target['cls'][b, :n] = (torch.rand(n, num_classes) > 0.9).float()
+            target['boxes'][b, :n, 0:2] = torch.rand(n, 2) * 0.98 + 0.01
+            target['boxes'][b, :n, 2:4] = torch.rand(n, 2) * 0.8 + 0.05
+            if n > 1:
+                # a repeated ground truth cell checks that the later box wins
+                target['boxes'][b, n-1] = target['boxes'][b, 0]
+        ref = build_targets_Ava(pred_boxes, target, anchors, nA, num_classes, nH, nW, 1, 5, 0.6)
+        target = {k: v.to(device) for k, v in target.items()}
+        out = build_targets_Ava_batched(pred_boxes.to(device), target, anchors, nA, num_classes, nH, nW, 1, 5, 0.6)
+        assert ref[0] == int(out[0]) and ref[1] == int(out[1]), 'trial %d: nGT/nCorrect differ' % trial
+        for name, r, o in zip(names, ref[2:], out[2:]):
+            assert torch.allclose(r, o.cpu(), atol=1e-5), 'trial %d: %s differs' % (trial, name)
+    print('build_targets_Ava_batched matches build_targets_Ava on %d random batches' % trials)
+
+
+if __name__ == '__main__':
+    test_build_targets()
+    test_build_targets_Ava()
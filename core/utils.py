@@ -2,11 +2,13 @@ import sys
 import os
 import time
 import math
-import shutil
+import functools
 import torch
+import torchvision
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from torch.autograd import Variable
+import core.distributed as du
 
 import struct # get_image_size
 import imghdr # get_image_size
@@ -31,18 +33,109 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
-def save_checkpoint(state, is_best, directory, dataset, clip_duration):
-    torch.save(state, '%s/%s_checkpoint.pth' % (directory, 'yowo_' + dataset + '_' + str(clip_duration) + 'f'))
-    if is_best:
-        shutil.copyfile('%s/%s_checkpoint.pth' % (directory, 'yowo_' + dataset + '_' + str(clip_duration) + 'f'),
-                        '%s/%s_best.pth' % (directory, 'yowo_' + dataset + '_' + str(clip_duration) + 'f'))
+class DeviceAverageMeter(AverageMeter):
+    """AverageMeter that accumulates tensors on their device and only syncs when read"""
 
+    def reset(self):
+        self._val = 0
+        self._sum = 0
+        self.count = 0
+
+    def update(self, val, n=1):
+        self._val = val
+        self._sum = self._sum + val * n
+        self.count += n
+
+    @property
+    def val(self):
+        return float(self._val)
+
+    @property
+    def sum(self):
+        return float(self._sum)
+
+    @property
+    def avg(self):
+        return self.sum / self.count if self.count else 0
+
+
+# devices of the two stages of the split codecs, filled by setup_devices
+_CODEC_DEVICES = []
+
+def get_device(cfg):
+    # torch.device of cfg.SYSTEM.DEVICE, a GPU request falls back to the CPU when CUDA is missing
+    device = torch.device(cfg.SYSTEM.DEVICE)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        device = torch.device('cpu')
+    return device
+
+def setup_devices(cfg):
+    # call once before anything touches CUDA, returns the main device
+    if cfg.SYSTEM.VISIBLE_DEVICES:
+        os.environ['CUDA_VISIBLE_DEVICES'] = cfg.SYSTEM.VISIBLE_DEVICES
+    device = get_device(cfg)
+    if device.type == 'cuda' and du.get_world_size() > 1:
+        # one GPU per process, the codec shares it
+        device = torch.device('cuda', du.get_local_rank(cfg))
+        torch.cuda.set_device(device)
+    if cfg.SYSTEM.CODEC_DEVICES:
+        codec_devices = [torch.device(d) for d in cfg.SYSTEM.CODEC_DEVICES]
+    elif device.type == 'cuda' and du.get_world_size() > 1:
+        codec_devices = [device]
+    elif device.type == 'cuda':
+        codec_devices = [torch.device('cuda', i) for i in range(min(2, torch.cuda.device_count()))]
+    else:
+        codec_devices = [device]
+    _CODEC_DEVICES[:] = codec_devices
+    logging('device: {}, codec devices: {}'.format(device, [str(d) for d in codec_devices]))
+    return device
+
+def codec_device(stage=0):
+    # device of a codec stage, stages beyond the configured devices share the last one
+    if not _CODEC_DEVICES:
+        if torch.cuda.is_available():
+            return torch.device('cuda', min(stage, torch.cuda.device_count()-1))
+        return torch.device('cpu')
+    return _CODEC_DEVICES[min(stage, len(_CODEC_DEVICES)-1)]
+
+
+def amp_dtype(cfg, device):
+    # autocast dtype of the detector loops, float16 autocast is not supported on the CPU
+    if device.type == 'cpu' or cfg.TRAIN.AMP_DTYPE == 'bfloat16':
+        return torch.bfloat16
+    return torch.float16
+
+def amp_autocast(cfg, device):
+    # mixed precision context for the model forward pass, a no-op unless cfg.TRAIN.AMP is set
+    return torch.autocast(device_type=device.type, dtype=amp_dtype(cfg, device), enabled=cfg.TRAIN.AMP)
+
+def amp_grad_scaler(cfg, device):
+    # only float16 needs loss scaling, the disabled scaler passes losses and steps through
+    enabled = cfg.TRAIN.AMP and device.type == 'cuda' and amp_dtype(cfg, device) == torch.float16
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+def clip_to_float(data, cfg):
+    # float clips of the uint8 [B, C, D, H, W] clips of DATA_LOADER.UINT8_CLIPS, scaled to [0, 1] and
+    # for AVA normalized with DATA.MEAN/STD like the dataset does, float clips are passed through
+    if data.dtype != torch.uint8:
+        return data
+    data = data.float().div_(255.0)
+    if cfg.TRAIN.DATASET == 'ava':
+        mean = torch.tensor(cfg.DATA.MEAN, dtype=data.dtype, device=data.device)
+        std = torch.tensor(cfg.DATA.STD, dtype=data.dtype, device=data.device)
+        if not cfg.AVA.BGR: # MEAN/STD are in the BGR order of the decoded frames
+            mean, std = mean.flip(0), std.flip(0)
+        data = data.sub_(mean.view(1, -1, 1, 1, 1)).div_(std.view(1, -1, 1, 1, 1))
+    return data
+
+def clip_to_device(data, cfg, device):
+    # move a [B, C, D, H, W] clip batch to the device in the layout the backbones run in
+    if isinstance(data, (tuple, list)): # cached backbone features
+        return tuple(d.to(device, non_blocking=True) for d in data)
+    if cfg.TRAIN.CHANNELS_LAST:
+        return clip_to_float(data.to(device, non_blocking=True, memory_format=torch.channels_last_3d), cfg)
+    return clip_to_float(data.to(device, non_blocking=True), cfg)
 
-def save_codec_checkpoint(state, is_best, directory, dataset, clip_duration, codec_name):
-    torch.save(state, '%s/%s_%s_ckpt.pth' % (directory, 'yowo_' + dataset + '_' + str(clip_duration) + 'f', codec_name))
-    if is_best:
-        shutil.copyfile('%s/%s_%s_ckpt.pth' % (directory, 'yowo_' + dataset + '_' + str(clip_duration) + 'f', codec_name),
-                        '%s/%s_%s_best.pth' % (directory, 'yowo_' + dataset + '_' + str(clip_duration) + 'f', codec_name))
 
 def adjust_learning_rate(optimizer, epoch, cfg):
     """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
@@ -166,25 +259,68 @@ def bbox_ious(boxes1, boxes2, x1y1x2y2=True):
     return carea/uarea
 
 def nms(boxes, nms_thresh):
+    # list based interface, boxes are [cx, cy, w, h, det_conf, ...]
     if len(boxes) == 0:
         return boxes
 
-    det_confs = torch.zeros(len(boxes))
-    for i in range(len(boxes)):
-        det_confs[i] = 1-boxes[i][4]                
+    packed = torch.tensor([[float(box[k]) for k in range(5)] for box in boxes])
+    keep = nms_tensor(packed[:, :4], packed[:, 4], nms_thresh)
+    return [boxes[i] for i in keep.tolist()]
 
-    _,sortIds = torch.sort(det_confs)
-    out_boxes = []
-    for i in range(len(boxes)):
-        box_i = boxes[sortIds[i]]
-        if box_i[4] > 0:
-            out_boxes.append(box_i)
-            for j in range(i+1, len(boxes)):
-                box_j = boxes[sortIds[j]]
-                if bbox_iou(box_i, box_j, x1y1x2y2=False) > nms_thresh:
-                    #print(box_i, box_j, bbox_iou(box_i, box_j, x1y1x2y2=False))
-                    box_j[4] = 0
-    return out_boxes
+
+def nms_tensor(boxes, scores, nms_thresh, batch_idx=None, class_ids=None, pre_nms_topk=None, max_dets=None):
+    """
+    Greedy non-maximum suppression on packed tensors, same boxes as nms().
+
+    Args:
+        boxes: [N, 4] (cx, cy, w, h) boxes, the suppression runs on their device.
+        scores: [N] confidences, boxes with score <= 0 are never kept.
+        batch_idx: optional [N] image index, boxes only suppress boxes of the same image.
+        class_ids: optional [N] class index for class-aware suppression.
+        pre_nms_topk: keep at most this many highest scoring candidates per image before nms.
+        max_dets: keep at most this many detections per image after nms.
+    Returns:
+        [M] indices into boxes of the kept detections, grouped by image in ascending
+        order and sorted by descending score within an image.
+    """
+    device = boxes.device
+    if boxes.size(0) == 0:
+        return torch.zeros(0, dtype=torch.long, device=device)
+    if batch_idx is None:
+        batch_idx = torch.zeros(boxes.size(0), dtype=torch.long, device=device)
+
+    # descending score inside every image, stable so that ties keep their input order
+    order = torch.sort(scores, descending=True, stable=True)[1]
+    order = order[torch.sort(batch_idx[order], stable=True)[1]]
+    order = order[scores[order] > 0]
+    if pre_nms_topk is not None:
+        order = order[_rank_in_group(batch_idx[order]) < pre_nms_topk]
+    if order.numel() == 0:
+        return order
+
+    # torchvision computes the IoU matrix and the greedy suppression on the device. The corners are
+    # those of bbox_ious, every image (and class) is shifted to its own region so that groups never
+    # overlap, in float64 where the shift keeps the float32 corners exact, and the ranks of order
+    # are passed as scores so that the suppression follows the stable order above
+    cx, cy, w, h = boxes[order].unbind(1)
+    corners = torch.stack([cx - w/2.0, cy - h/2.0, cx + w/2.0, cy + h/2.0], 1).double()
+    group = batch_idx[order]
+    if class_ids is not None:
+        group = group * (class_ids.max() + 1) + class_ids[order]
+    corners = corners + (group * (corners.max() - corners.min() + 1)).unsqueeze(1)
+    ranks = torch.arange(order.numel(), 0, -1, dtype=torch.float64, device=device)
+    keep = torchvision.ops.nms(corners, ranks, nms_thresh)
+    order = order[keep.sort()[0]]
+    if max_dets is not None:
+        order = order[_rank_in_group(batch_idx[order]) < max_dets]
+    return order
+
+
+def _rank_in_group(group):
+    # position of every element inside its run of equal values, group must be sorted
+    counts = torch.unique_consecutive(group, return_counts=True)[1]
+    starts = torch.cumsum(counts, 0) - counts
+    return torch.arange(group.numel(), device=group.device) - starts.repeat_interleave(counts)
 
 
 def area2d(b):
@@ -269,8 +405,33 @@ def convert2cpu(gpu_matrix):
 def convert2cpu_long(gpu_matrix):
     return torch.LongTensor(gpu_matrix.size()).copy_(gpu_matrix)
 
-def get_region_boxes(output, conf_thresh, num_classes, anchors, num_anchors, only_objectness=1, validation=False):
+def region_grid(anchors, num_anchors, nH, nW, device, dtype=torch.float32):
+    """
+    Grid offsets and anchor sizes of the region head, memoized per
+    (anchors, num_anchors, nH, nW, device, dtype).
+
+    Returns grid_x, grid_y of shape [1, 1, nH, nW] and anchor_w, anchor_h of
+    shape [1, num_anchors, 1, 1], they broadcast against any [B, A, H, W] tensor.
+    The tensors are shared between calls and must not be modified in place.
+    """
+    return _region_grid(tuple(float(a) for a in anchors), num_anchors, nH, nW, torch.device(device), dtype)
+
+
+@functools.lru_cache(maxsize=32)
+def _region_grid(anchors, num_anchors, nH, nW, device, dtype):
     anchor_step = len(anchors)//num_anchors
+    grid_x = torch.arange(nW, dtype=dtype, device=device).view(1, 1, 1, nW).expand(1, 1, nH, nW)
+    grid_y = torch.arange(nH, dtype=dtype, device=device).view(1, 1, nH, 1).expand(1, 1, nH, nW)
+    anchor_wh = torch.tensor(anchors, dtype=dtype, device=device).view(num_anchors, anchor_step)
+    anchor_w = anchor_wh[:, 0].contiguous().view(1, num_anchors, 1, 1)
+    anchor_h = anchor_wh[:, 1].contiguous().view(1, num_anchors, 1, 1)
+    return grid_x.contiguous(), grid_y.contiguous(), anchor_w, anchor_h
+
+
+def region_output(output, num_classes, anchors, num_anchors):
+    # decode the raw head output into box parameters on the output's device
+    # every returned tensor is laid out as [batch, h*w, num_anchors] so that flattening
+    # it visits the boxes in the (cy, cx, anchor) order the Python loops used to emit
     if output.dim() == 3:
         output = output.unsqueeze(0)
     batch = output.size(0)
@@ -278,238 +439,154 @@ def get_region_boxes(output, conf_thresh, num_classes, anchors, num_anchors, onl
     h = output.size(2)
     w = output.size(3)
 
-    t0 = time.time()
-    all_boxes = []
-    output = output.view(batch*num_anchors, 5+num_classes, h*w).transpose(0,1).contiguous().view(5+num_classes, batch*num_anchors*h*w)
-
-    grid_x = torch.linspace(0, w-1, w).repeat(h,1).repeat(batch*num_anchors, 1, 1).view(batch*num_anchors*h*w).cuda()
-    grid_y = torch.linspace(0, h-1, h).repeat(w,1).t().repeat(batch*num_anchors, 1, 1).view(batch*num_anchors*h*w).cuda()
-    xs = torch.sigmoid(output[0]) + grid_x
-    ys = torch.sigmoid(output[1]) + grid_y
+    output = output.view(batch, num_anchors, 5+num_classes, h*w).permute(2, 0, 3, 1)
 
-    anchor_w = torch.Tensor(anchors).view(num_anchors, anchor_step).index_select(1, torch.LongTensor([0]))
-    anchor_h = torch.Tensor(anchors).view(num_anchors, anchor_step).index_select(1, torch.LongTensor([1]))
-    anchor_w = anchor_w.repeat(batch, 1).repeat(1, 1, h*w).view(batch*num_anchors*h*w).cuda()
-    anchor_h = anchor_h.repeat(batch, 1).repeat(1, 1, h*w).view(batch*num_anchors*h*w).cuda()
-    ws = torch.exp(output[2]) * anchor_w
-    hs = torch.exp(output[3]) * anchor_h
+    grid_x, grid_y, anchor_w, anchor_h = region_grid(anchors, num_anchors, h, w, output.device, output.dtype)
+    grid_x = grid_x.view(1, h*w, 1)
+    grid_y = grid_y.view(1, h*w, 1)
+    anchor_w = anchor_w.view(1, 1, num_anchors)
+    anchor_h = anchor_h.view(1, 1, num_anchors)
 
+    xs = (torch.sigmoid(output[0]) + grid_x) / w
+    ys = (torch.sigmoid(output[1]) + grid_y) / h
+    ws = (torch.exp(output[2]) * anchor_w) / w
+    hs = (torch.exp(output[3]) * anchor_h) / h
     det_confs = torch.sigmoid(output[4])
-
-    cls_confs = torch.nn.Softmax()(Variable(output[5:5+num_classes].transpose(0,1))).data
-    cls_max_confs, cls_max_ids = torch.max(cls_confs, 1)
-    cls_max_confs = cls_max_confs.view(-1)
-    cls_max_ids = cls_max_ids.view(-1)
-    t1 = time.time()
-    
-    sz_hw = h*w
-    sz_hwa = sz_hw*num_anchors
-    det_confs = convert2cpu(det_confs)
-    cls_max_confs = convert2cpu(cls_max_confs)
-    cls_max_ids = convert2cpu_long(cls_max_ids)
-    xs = convert2cpu(xs)
-    ys = convert2cpu(ys)
-    ws = convert2cpu(ws)
-    hs = convert2cpu(hs)
-    if validation:
-        cls_confs = convert2cpu(cls_confs.view(-1, num_classes))
-    t2 = time.time()
-    for b in range(batch):
-        boxes = []
-        for cy in range(h):
-            for cx in range(w):
-                for i in range(num_anchors):
-                    ind = b*sz_hwa + i*sz_hw + cy*w + cx
-                    det_conf =  det_confs[ind]
-                    if only_objectness:
-                        conf =  det_confs[ind]
-                    else:
-                        conf = det_confs[ind] * cls_max_confs[ind]
-    
-                    if conf > conf_thresh:
-                        bcx = xs[ind]
-                        bcy = ys[ind]
-                        bw = ws[ind]
-                        bh = hs[ind]
-                        cls_max_conf = cls_max_confs[ind]
-                        cls_max_id = cls_max_ids[ind]
-                        box = [bcx/w, bcy/h, bw/w, bh/h, det_conf, cls_max_conf, cls_max_id]
-                        if (not only_objectness) and validation:
-                            for c in range(num_classes):
-                                tmp_conf = cls_confs[ind][c]
-                                if c != cls_max_id and det_confs[ind]*tmp_conf > conf_thresh:
-                                    box.append(tmp_conf)
-                                    box.append(c)
-                        boxes.append(box)
-        all_boxes.append(boxes)
-    t3 = time.time()
-    if False:
-        print('---------------------------------')
-        print('matrix computation : %f' % (t1-t0))
-        print('        gpu to cpu : %f' % (t2-t1))
-        print('      boxes filter : %f' % (t3-t2))
-        print('---------------------------------')
-    return all_boxes
+    # class logits as [batch, h*w, num_anchors, num_classes]
+    cls_logits = output[5:5+num_classes].permute(1, 2, 3, 0)
+    return xs, ys, ws, hs, det_confs, cls_logits
 
 
-def get_region_boxes_ava(output, conf_thresh, num_classes, anchors, num_anchors, only_objectness=1, validation=False):
-    anchor_step = len(anchors)//num_anchors
-    if output.dim() == 3:
-        output = output.unsqueeze(0)
-    batch = output.size(0)
-    assert(output.size(1) == (5+num_classes)*num_anchors)
-    h = output.size(2)
-    w = output.size(3)
+def get_region_boxes_flat(output, conf_thresh, num_classes, anchors, num_anchors, only_objectness=1, validation=False):
+    """
+    Vectorized decoding of the region head.
+
+    Returns:
+        boxes (tensor): [N, 7+2K] packed boxes of the whole batch on the output's device.
+            Each row is (cx, cy, w, h, det_conf, cls_max_conf, cls_max_id) followed, when
+            validation is on and only_objectness is off, by K = num_classes (cls_conf, cls_id)
+            pairs in class order. Pairs that the original decoder did not emit (the max class
+            itself or det_conf*cls_conf <= conf_thresh) carry cls_id = -1.
+        batch_idx (tensor): [N] image index of every box, boxes of an image are contiguous.
+    """
+    xs, ys, ws, hs, det_confs, cls_logits = region_output(output, num_classes, anchors, num_anchors)
+    cls_confs = torch.softmax(cls_logits, dim=-1)
+    cls_max_confs, cls_max_ids = torch.max(cls_confs, -1)
 
-    t0 = time.time()
+    if only_objectness:
+        conf = det_confs
+    else:
+        conf = det_confs * cls_max_confs
+    mask = conf > conf_thresh
+    batch_idx = mask.nonzero()[:, 0]
+
+    columns = [xs, ys, ws, hs, det_confs, cls_max_confs, cls_max_ids.to(xs.dtype)]
+    boxes = torch.stack([c[mask] for c in columns], 1)
+    if (not only_objectness) and validation:
+        cls_confs = cls_confs[mask]
+        cls_ids = torch.arange(num_classes, device=boxes.device).expand_as(cls_confs)
+        emitted = (boxes[:, 4:5] * cls_confs > conf_thresh) & (cls_ids != cls_max_ids[mask].unsqueeze(1))
+        cls_ids = torch.where(emitted, cls_ids, torch.full_like(cls_ids, -1))
+        pairs = torch.stack([cls_confs, cls_ids.to(boxes.dtype)], 2).view(-1, 2*num_classes)
+        boxes = torch.cat([boxes, pairs], 1)
+    return boxes, batch_idx
+
+
+def region_boxes_to_list(boxes, batch_idx, batch):
+    # compatibility adapter from the packed layout of get_region_boxes_flat to the
+    # per-image lists of [cx, cy, w, h, det_conf, cls_max_conf, cls_max_id, (cls_conf, cls_id)...]
+    boxes = boxes.cpu()
+    counts = torch.bincount(batch_idx.cpu(), minlength=batch).tolist()
     all_boxes = []
-    output = output.view(batch*num_anchors, 5+num_classes, h*w).transpose(0,1).contiguous().view(5+num_classes, batch*num_anchors*h*w)
-
-    grid_x = torch.linspace(0, w-1, w).repeat(h,1).repeat(batch*num_anchors, 1, 1).view(batch*num_anchors*h*w).cuda()
-    grid_y = torch.linspace(0, h-1, h).repeat(w,1).t().repeat(batch*num_anchors, 1, 1).view(batch*num_anchors*h*w).cuda()
-    xs = torch.sigmoid(output[0]) + grid_x
-    ys = torch.sigmoid(output[1]) + grid_y
-
-    anchor_w = torch.Tensor(anchors).view(num_anchors, anchor_step).index_select(1, torch.LongTensor([0]))
-    anchor_h = torch.Tensor(anchors).view(num_anchors, anchor_step).index_select(1, torch.LongTensor([1]))
-    anchor_w = anchor_w.repeat(batch, 1).repeat(1, 1, h*w).view(batch*num_anchors*h*w).cuda()
-    anchor_h = anchor_h.repeat(batch, 1).repeat(1, 1, h*w).view(batch*num_anchors*h*w).cuda()
-    ws = torch.exp(output[2]) * anchor_w
-    hs = torch.exp(output[3]) * anchor_h
+    for image_boxes in boxes.split(counts):
+        cls_ids = image_boxes[:, 6::2].long().tolist()
+        out_boxes = []
+        for row, ids in zip(image_boxes, cls_ids):
+            values = row.unbind(0)
+            box = list(values[:6])
+            box.append(ids[0])
+            for j in range(1, len(ids)):
+                if ids[j] >= 0:
+                    box.append(values[5+2*j])
+                    box.append(ids[j])
+            out_boxes.append(box)
+        all_boxes.append(out_boxes)
+    return all_boxes
 
-    det_confs = torch.sigmoid(output[4])
 
-    pose_cls_confs = torch.nn.Softmax()(Variable(output[5:5+14].transpose(0,1))).data  ############## MODIFICATION
-    act_cls_confs = torch.sigmoid(Variable(output[5+14:5+num_classes].transpose(0,1))).data  ############## MODIFICATION
-    cls_confs = torch.cat([pose_cls_confs, act_cls_confs], dim=1)
-    t1 = time.time()
-    
-    sz_hw = h*w
-    sz_hwa = sz_hw*num_anchors
-    det_confs = convert2cpu(det_confs)
-    xs = convert2cpu(xs)
-    ys = convert2cpu(ys)
-    ws = convert2cpu(ws)
-    hs = convert2cpu(hs)
-    if validation:
-        cls_confs = convert2cpu(cls_confs.view(-1, num_classes))
-    t2 = time.time()
-    for b in range(batch):
-        boxes = []
-        for cy in range(h):
-            for cx in range(w):
-                for i in range(num_anchors):
-                    ind = b*sz_hwa + i*sz_hw + cy*w + cx
-                    det_conf =  det_confs[ind]
-                    if det_conf > conf_thresh:  ############## MODIFICATION
-                        bcx = xs[ind]
-                        bcy = ys[ind]
-                        bw = ws[ind]
-                        bh = hs[ind]
-                        cls_conf = cls_confs[ind]
-                        box = [bcx/w, bcy/h, bw/w, bh/h, det_conf, cls_conf]
-                        boxes.append(box)
-        all_boxes.append(boxes)
-    t3 = time.time()
-    if False:
-        print('---------------------------------')
-        print('matrix computation : %f' % (t1-t0))
-        print('        gpu to cpu : %f' % (t2-t1))
-        print('      boxes filter : %f' % (t3-t2))
-        print('---------------------------------')
-    return all_boxes
+def get_region_boxes(output, conf_thresh, num_classes, anchors, num_anchors, only_objectness=1, validation=False):
+    batch = output.size(0) if output.dim() == 4 else 1
+    boxes, batch_idx = get_region_boxes_flat(output, conf_thresh, num_classes, anchors, num_anchors, only_objectness, validation)
+    return region_boxes_to_list(boxes, batch_idx, batch)
 
 
-def get_region_boxes_video(output, conf_thresh, num_classes, anchors, num_anchors, only_objectness=1, validation=False):
-    anchor_step = len(anchors)//num_anchors
-    if output.dim() == 3:
-        output = output.unsqueeze(0)
-    batch = output.size(0)
-    assert(output.size(1) == (5+num_classes)*num_anchors)
-    h = output.size(2)
-    w = output.size(3)
+def _region_boxes_ava_tensors(output, conf_thresh, num_classes, anchors, num_anchors):
+    # boxes above conf_thresh with their raw class confidences, kept on the output's device
+    xs, ys, ws, hs, det_confs, cls_logits = region_output(output, num_classes, anchors, num_anchors)
+    pose_cls_confs = torch.softmax(cls_logits[..., :14], dim=-1)
+    act_cls_confs = torch.sigmoid(cls_logits[..., 14:num_classes])
 
-    t0 = time.time()
-    all_boxes = []
-    output = output.view(batch*num_anchors, 5+num_classes, h*w).transpose(0,1).contiguous().view(5+num_classes, batch*num_anchors*h*w)
+    mask = det_confs > conf_thresh
+    batch_idx = mask.nonzero()[:, 0]
+    boxes = torch.stack([xs[mask], ys[mask], ws[mask], hs[mask]], 1)
+    cls_confs = torch.cat([pose_cls_confs[mask], act_cls_confs[mask]], 1)
+    return boxes, det_confs[mask], cls_confs, batch_idx
 
-    grid_x = torch.linspace(0, w-1, w).repeat(h,1).repeat(batch*num_anchors, 1, 1).view(batch*num_anchors*h*w).cuda()
-    grid_y = torch.linspace(0, h-1, h).repeat(w,1).t().repeat(batch*num_anchors, 1, 1).view(batch*num_anchors*h*w).cuda()
-    xs = torch.sigmoid(output[0]) + grid_x
-    ys = torch.sigmoid(output[1]) + grid_y
 
-    anchor_w = torch.Tensor(anchors).view(num_anchors, anchor_step).index_select(1, torch.LongTensor([0]))
-    anchor_h = torch.Tensor(anchors).view(num_anchors, anchor_step).index_select(1, torch.LongTensor([1]))
-    anchor_w = anchor_w.repeat(batch, 1).repeat(1, 1, h*w).view(batch*num_anchors*h*w).cuda()
-    anchor_h = anchor_h.repeat(batch, 1).repeat(1, 1, h*w).view(batch*num_anchors*h*w).cuda()
-    ws = torch.exp(output[2]) * anchor_w
-    hs = torch.exp(output[3]) * anchor_h
+def get_region_boxes_ava_arrays(output, conf_thresh, num_classes, anchors, num_anchors):
+    """
+    Vectorized decoding of the AVA region head, the first 14 (pose) classes are
+    mutually exclusive and the remaining (action) classes are independent labels.
+
+    Returns (numpy arrays for the whole batch, boxes of an image are contiguous):
+        boxes: [N, 4] (cx, cy, w, h) normalized to the feature map size.
+        det_confs: [N] objectness of every box.
+        cls_scores: [N, num_classes] class confidences multiplied by the objectness.
+        batch_idx: [N] image index of every box.
+    """
+    boxes, det_confs, cls_confs, batch_idx = _region_boxes_ava_tensors(output, conf_thresh, num_classes, anchors, num_anchors)
+    cls_scores = cls_confs * det_confs.unsqueeze(1)
+    return boxes.cpu().numpy(), det_confs.cpu().numpy(), cls_scores.cpu().numpy(), batch_idx.cpu().numpy()
 
-    det_confs = torch.sigmoid(output[4])
 
-    cls_confs = torch.nn.Softmax()(Variable(output[5:5+num_classes].transpose(0,1))).data
-    cls_max_confs, cls_max_ids = torch.max(cls_confs, 1)
-    cls_max_confs = cls_max_confs.view(-1)
-    cls_max_ids = cls_max_ids.view(-1)
-    t1 = time.time()
-    
-    sz_hw = h*w
-    sz_hwa = sz_hw*num_anchors
-    det_confs = convert2cpu(det_confs)
-    cls_max_confs = convert2cpu(cls_max_confs)
-    cls_max_ids = convert2cpu_long(cls_max_ids)
-    xs = convert2cpu(xs)
-    ys = convert2cpu(ys)
-    ws = convert2cpu(ws)
-    hs = convert2cpu(hs)
-    if validation:
-        cls_confs = convert2cpu(cls_confs.view(-1, num_classes))
-    t2 = time.time()
-    for b in range(batch):
-        boxes = []
-        for cy in range(h):
-            for cx in range(w):
-                for i in range(num_anchors):
-                    ind = b*sz_hwa + i*sz_hw + cy*w + cx
-                    det_conf =  det_confs[ind]
-                    if only_objectness:
-                        conf =  det_confs[ind]
-                    else:
-                        conf = det_confs[ind] * cls_max_confs[ind]
-    
-                    if conf > conf_thresh:
-                        bcx = xs[ind]
-                        bcy = ys[ind]
-                        bw = ws[ind]
-                        bh = hs[ind]
-                        cls_max_conf = cls_max_confs[ind]
-                        cls_max_id = cls_max_ids[ind]
-                        box = [bcx/w, bcy/h, bw/w, bh/h, det_conf]
-                        if (not only_objectness) and validation:
-                            for c in range(num_classes):
-                                tmp_conf = cls_confs[ind][c]
-                                box.append(tmp_conf)
-                                box.append(c)
-
-                        # box = [bcx/w, bcy/h, bw/w, bh/h, det_conf, cls_max_conf, cls_max_id]
-                        # if (not only_objectness) and validation:
-                        #     for c in range(num_classes):
-                        #         tmp_conf = cls_confs[ind][c]
-                        #         if c != cls_max_id and det_confs[ind]*tmp_conf > conf_thresh:
-                        #             box.append(tmp_conf)
-                        #             box.append(c)
-                        boxes.append(box)
-        all_boxes.append(boxes)
-    t3 = time.time()
-    if False:
-        print('---------------------------------')
-        print('matrix computation : %f' % (t1-t0))
-        print('        gpu to cpu : %f' % (t2-t1))
-        print('      boxes filter : %f' % (t3-t2))
-        print('---------------------------------')
+def get_region_boxes_ava(output, conf_thresh, num_classes, anchors, num_anchors, only_objectness=1, validation=False):
+    # compatibility adapter returning per-image lists of [cx, cy, w, h, det_conf, cls_confs]
+    batch = output.size(0) if output.dim() == 4 else 1
+    boxes, det_confs, cls_confs, batch_idx = _region_boxes_ava_tensors(output, conf_thresh, num_classes, anchors, num_anchors)
+    boxes, det_confs, cls_confs = boxes.cpu(), det_confs.cpu(), cls_confs.cpu()
+    all_boxes = [[] for _ in range(batch)]
+    for i, b in enumerate(batch_idx.tolist()):
+        all_boxes[b].append(list(boxes[i].unbind(0)) + [det_confs[i], cls_confs[i]])
     return all_boxes
 
 
+def get_region_boxes_video(output, conf_thresh, num_classes, anchors, num_anchors, only_objectness=1, validation=False):
+    # per-image lists of [cx, cy, w, h, det_conf] followed, when validation is on and
+    # only_objectness is off, by the (cls_conf, cls_id) pair of every class
+    batch = output.size(0) if output.dim() == 4 else 1
+    xs, ys, ws, hs, det_confs, cls_logits = region_output(output, num_classes, anchors, num_anchors)
+    cls_confs = torch.softmax(cls_logits, dim=-1)
+
+    if only_objectness:
+        conf = det_confs
+    else:
+        conf = det_confs * cls_confs.max(-1)[0]
+    mask = conf > conf_thresh
+    batch_idx = mask.nonzero()[:, 0].cpu()
+    boxes = torch.stack([xs[mask], ys[mask], ws[mask], hs[mask], det_confs[mask]], 1).cpu()
+    with_classes = (not only_objectness) and validation
+    if with_classes:
+        cls_confs = cls_confs[mask].cpu()
+
+    all_boxes = [[] for _ in range(batch)]
+    for i, b in enumerate(batch_idx.tolist()):
+        box = list(boxes[i].unbind(0))
+        if with_classes:
+            for c, tmp_conf in enumerate(cls_confs[i].unbind(0)):
+                box.append(tmp_conf)
+                box.append(c)
+        all_boxes[b].append(box)
+    return all_boxes
 
 
 def plot_boxes_cv2(img, boxes, savename=None, class_names=None, color=None):
@@ -613,8 +690,10 @@ def read_truths(lab_path):
     else:
         return np.array([])
 
-def read_truths_args(lab_path, min_box_scale):
-    truths = read_truths(lab_path)
+def read_truths_args(lab_path, min_box_scale, truths=None):
+    # truths: rows of the label file when they are known already, e.g. from datasets.manifest
+    if truths is None:
+        truths = read_truths(lab_path)
     new_truths = []
     for i in range(truths.shape[0]):
         cx = (truths[i][1] + truths[i][3]) / (2 * 320)
@@ -652,7 +731,6 @@ def image2torch(img):
 
 def do_detect(model, img, conf_thresh, nms_thresh, use_cuda=1):
     model.eval()
-    t0 = time.time()
 
     if isinstance(img, Image.Image):
         width = img.width
@@ -667,37 +745,22 @@ def do_detect(model, img, conf_thresh, nms_thresh, use_cuda=1):
         print("unknow image type")
         exit(-1)
 
-    t1 = time.time()
 
     if use_cuda:
         img = img.cuda()
     img = torch.autograd.Variable(img)
-    t2 = time.time()
 
     output = model(img)
     output = output.data
     #for j in range(100):
     #    sys.stdout.write('%f ' % (output.storage()[j]))
     #print('')
-    t3 = time.time()
 
     boxes = get_region_boxes(output, conf_thresh, model.num_classes, model.anchors, model.num_anchors)[0]
     #for j in range(len(boxes)):
     #    print(boxes[j])
-    t4 = time.time()
 
     boxes = nms(boxes, nms_thresh)
-    t5 = time.time()
-
-    if False:
-        print('-----------------------------------')
-        print(' image to tensor : %f' % (t1 - t0))
-        print('  tensor to cuda : %f' % (t2 - t1))
-        print('         predict : %f' % (t3 - t2))
-        print('get_region_boxes : %f' % (t4 - t3))
-        print('             nms : %f' % (t5 - t4))
-        print('           total : %f' % (t5 - t0))
-        print('-----------------------------------')
     return boxes
 
 def read_data_cfg(datacfg):
@@ -780,4 +843,61 @@ def load_value_file(file_path):
     with open(file_path, 'r') as input_file:
         value = float(input_file.read().rstrip('\n\r'))
 
-    return value
\ No newline at end of file
+    return value
+
+
+def benchmark_nms(num_boxes=(100, 300, 1000), nms_thresh=0.5, repeat=5):
+    # compare the list based reference loop against nms_tensor on CPU (and GPU when present), on
+    # random boxes and on dense outputs, boxes of one object with small jitter
+    def reference_nms(boxes):
+        boxes = [list(box) for box in boxes]
+        det_confs = torch.zeros(len(boxes))
+        for i in range(len(boxes)):
+            det_confs[i] = 1-boxes[i][4]
+        _,sortIds = torch.sort(det_confs)
+        out_boxes = []
+        for i in range(len(boxes)):
+            box_i = boxes[sortIds[i]]
+            if box_i[4] > 0:
+                out_boxes.append(box_i)
+                for j in range(i+1, len(boxes)):
+                    box_j = boxes[sortIds[j]]
+                    if bbox_iou(box_i, box_j, x1y1x2y2=False) > nms_thresh:
+                        box_j[4] = 0
+        return out_boxes
+
+    devices = [torch.device('cpu')]
+    if torch.cuda.is_available():
+        devices.append(torch.device('cuda'))
+    for n, dense in [(n, dense) for dense in [False, True] for n in num_boxes]:
+        packed = torch.rand(n, 5)
+        if dense:
+            packed[:, 0:2] = 0.5 + (packed[:, 0:2] - 0.5) * 0.1
+            packed[:, 2:4] = 0.3 + packed[:, 2:4] * 0.1
+        else:
+            packed[:, 2:4] = packed[:, 2:4] * 0.3 + 0.02
+        t0 = time.perf_counter()
+        ref = reference_nms(packed.tolist())
+        t_ref = time.perf_counter() - t0
+        line = '%-6s boxes %5d | reference %8.2f ms' % ('dense' if dense else 'random', n, t_ref*1000)
+        for device in devices:
+            boxes = packed.to(device)
+            keep = nms_tensor(boxes[:, :4], boxes[:, 4], nms_thresh)
+            assert len(ref) == keep.numel()
+            if device.type == 'cpu':
+                keep_cpu = keep
+            assert torch.equal(keep.cpu(), keep_cpu) # the same boxes on every device
+            assert torch.allclose(torch.tensor(ref)[:, 4], packed[keep.cpu(), 4])
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            t0 = time.perf_counter()
+            for _ in range(repeat):
+                nms_tensor(boxes[:, :4], boxes[:, 4], nms_thresh)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            line += ' | nms_tensor %s %8.2f ms' % (device.type, (time.perf_counter() - t0)/repeat*1000)
+        print(line)
+
+
+if __name__ == '__main__':
+    benchmark_nms()
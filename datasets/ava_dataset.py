@@ -9,11 +9,14 @@ import os
 import torch
 import numpy as np
 import cv2
+from PIL import Image
 
-from datasets import ava_helper, cv2_transform
-from datasets.dataset_utils import retry_load_images, get_frame_idx, get_sequence
+from datasets import ava_helper, ava_index, cv2_transform
+from datasets.dataset_utils import retry_load_images, get_frame_idx, get_sequence, decode_reduction, \
+    get_decode_threads, load_frames
 from datasets import image
 from torchvision import transforms
+from core.utils import codec_device
 
 logger = logging.getLogger(__name__)
 
@@ -50,9 +53,43 @@ class Ava(torch.utils.data.Dataset):
             self._crop_size = cfg.DATA.TEST_CROP_SIZE
             self._test_force_flip = cfg.AVA.TEST_FORCE_FLIP
             self._jitter_min_scale = cfg.DATA.TRAIN_JITTER_SCALES[0]
+        # Decode frames at the smallest DCT scale that covers the input,
+        # cdet_augmentation crops up to 2 * 0.1 of a side in training.
+        self._reduced_decode = cfg.DATA.REDUCED_DECODE
+        self._decode_size = (
+            int(math.ceil(self._crop_size / 0.8)) if self._split == "train" else self._crop_size
+        )
+        self._frame_sizes = {}
+        # Decode the frames of a clip concurrently.
+        self._decode_threads = get_decode_threads(cfg)
+        # Return uint8 clips, scaled and normalized by core.utils.clip_to_float
+        # on the device. The color augmentation works on float clips.
+        self._uint8_clips = cfg.DATA_LOADER.UINT8_CLIPS and not (
+            self._split == "train" and self._use_color_augmentation
+        )
+        # Training clips are augmented unless disable_augmentation is called.
+        self._augment = True
 
         self._load_data(cfg)
 
+    def disable_augmentation(self):
+        """
+        Preprocess the training clips like the test clips, resized to the crop
+        size without jitter, flips or color augmentation. Used for the
+        un-augmented view of datasets.feature_cache.
+        """
+        self._augment = False
+
+    def _source_size(self, video_idx):
+        """
+        (width, height) of the frames of a video on disk, from the header of the
+        first frame.
+        """
+        if video_idx not in self._frame_sizes:
+            with Image.open(self._image_paths[video_idx][0]) as img:
+                self._frame_sizes[video_idx] = img.size
+        return self._frame_sizes[video_idx]
+
     def _load_data(self, cfg):
         """
         Load frame paths and annotations from files
@@ -60,6 +97,21 @@ class Ava(torch.utils.data.Dataset):
         Args:
             cfg (CfgNode): config
         """
+        if cfg.AVA.INDEX_DIR:
+            # Compiled and memory-mapped by ava_index, parsed on first use.
+            (
+                self._image_paths,
+                self._video_idx_to_name,
+                self._keyframe_indices,
+                self._keyframe_boxes_and_labels,
+                self._num_boxes_used,
+            ) = ava_index.load_annotations(cfg, self._split)
+            self._max_objs = ava_helper.get_max_objs(
+                self._keyframe_indices, self._keyframe_boxes_and_labels
+            )
+            self.print_summary()
+            return
+
         # Loading frame paths.
         (
             self._image_paths,
@@ -138,7 +190,7 @@ class Ava(torch.utils.data.Dataset):
         boxes = [boxes]
 
         # The image now is in HWC, BGR format.
-        if self._split == "train":  # "train"
+        if self._split == "train" and self._augment:  # "train"
             ''' slow-fast augmentation'''
             # imgs, boxes = cv2_transform.random_short_side_scale_jitter_list(
             #     imgs,
@@ -167,6 +219,9 @@ class Ava(torch.utils.data.Dataset):
                 imgs, boxes = cv2_transform.horizontal_flip_list(
                     0.5, imgs, order="HWC", boxes=boxes
                 )
+        elif self._split == "train":  # without augmentation, like "test"
+            imgs = [cv2_transform.resize(self._crop_size, img) for img in imgs]
+            boxes = cv2_transform.resize_boxes(self._crop_size, boxes, height, width)
         elif self._split == "val":  # need modified
             # Short side to test_scale. Non-local and STRG uses 256.
             # imgs = [cv2_transform.scale(self._crop_size, img) for img in imgs]
@@ -218,6 +273,15 @@ class Ava(torch.utils.data.Dataset):
         # Convert image to CHW keeping BGR order.
         imgs = [cv2_transform.HWC2CHW(img) for img in imgs]
 
+        if self._uint8_clips:
+            # The resized frames hold integers in [0, 255], the clip
+            # [C, T, H, W] is scaled and normalized after the transfer.
+            imgs = np.stack(imgs, axis=1)
+            if not self._use_bgr:
+                imgs = imgs[::-1, ...]
+            imgs = torch.from_numpy(np.ascontiguousarray(imgs, dtype=np.uint8))
+            return self._clip_and_boxes(imgs, boxes)
+
         # Image [0, 255] -> [0, 1].
         imgs = [img / 255.0 for img in imgs]
 
@@ -230,7 +294,7 @@ class Ava(torch.utils.data.Dataset):
         ]
 
         # Do color augmentation (after divided by 255.0).
-        if self._split == "train" and self._use_color_augmentation:
+        if self._split == "train" and self._use_color_augmentation and self._augment:
             if not self._pca_jitter_only:
                 imgs = cv2_transform.color_jitter_list(
                     imgs,
@@ -267,6 +331,20 @@ class Ava(torch.utils.data.Dataset):
 
         imgs = np.ascontiguousarray(imgs)
         imgs = torch.from_numpy(imgs)
+        return self._clip_and_boxes(imgs, boxes)
+
+    def _clip_and_boxes(self, imgs, boxes):
+        """
+        Clips the boxes to the frames of a clip and converts them to (cx, cy, w, h).
+
+        Args:
+            imgs (tensor): the [C, T, H, W] clip.
+            boxes (list): the boxes of the clip.
+
+        Returns:
+            imgs (tensor): the clip.
+            boxes (ndarray): the boxes as (cx, cy, w, h).
+        """
         bx_count = boxes[0].shape[0]
         boxes = cv2_transform.clip_boxes_to_image(
             boxes[0], imgs[0].shape[1], imgs[0].shape[2]
@@ -304,13 +382,23 @@ class Ava(torch.utils.data.Dataset):
             num_frames=len(self._image_paths[video_idx]),
         )
         image_paths = [self._image_paths[video_idx][frame - 1] for frame in seq]
-        imgs = retry_load_images(image_paths, backend=self.cfg.AVA.IMG_PROC_BACKEND)
+        reduce = 1
+        if self._reduced_decode:
+            src_width, src_height = self._source_size(video_idx)
+            reduce = decode_reduction(src_height, src_width, self._decode_size)
+        imgs = retry_load_images(
+            image_paths,
+            backend=self.cfg.AVA.IMG_PROC_BACKEND,
+            reduce=reduce,
+            num_threads=self._decode_threads,
+        )
 
         assert len(clip_label_list) > 0
         assert len(clip_label_list) <= self._max_objs
         num_objs = len(clip_label_list)
         keyframe_info = self._image_paths[video_idx][frame_idx - 1]
-        src_height, src_width = imgs[0].shape[0], imgs[0].shape[1]
+        if not self._reduced_decode:
+            src_height, src_width = imgs[0].shape[0], imgs[0].shape[1]
 
         # Get boxes and labels for current clip.
         boxes = []
@@ -433,6 +521,9 @@ class Ava_codec(torch.utils.data.Dataset):
             self._test_force_flip = cfg.AVA.TEST_FORCE_FLIP
             self._jitter_min_scale = cfg.DATA.TRAIN_JITTER_SCALES[0]
 
+        self._reduced_decode = cfg.DATA.REDUCED_DECODE # frames decoded at the smallest DCT scale that covers the crop
+        self._decode_threads = get_decode_threads(cfg) # the frames of a video decoded concurrently
+
         self._load_data(cfg)
         self.cache = {} # cache for current video clip
         self.prev_video = '' # previous video name to determine whether its a whole new video
@@ -445,6 +536,21 @@ class Ava_codec(torch.utils.data.Dataset):
         Args:
             cfg (CfgNode): config
         """
+        if cfg.AVA.INDEX_DIR:
+            # Compiled and memory-mapped by ava_index, parsed on first use.
+            (
+                self._image_paths,
+                self._video_idx_to_name,
+                self._keyframe_indices,
+                self._keyframe_boxes_and_labels,
+                self._num_boxes_used,
+            ) = ava_index.load_annotations(cfg, self._split)
+            self._max_objs = ava_helper.get_max_objs(
+                self._keyframe_indices, self._keyframe_boxes_and_labels
+            )
+            self.print_summary()
+            return
+
         # Loading frame paths.
         (
             self._image_paths,
@@ -497,6 +603,10 @@ class Ava_codec(torch.utils.data.Dataset):
 
     def __len__(self):
         return len(self._keyframe_indices)
+
+    def shard(self, start, end):
+        # keep the contiguous key frames [start, end), so that each process compresses its videos in order
+        self._keyframe_indices = self._keyframe_indices[start:end]
         
     def _images_preprocessing_cv2(self, imgs):
         
@@ -509,7 +619,7 @@ class Ava_codec(torch.utils.data.Dataset):
                         ])
         
         # 255->1,HWC->CHW,RGB
-        imgs = [transform(img).cuda() for img in imgs]
+        imgs = [transform(img).to(codec_device(0)) for img in imgs]
 
         return imgs
         
@@ -602,12 +712,21 @@ class Ava_codec(torch.utils.data.Dataset):
         seq_len = self._video_length * sample_rate
         seq = list(range(len(self._image_paths[video_idx])))
         image_paths = [self._image_paths[video_idx][frame - 1] for frame in seq]
-        imgs = retry_load_images(image_paths, backend=self.cfg.AVA.IMG_PROC_BACKEND)
-        self.cache['hw'] = (imgs[0].shape[0],imgs[0].shape[1])
+        # the frame size from the header of the first frame, the frames are decoded once below
+        with Image.open(image_paths[0]) as img:
+            width, height = img.size
+        if self._reduced_decode: # the boxes are scaled to the decoded size
+            reduce = decode_reduction(height, width, self._crop_size)
+            width, height = int(math.ceil(width / reduce)), int(math.ceil(height / reduce))
+        self.cache['hw'] = (height, width)
         
-        imgs = []
-        for image_path in image_paths:
-            imgs.append(Image.open(image_path).convert('RGB'))
+        def load(image_path):
+            img = Image.open(image_path)
+            if self._reduced_decode:
+                img.draft('RGB', (width, height))
+            return img.convert('RGB')
+
+        imgs = load_frames(load, image_paths, self._decode_threads)
             
         imgs = [img.resize(self.cache['hw']) for img in imgs]
                     
@@ -667,6 +786,16 @@ class Ava_codec(torch.utils.data.Dataset):
         return ret, cache['bpp_est'][frame_idx-1], cache['img_loss'][frame_idx-1], cache['aux'][frame_idx-1], \
                 cache['flow_loss'][frame_idx-1], cache['bpp_act'][frame_idx-1], cache['metrics'][frame_idx-1]
         
+    def starts_new_clip(self, index):
+        """
+        Whether preprocess(index) starts a new codec clip, i.e. keeps no
+        state of the clips before it. True past the end of the dataset.
+        """
+        if index >= len(self):
+            return True
+        video_idx, _, _, frame_idx = self._keyframe_indices[index]
+        return video_idx != self.prev_video or self.cache['max_idx'] != frame_idx - 2
+
     def preprocess(self, index, model_codec, GOP=10):
         # called by the optimization code in each iteration
         assert index <= len(self), 'index range error'
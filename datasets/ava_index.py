@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+
+"""
+Compiled AVA annotation index.
+
+The frame lists, the box annotations and the evaluation ground truth are
+parsed from their CSVs once and saved as flat arrays, one .npy file per
+array, in AVA.INDEX_DIR/<part>_<key>. The key hashes the contents of the
+source files and the settings that select the rows, so edited CSVs or
+other settings build a new index. The arrays are opened memory-mapped:
+data loader workers share their pages, and the frame paths and boxes of a
+clip are only turned into python objects when the clip is loaded.
+
+    python -m datasets.ava_index --cfg cfg/ava.yaml AVA.INDEX_DIR /path/to/ava/index
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+from collections import defaultdict
+
+import numpy as np
+from fvcore.common.file_io import PathManager
+
+from datasets import ava_helper
+from datasets.ava_eval_helper import read_csv, read_exclusions, read_labelmap
+
+logger = logging.getLogger(__name__)
+
+# Memory-mapped arrays of the indexes opened by this process.
+_INDEXES = {}
+# Evaluation ground truth of this process, AVAMeter is built every epoch.
+_GROUNDTRUTH = {}
+# Content hashes of the source files, by path, size and modification time.
+_FILE_HASHES = {}
+
+
+def _file_hash(path):
+    """
+    Returns the sha1 of the contents of a file, "" if the file is not given.
+    """
+    if not path:
+        return ""
+    try:
+        st = os.stat(path)
+        stamp = (path, st.st_size, st.st_mtime_ns)
+    except OSError:  # not a local file
+        stamp = None
+    if stamp is not None and stamp in _FILE_HASHES:
+        return _FILE_HASHES[stamp]
+    h = hashlib.sha1()
+    with PathManager.open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 22), b""):
+            h.update(chunk)
+    if stamp is not None:
+        _FILE_HASHES[stamp] = h.hexdigest()
+    return h.hexdigest()
+
+
+def _index_key(files, settings):
+    h = hashlib.sha1()
+    h.update(json.dumps([_file_hash(f) for f in files] + settings).encode())
+    return h.hexdigest()[:16]
+
+
+def _open_index(cfg, part, files, settings, build):
+    """
+    Opens an index, built by `build` if it does not exist yet.
+
+    Args:
+        cfg (CfgNode): config.
+        part (str): the part of the annotations the index holds.
+        files (list): the source files of the index.
+        settings (list): the settings the index depends on besides the files.
+        build (callable): returns the dict of arrays of the index.
+
+    Returns:
+        arrays (dict): the memory-mapped arrays of the index by name.
+    """
+    directory = os.path.join(
+        cfg.AVA.INDEX_DIR, "%s_%s" % (part, _index_key(files, settings))
+    )
+    if directory not in _INDEXES:
+        if not os.path.exists(os.path.join(directory, "meta.json")):
+            _save_index(directory, build())
+            logger.info("Saved AVA annotation index to %s" % directory)
+        with open(os.path.join(directory, "meta.json")) as f:
+            names = json.load(f)["arrays"]
+        _INDEXES[directory] = {
+            n: np.load(os.path.join(directory, n + ".npy"), mmap_mode="r")
+            for n in names
+        }
+    return _INDEXES[directory]
+
+
+def _save_index(directory, arrays):
+    # Written next to the target and renamed, processes that build the same
+    # index at once keep the first complete one.
+    tmp = "%s.tmp%d" % (directory, os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp, name + ".npy"), array)
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({"arrays": sorted(arrays)}, f)
+    try:
+        os.rename(tmp, directory)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _offsets(lengths):
+    return np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]).astype(np.int64)
+
+
+def _strings(values):
+    # Fixed width bytes, a quarter of the size of numpy unicode strings.
+    return np.array([v.encode() for v in values], dtype=bytes)
+
+
+class FramePaths(object):
+    """
+    The image paths of ava_helper.load_image_lists as a sequence of videos,
+    each a sequence of the paths of its frames, read from the index.
+    """
+
+    def __init__(self, frame_dir, paths, offsets):
+        self._frame_dir = frame_dir
+        self._paths = paths
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, video_idx):
+        if not 0 <= video_idx < len(self):
+            raise IndexError(video_idx)
+        return _VideoFramePaths(self, video_idx)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class _VideoFramePaths(object):
+    def __init__(self, frame_paths, video_idx):
+        self._frame_paths = frame_paths
+        self._start = int(frame_paths._offsets[video_idx])
+        self._len = int(frame_paths._offsets[video_idx + 1]) - self._start
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError(i)
+        path = self._frame_paths._paths[self._start + i].decode()
+        return os.path.join(self._frame_paths._frame_dir, path)
+
+    def __iter__(self):
+        return (self[i] for i in range(self._len))
+
+
+class KeyframeBoxes(object):
+    """
+    The keyframe boxes and labels of ava_helper.get_keyframe_data, indexed by
+    video_idx and sec_idx, read from the index. Every lookup returns new
+    lists of [box_i, box_i_labels].
+    """
+
+    def __init__(self, arrays):
+        self._video_offsets = arrays["video_keyframe_offset"]
+        self._box_offsets = arrays["box_offset"]
+        self._boxes = arrays["boxes"]
+        self._label_offsets = arrays["label_offset"]
+        self._labels = arrays["labels"]
+
+    def __len__(self):
+        return len(self._video_offsets) - 1
+
+    def __getitem__(self, video_idx):
+        if not 0 <= video_idx < len(self):
+            raise IndexError(video_idx)
+        return _VideoKeyframeBoxes(self, video_idx)
+
+
+class _VideoKeyframeBoxes(object):
+    def __init__(self, keyframe_boxes, video_idx):
+        self._keyframe_boxes = keyframe_boxes
+        self._start = int(keyframe_boxes._video_offsets[video_idx])
+        self._len = int(keyframe_boxes._video_offsets[video_idx + 1]) - self._start
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, sec_idx):
+        if not 0 <= sec_idx < self._len:
+            raise IndexError(sec_idx)
+        kb = self._keyframe_boxes
+        k = self._start + sec_idx
+        b0, b1 = int(kb._box_offsets[k]), int(kb._box_offsets[k + 1])
+        l0, l1 = int(kb._label_offsets[b0]), int(kb._label_offsets[b1])
+        boxes = kb._boxes[b0:b1].tolist()
+        labels = kb._labels[l0:l1].tolist()
+        offsets = (kb._label_offsets[b0:b1 + 1] - l0).tolist()
+        return [
+            [box, labels[offsets[i]:offsets[i + 1]]]
+            for i, box in enumerate(boxes)
+        ]
+
+
+def _frame_list_files(cfg, is_train):
+    return [
+        os.path.join(cfg.AVA.FRAME_LIST_DIR, filename)
+        for filename in (cfg.AVA.TRAIN_LISTS if is_train else cfg.AVA.TEST_LISTS)
+    ]
+
+
+def _frame_index(cfg, is_train):
+    def build():
+        # The paths relative to FRAME_DIR, which is joined on lookup.
+        list_cfg = cfg.clone()
+        list_cfg.defrost()
+        list_cfg.AVA.FRAME_DIR = ""
+        image_paths, video_idx_to_name = ava_helper.load_image_lists(
+            list_cfg, is_train
+        )
+        return {
+            "videos": _strings(video_idx_to_name),
+            "frame_offset": _offsets([len(p) for p in image_paths]),
+            "frame_paths": _strings([p for paths in image_paths for p in paths]),
+        }
+
+    return _open_index(cfg, "frames", _frame_list_files(cfg, is_train), [], build)
+
+
+def load_image_lists(cfg, is_train):
+    """
+    ava_helper.load_image_lists from the index.
+
+    Args:
+        cfg (CfgNode): config.
+        is_train (bool): if it is training dataset or not.
+
+    Returns:
+        image_paths (FramePaths): the paths of the images of every video.
+        video_idx_to_name (list): a list which stores video names.
+    """
+    arrays = _frame_index(cfg, is_train)
+    image_paths = FramePaths(
+        cfg.AVA.FRAME_DIR, arrays["frame_paths"], arrays["frame_offset"]
+    )
+    video_idx_to_name = [v.decode() for v in arrays["videos"].tolist()]
+    return image_paths, video_idx_to_name
+
+
+def load_annotations(cfg, split):
+    """
+    The frame paths and keyframes an Ava dataset of `split` loads in
+    _load_data, from the index.
+
+    Args:
+        cfg (CfgNode): config.
+        split (str): 'train', 'val', or 'test' mode.
+
+    Returns:
+        image_paths (FramePaths): the paths of the images of every video.
+        video_idx_to_name (list): a list which stores video names.
+        keyframe_indices (list): [video_idx, sec_idx, sec, frame_index] of
+            every keyframe.
+        keyframe_boxes_and_labels (KeyframeBoxes): the boxes and labels of
+            the keyframes by video_idx and sec_idx.
+        num_boxes_used (int): total number of boxes of the keyframes.
+    """
+    is_train = split == "train"
+    image_paths, video_idx_to_name = load_image_lists(cfg, is_train)
+
+    if cfg.TRAIN.USE_SLOWFAST:
+        gt_filename = cfg.AVA.TRAIN_GT_BOX_LISTS if is_train else cfg.AVA.TEST_PREDICT_BOX_LISTS
+    else:
+        gt_filename = cfg.AVA.TRAIN_GT_BOX_LISTS if is_train else cfg.AVA.VAL_GT_BOX_LISTS
+    exclusion_file = cfg.AVA.TRAIN_EXCLUSION_FILE if is_train else cfg.AVA.EXCLUSION_FILE
+    files = _frame_list_files(cfg, is_train) + [
+        os.path.join(cfg.AVA.ANNOTATION_DIR, gt_filename[0]),
+        os.path.join(cfg.AVA.ANNOTATION_DIR, exclusion_file) if exclusion_file else "",
+    ]
+    settings = [
+        split,
+        cfg.TRAIN.USE_SLOWFAST,
+        cfg.AVA.DETECTION_SCORE_THRESH,
+        cfg.AVA.FULL_TEST_ON_VAL,
+    ]
+
+    def build():
+        boxes_and_labels = ava_helper.load_boxes_and_labels(cfg, mode=split)
+        assert len(boxes_and_labels) == len(image_paths)
+        boxes_and_labels = [
+            boxes_and_labels[video_idx_to_name[i]]
+            for i in range(len(image_paths))
+        ]
+        keyframe_indices, keyframe_boxes_and_labels = ava_helper.get_keyframe_data(
+            boxes_and_labels
+        )
+        keyframe_boxes = [
+            box_labels
+            for video in keyframe_boxes_and_labels
+            for sec in video
+            for box_labels in sec
+        ]
+        return {
+            "keyframes": np.array(keyframe_indices, dtype=np.int64).reshape(-1, 4),
+            "video_keyframe_offset": _offsets([len(v) for v in keyframe_boxes_and_labels]),
+            "box_offset": _offsets(
+                [len(sec) for video in keyframe_boxes_and_labels for sec in video]
+            ),
+            "boxes": np.array(
+                [b[0] for b in keyframe_boxes], dtype=np.float64
+            ).reshape(-1, 4),
+            "label_offset": _offsets([len(b[1]) for b in keyframe_boxes]),
+            "labels": np.array(
+                [l for b in keyframe_boxes for l in b[1]], dtype=np.int64
+            ),
+        }
+
+    arrays = _open_index(cfg, "keyframes", files, settings, build)
+    keyframe_indices = [tuple(k) for k in arrays["keyframes"].tolist()]
+    num_boxes_used = int(arrays["box_offset"][-1])
+    logger.info("%d keyframes used." % len(keyframe_indices))
+    return (
+        image_paths,
+        video_idx_to_name,
+        keyframe_indices,
+        KeyframeBoxes(arrays),
+        num_boxes_used,
+    )
+
+
+def load_groundtruth(cfg):
+    """
+    The labelmap, exclusions and ground truth AVAMeter evaluates with, from
+    the index. They are kept for the lifetime of the process and must not
+    be modified.
+
+    Args:
+        cfg (CfgNode): config.
+
+    Returns:
+        categories (list): the categories of read_labelmap.
+        class_whitelist (set): the class ids of read_labelmap.
+        excluded_keys (set): the image keys of read_exclusions.
+        groundtruth (tuple): boxes, labels and scores of read_csv.
+    """
+    labelmap_file = os.path.join(cfg.AVA.ANNOTATION_DIR, cfg.AVA.LABEL_MAP_FILE)
+    exclusion_file = os.path.join(cfg.AVA.ANNOTATION_DIR, cfg.AVA.EXCLUSION_FILE)
+    gt_file = os.path.join(cfg.AVA.ANNOTATION_DIR, cfg.AVA.GROUNDTRUTH_FILE)
+    memo = (labelmap_file, exclusion_file, gt_file)
+    if memo in _GROUNDTRUTH:
+        return _GROUNDTRUTH[memo]
+
+    # The labelmap is a few lines, it is read every time.
+    categories, class_whitelist = read_labelmap(labelmap_file)
+
+    def build():
+        boxes, labels, scores = read_csv(gt_file, class_whitelist)
+        keys = list(boxes.keys())
+        return {
+            "keys": _strings(keys),
+            "offset": _offsets([len(boxes[k]) for k in keys]),
+            "boxes": np.array(
+                [b for k in keys for b in boxes[k]], dtype=np.float64
+            ).reshape(-1, 4),
+            "labels": np.array([l for k in keys for l in labels[k]], dtype=np.int64),
+            "scores": np.array([s for k in keys for s in scores[k]], dtype=np.float64),
+            "excluded": _strings(sorted(read_exclusions(exclusion_file))),
+        }
+
+    arrays = _open_index(
+        cfg,
+        "groundtruth",
+        [labelmap_file, exclusion_file, gt_file],
+        [],
+        build,
+    )
+    keys = [k.decode() for k in arrays["keys"].tolist()]
+    offsets = arrays["offset"].tolist()
+    all_boxes = arrays["boxes"].tolist()
+    all_labels = arrays["labels"].tolist()
+    all_scores = arrays["scores"].tolist()
+    groundtruth = (defaultdict(list), defaultdict(list), defaultdict(list))
+    for i, key in enumerate(keys):
+        s, e = offsets[i], offsets[i + 1]
+        groundtruth[0][key] = all_boxes[s:e]
+        groundtruth[1][key] = all_labels[s:e]
+        groundtruth[2][key] = all_scores[s:e]
+    excluded_keys = set(k.decode() for k in arrays["excluded"].tolist())
+
+    _GROUNDTRUTH[memo] = (categories, class_whitelist, excluded_keys, groundtruth)
+    return _GROUNDTRUTH[memo]
+
+
+if __name__ == "__main__":
+    from cfg import defaults
+
+    parser = argparse.ArgumentParser(description="Build the AVA annotation indexes")
+    parser.add_argument("--cfg", required=True, help="config file of the AVA runs")
+    parser.add_argument("opts", nargs=argparse.REMAINDER, help="options overriding the config, e.g. AVA.INDEX_DIR")
+    args = parser.parse_args()
+    cfg = defaults.get_cfg()
+    cfg.merge_from_file(args.cfg)
+    cfg.merge_from_list(args.opts)
+    assert cfg.AVA.INDEX_DIR, "AVA.INDEX_DIR is not set"
+    logging.basicConfig(level=logging.INFO)
+    for split in ["train", "val"]:
+        load_annotations(cfg, split)
+    load_groundtruth(cfg)
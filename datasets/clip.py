@@ -1,10 +1,14 @@
 #!/usr/bin/python
 # encoding: utf-8
 import os
+import math
+import time
 import torch
+import torch.nn.functional as F
 from PIL import Image
 import numpy as np
 from core.utils import *
+from datasets.dataset_utils import load_frames
 import cv2
 
 
@@ -46,18 +50,16 @@ def random_distort_image(im, dhue, dsat, dexp):
     res = distort_image(im, dhue, dsat, dexp)
     return res
 
-def data_augmentation(clip, shape, jitter, hue, saturation, exposure):
-    # Initialize Random Variables
-    oh = clip[0].height  
-    ow = clip[0].width
-    
+def augmentation_params(ow, oh, jitter, hue, saturation, exposure):
+    # random parameters of the augmentation of one clip of ow x oh frames, the crop box,
+    # flip and hue/saturation/exposure changes and the box transform of fill_truth_detection
     dw =int(ow*jitter)
     dh =int(oh*jitter)
 
-    pleft  = torch.randint(-dw, dw, (1,))
-    pright = torch.randint(-dw, dw, (1,))
-    ptop   = torch.randint(-dh, dh, (1,))
-    pbot   = torch.randint(-dh, dh, (1,))
+    pleft  = int(torch.randint(-dw, dw, (1,)))
+    pright = int(torch.randint(-dw, dw, (1,)))
+    ptop   = int(torch.randint(-dh, dh, (1,)))
+    pbot   = int(torch.randint(-dh, dh, (1,)))
 
     swidth =  ow - pleft - pright
     sheight = oh - ptop - pbot
@@ -68,11 +70,21 @@ def data_augmentation(clip, shape, jitter, hue, saturation, exposure):
     dx = (float(pleft)/ow)/sx
     dy = (float(ptop) /oh)/sy
 
-    flip = torch.randint(1,10000, (1,))%2
+    flip = int(torch.randint(1,10000, (1,))%2)
+
+    dhue = float(torch.rand(1)*2*hue - hue)
+    dsat = float(rand_scale(saturation))
+    dexp = float(rand_scale(exposure))
+
+    return {'pleft': pleft, 'ptop': ptop, 'swidth': swidth, 'sheight': sheight, 'flip': flip,
+            'dhue': dhue, 'dsat': dsat, 'dexp': dexp, 'dx': dx, 'dy': dy, 'sx': sx, 'sy': sy}
 
-    dhue = torch.rand(1)*2*hue - hue
-    dsat = rand_scale(saturation)
-    dexp = rand_scale(exposure)
+def data_augmentation(clip, shape, jitter, hue, saturation, exposure):
+    # Initialize Random Variables
+    p = augmentation_params(clip[0].width, clip[0].height, jitter, hue, saturation, exposure)
+    pleft, ptop, swidth, sheight = p['pleft'], p['ptop'], p['swidth'], p['sheight']
+    flip, dhue, dsat, dexp = p['flip'], p['dhue'], p['dsat'], p['dexp']
+    dx, dy, sx, sy = p['dx'], p['dy'], p['sx'], p['sy']
 
     # Augment
     cropped = [img.crop((float(pleft), float(ptop), float(pleft + swidth - 1), float(ptop + sheight - 1))) for img in clip]
@@ -86,15 +98,115 @@ def data_augmentation(clip, shape, jitter, hue, saturation, exposure):
     
     return clip, flip, dx, dy, sx, sy 
 
+def _crop_frames(frames, left, top, width, height):
+    # Image.crop of frames [T, H, W, C], the parts of the box outside the frames are black
+    T, H, W, C = frames.shape
+    if left >= 0 and top >= 0 and left + width <= W and top + height <= H:
+        return frames[:, top:top+height, left:left+width]
+    out = frames.new_zeros((T, height, width, C))
+    x0, y0, x1, y1 = max(left, 0), max(top, 0), min(left + width, W), min(top + height, H)
+    if x1 > x0 and y1 > y0:
+        out[:, y0-top:y1-top, x0-left:x1-left] = frames[:, y0:y1, x0:x1]
+    return out
+
+def _pil_hue(rgb):
+    # hue of PIL's RGB -> HSV conversion of the colours [N, 3], the float and double steps of its
+    # C code are reproduced so that every colour gets the same value
+    x = rgb.float()
+    r, g, b = x.unbind(-1)
+    maxc = x.amax(-1)
+    cr = maxc - x.amin(-1)
+    gray = cr == 0
+    cr = torch.where(gray, torch.ones_like(cr), cr)
+    rc = ((maxc - r) / cr).double()
+    gc = ((maxc - g) / cr).double()
+    bc = ((maxc - b) / cr).double()
+    h = torch.where(r == maxc, (bc - gc).float().double(), torch.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc)).float().double()
+    h = torch.remainder(h / 6.0 + 1.0, 1.0).float().double()
+    return torch.where(gray, torch.zeros_like(h), h * 255.0).long().clamp(0, 255)
+
+_HSV_TABLES = {}
+
+def _hsv_tables(device):
+    # lookup tables of the HSV conversions of PIL, built once on the CPU (~2 s, 17 MB) and copied to
+    # other devices: the hue of every RGB colour, the saturation of every (max, min) pair, and for the
+    # way back the factor of v in r, g and b for every (hue, saturation), r = floor(v * factor + 0.5)
+    # like PIL. build_hsv_tables builds them before the data loader workers fork
+    device = torch.device(device)
+    if device not in _HSV_TABLES and device.type != 'cpu':
+        _HSV_TABLES[device] = {k: v.to(device) for k, v in _hsv_tables('cpu').items()}
+    if device not in _HSV_TABLES:
+        colors = torch.arange(256**3, dtype=torch.int32)
+        hue = torch.cat([_pil_hue(torch.stack([c >> 16, (c >> 8) & 255, c & 255], -1)) for c in colors.split(2**20)])
+        m = torch.arange(256).float()
+        maxc, minc = m.view(-1, 1), m.view(1, -1)
+        sat = torch.where(maxc > minc, ((maxc - minc) / maxc.clamp(min=1)).double() * 255.0, torch.zeros((), dtype=torch.float64))
+        hf = m * 6.0 / 255.0
+        sector = torch.floor(hf)
+        f = (hf - sector).view(-1, 1)
+        fs = m / 255.0
+        # factors of p, q, t and v, and which of them r, g and b take in the six hue sectors
+        pqtv = torch.stack([(1.0 - fs).expand(256, 256), 1.0 - fs * f, 1.0 - fs * (1.0 - f), torch.ones(256, 256)], 0)
+        order = torch.tensor([[3, 2, 0], [1, 3, 0], [0, 3, 2], [0, 1, 3], [2, 0, 3], [3, 0, 1]])[sector.long() % 6]
+        factor = pqtv.gather(0, order.t().unsqueeze(-1).expand(3, 256, 256)).reshape(3, -1)
+        _HSV_TABLES[device] = {'hue': hue.to(torch.uint8), 'sat': sat.int().clamp(0, 255).view(-1), 'factor': factor}
+    return _HSV_TABLES[device]
+
+def build_hsv_tables():
+    # the CPU tables of augment_clip in this process, data loader workers forked from it share
+    # their memory instead of building their own every time they start
+    _hsv_tables('cpu')
+
+def _distort_luts(dhue, dsat, dexp, device):
+    # the Image.point tables of distort_image, rounded and clipped to 0..255 like PIL
+    x = torch.arange(256, dtype=torch.float64, device=device)
+    h = x + dhue*255
+    h = torch.where(h > 255, h - 255, torch.where(h < 0, h + 255, h))
+    return [torch.round(lut).clamp(0, 255).int() for lut in [h, x * dsat, x * dexp]]
+
+def _distort_frames(rgb, dhue, dsat, dexp):
+    # distort_image of uint8 frames [..., 3]: HSV conversion, the three point tables and the way
+    # back, all as table lookups, the same pixels as PIL
+    tab = _hsv_tables(rgb.device)
+    lut_h, lut_s, lut_v = _distort_luts(dhue, dsat, dexp, rgb.device)
+    r, g, b = [c.reshape(-1).int() for c in rgb.unbind(-1)]
+    maxc = torch.maximum(torch.maximum(r, g), b)
+    minc = torch.minimum(torch.minimum(r, g), b)
+    hs = (lut_h * 256).index_select(0, tab['hue'].index_select(0, (r << 16) | (g << 8) | b).int()) + \
+         lut_s.index_select(0, tab['sat'].index_select(0, maxc * 256 + minc))
+    v = lut_v.float().index_select(0, maxc)
+    out = torch.empty((v.numel(), 3), dtype=torch.uint8, device=rgb.device)
+    for c in range(3):
+        out[:, c] = torch.floor(v * tab['factor'][c].index_select(0, hs) + 0.5)
+    return out.view(rgb.shape)
+
+def augment_clip(frames, shape, params):
+    # data_augmentation of a whole clip at once, frames is a uint8 tensor [T, H, W, C] on any device and
+    # params come from augmentation_params. Crop, flip and the HSV changes give the same pixels as
+    # the PIL version, torch's antialiased bicubic resize differs from PIL's by rounding in a few
+    # pixels. Returns uint8 [T, shape[1], shape[0], C].
+    p = params
+    x = _crop_frames(frames, p['pleft'], p['ptop'], p['swidth'] - 1, p['sheight'] - 1)
+    x = x.permute(0, 3, 1, 2)
+    if x.device.type == 'cpu': # the uint8 kernel follows PIL's resampling
+        x = F.interpolate(x, size=(shape[1], shape[0]), mode='bicubic', align_corners=False, antialias=True)
+    else:
+        x = F.interpolate(x.float(), size=(shape[1], shape[0]), mode='bicubic', align_corners=False, antialias=True)
+        x = x.round().clamp(0, 255).to(torch.uint8)
+    x = x.permute(0, 2, 3, 1)
+    if p['flip']:
+        x = x.flip(2)
+    return _distort_frames(x, p['dhue'], p['dsat'], p['dexp'])
+
 # this function works for obtaining new labels after data augumentation
-def fill_truth_detection(labpath, w, h, flip, dx, dy, sx, sy):
+def fill_truth_detection(labpath, w, h, flip, dx, dy, sx, sy, truths=None):
+    # truths: rows of the label file when they are known already, e.g. from datasets.manifest
     max_boxes = 50
     label = np.zeros((max_boxes,5))
-    if os.path.getsize(labpath):
-        bs = np.loadtxt(labpath)
-        if bs is None:
-            return label
-        bs = np.reshape(bs, (-1, 5))
+    if truths is None:
+        truths = np.loadtxt(labpath) if os.path.getsize(labpath) else np.zeros((0, 5))
+    if truths.size:
+        bs = np.reshape(truths, (-1, 5))
 
         for i in range(bs.shape[0]):
             cx = (bs[i][1] + bs[i][3]) / (2 * 320)
@@ -137,28 +249,76 @@ def fill_truth_detection(labpath, w, h, flip, dx, dy, sx, sy):
     label = np.reshape(label, (-1))
     return label
 
-def load_data_detection(base_path, imgpath, train, train_dur, sampling_rate, shape, dataset_use='ucf24', jitter=0.2, hue=0.1, saturation=1.5, exposure=1.5):
+def open_frame(path, draft_size=None):
+    # a frame as RGB PIL image, with draft_size (w, h) JPEGs are decoded at the smallest DCT scale
+    # (1/2, 1/4 or 1/8) that still covers it, other formats at full size. info['source_size'] is
+    # the (w, h) of the frame on disk
+    with Image.open(path) as img:
+        size = img.size
+        if draft_size is not None:
+            img.draft('RGB', draft_size)
+        frame = img.convert('RGB')
+    frame.info['source_size'] = size
+    return frame
+
+def draft_size(shape, jitter=0.):
+    # decode size for frames that are resized to shape, after a crop of up to 2 * jitter of each side
+    return tuple(int(math.ceil(s / (1 - 2 * jitter))) for s in shape)
+
+def manifest_truths(manifest, video, frame_index, train=False):
+    # label rows of a frame from a datasets.manifest.DatasetManifest, empty for test frames without a label file,
+    # None without a manifest so that the label file is read. A training frame without a label file is an
+    # error, like np.loadtxt of the file in fill_truth_detection
+    if manifest is None:
+        return None
+    truths = manifest.truths(video, frame_index)
+    if truths is None and train:
+        raise FileNotFoundError('training frame %s/%05d has no label file in the manifest' % (video, frame_index))
+    return truths if truths is not None else np.array([])
+
+
+def num_frame_files(base_path, video, frame_store=None, manifest=None):
+    # number of files in the frame folder of a video, from a manifest or the index of a packed store if there is one
+    if manifest is not None:
+        return manifest.num_frame_files(video)
+    if frame_store is not None:
+        return frame_store.num_files(video)
+    return len(os.listdir(os.path.join(base_path, 'rgb-images', video)))
+
+def load_data_detection(base_path, imgpath, train, train_dur, sampling_rate, shape, dataset_use='ucf24', jitter=0.2, hue=0.1, saturation=1.5, exposure=1.5, frame_cache=None, frame_store=None, manifest=None, tensor_augmentation=False,
+                        reduced_decode=False, decode_threads=0):
     # clip loading and  data augmentation
+    # frame_cache: optional datasets.frame_cache.FrameCache of the decoded frames
+    # frame_store: optional datasets.frame_store.FrameStore, frames are sliced out of its arrays instead of
+    #              decoded, test clips come from the variant resized to shape when the store has it
+    # manifest:    optional datasets.manifest.DatasetManifest with the frame counts and label rows
+    # tensor_augmentation: training clips are augmented by augment_clip and returned as one uint8 tensor [T, H, W, C]
+    # reduced_decode: JPEG frames are decoded at the smallest DCT scale that covers shape (after the crop in training)
+    # decode_threads: the frames are decoded concurrently on this many threads (datasets.dataset_utils.load_frames)
 
     im_split = imgpath.split('/')
     num_parts = len(im_split)
     im_ind = int(im_split[num_parts-1][0:5])
     labpath = os.path.join(base_path, 'labels', im_split[0], im_split[1] ,'{:05d}.txt'.format(im_ind))
 
-    img_folder = os.path.join(base_path, 'rgb-images', im_split[0], im_split[1])
+    video = im_split[0] + '/' + im_split[1]
     if dataset_use == 'ucf24':
-        max_num = len(os.listdir(img_folder))
+        max_num = num_frame_files(base_path, video, frame_store, manifest)
     elif dataset_use == 'jhmdb21':
-        max_num = len(os.listdir(img_folder)) - 1
+        max_num = num_frame_files(base_path, video, frame_store, manifest) - 1
+    truths = manifest_truths(manifest, video, im_ind, train)
+    resized = frame_store is not None and not train and frame_store.has_size(shape)
+    as_array = train and tensor_augmentation
+    decode_size = draft_size(shape, jitter if train else 0.) if reduced_decode else None
 
-    clip = []
+    keys, loads = [], []
 
     ### We change downsampling rate throughout training as a       ###
     ### temporal augmentation, which brings around 1-2 frame       ###
     ### mAP. During test time it is set to cfg.DATA.SAMPLING_RATE. ###
     d = sampling_rate
-    if train:
-        d = torch.randint(1, 3, (1,))
+    if train: # a python int, the frame indices key the frame cache
+        d = int(torch.randint(1, 3, (1,)))
 
     for i in reversed(range(train_dur)):
         # make it as a loop
@@ -173,17 +333,46 @@ def load_data_detection(base_path, imgpath, train, train_dur, sampling_rate, sha
         elif dataset_use == 'jhmdb21':
             path_tmp = os.path.join(base_path, 'rgb-images', im_split[0], im_split[1] ,'{:05d}.png'.format(i_temp))
 
-        clip.append(Image.open(path_tmp).convert('RGB'))
+        if resized:
+            load = lambda i=i_temp: Image.fromarray(frame_store.frames(video, shape[0])[i - 1])
+        elif frame_store is not None and as_array:
+            load = lambda i=i_temp: frame_store.frames(video)[i - 1]
+        elif frame_store is not None:
+            load = lambda i=i_temp: frame_store.image(video, i)
+        else:
+            load = lambda path=path_tmp: open_frame(path, decode_size)
+        keys.append((video, i_temp))
+        loads.append(load)
+
+    load_all = lambda loads: load_frames(lambda load: load(), loads, decode_threads)
+    if frame_cache is not None: # the augmentation below makes new images, cached frames are not modified
+        clip = frame_cache.get_all(keys, loads, load_all)
+    else:
+        clip = load_all(loads)
 
-    if train: # Apply augmentation
+    if as_array: # Apply augmentation to the stacked clip
+        frames = torch.from_numpy(np.stack([np.asarray(img) for img in clip]))
+        p = augmentation_params(frames.shape[2], frames.shape[1], jitter, hue, saturation, exposure)
+        clip = augment_clip(frames, shape, p)
+        label = fill_truth_detection(labpath, shape[0], shape[1], p['flip'], p['dx'], p['dy'], 1./p['sx'], 1./p['sy'], truths)
+        label = torch.from_numpy(label)
+
+    elif train: # Apply augmentation
         clip,flip,dx,dy,sx,sy = data_augmentation(clip, shape, jitter, hue, saturation, exposure)
-        label = fill_truth_detection(labpath, clip[0].width, clip[0].height, flip, dx, dy, 1./sx, 1./sy)
+        label = fill_truth_detection(labpath, clip[0].width, clip[0].height, flip, dx, dy, 1./sx, 1./sy, truths)
         label = torch.from_numpy(label)
 
     else: # No augmentation
+        # size of the frames on disk
+        if resized:
+            width = frame_store.videos[video]['width']
+        elif decode_size is not None and frame_store is None:
+            width = clip[-1].info['source_size'][0]
+        else:
+            width = clip[0].width
         label = torch.zeros(50*5)
         try:
-            tmp = torch.from_numpy(read_truths_args(labpath, 8.0/clip[0].width).astype('float32'))
+            tmp = torch.from_numpy(read_truths_args(labpath, 8.0/width, truths).astype('float32'))
         except Exception:
             tmp = torch.zeros(1,5)
 
@@ -200,6 +389,15 @@ def load_data_detection(base_path, imgpath, train, train_dur, sampling_rate, sha
     else:
         return im_split[0] + '_' +im_split[1] + '_' + im_split[2], clip, label
 
+def sliding_clips(frames, train_dur, sampling_rate):
+    # clips of every frame of a video [T, C, H, W] as one strided view [T, C, train_dur, H, W],
+    # clip t holds frames t - i*sampling_rate, clamped to the first frame like load_data_detection.
+    # Only the video is copied once to prepend the clamped frames, the clips share its memory.
+    span = (train_dur - 1) * sampling_rate + 1
+    pad = frames[:1].expand((span - 1,) + tuple(frames.shape[1:]))
+    padded = torch.cat([pad, frames], 0)
+    return padded.unfold(0, span, 1)[..., ::sampling_rate].permute(0, 1, 4, 2, 3)
+
 def load_data_detection_test(root, imgpath, train_dur, num_samples):
 
     clip,label = get_clip(root, imgpath, train_dur, num_samples)
@@ -244,3 +442,66 @@ def get_clip(root, imgpath, train_dur, num_samples):
         label[0:tsz] = tmp
 
     return clip, label
+
+def benchmark_augmentation(num_frames=25, size=(320, 240), shape=(224, 224), clips=10):
+    # clips per second of data_augmentation on PIL frames against augment_clip on the CPU (and the GPU),
+    # and how far the outputs of both are apart for the same random parameters
+    g = torch.Generator().manual_seed(0)
+    small = torch.randint(0, 256, (num_frames, 3, size[1] // 8, size[0] // 8), generator=g).float()
+    frames = F.interpolate(small, size=(size[1], size[0]), mode='bilinear').round().to(torch.uint8).permute(0, 2, 3, 1).contiguous()
+    images = [Image.fromarray(f) for f in frames.numpy()]
+    devices = [torch.device('cpu')] + ([torch.device('cuda')] if torch.cuda.is_available() else [])
+
+    def run(augment, sync=lambda: None):
+        outputs = []
+        start = time.perf_counter()
+        for c in range(clips):
+            torch.manual_seed(c)
+            outputs.append(augment())
+        sync()
+        return clips / (time.perf_counter() - start), outputs
+
+    def pil_augment():
+        clip = data_augmentation(images, shape, 0.2, 0.1, 1.5, 1.5)[0]
+        return torch.from_numpy(np.stack([np.asarray(img) for img in clip]))
+
+    rate, reference = run(pil_augment)
+    logging('%-12s %8.1f clips/s' % ('PIL', rate))
+    ref = torch.stack(reference).float()
+    for device in devices:
+        x = frames.to(device)
+        augment = lambda: augment_clip(x, shape, augmentation_params(size[0], size[1], 0.2, 0.1, 1.5, 1.5))
+        sync = (lambda: torch.cuda.synchronize(device)) if device.type == 'cuda' else (lambda: None)
+        run(augment, sync) # warm up
+        rate, outputs = run(augment, sync)
+        out = torch.stack(outputs).float().cpu()
+        diff = (out - ref).abs()
+        logging('%-12s %8.1f clips/s   mean |diff| %.3f   pixels differing %.2f%%   mean %.2f/%.2f   std %.2f/%.2f' % (
+                'tensor ' + device.type, rate, diff.mean(), 100.0 * (diff > 0).float().mean(),
+                out.mean(), ref.mean(), out.std(), ref.std()))
+
+
+def test_frame_cache_hits(num_frames=30, train_dur=16):
+    # two neighbouring training clips of a small synthetic video share most of their frames,
+    # the second one has to find them in the frame cache
+    import tempfile
+    from datasets.frame_cache import FrameCache
+    with tempfile.TemporaryDirectory() as base:
+        folder = os.path.join(base, 'rgb-images', 'Basketball', 'v_test')
+        os.makedirs(folder)
+        os.makedirs(os.path.join(base, 'labels', 'Basketball', 'v_test'))
+        for i in range(1, num_frames + 1):
+            Image.fromarray(np.full((48, 64, 3), i, dtype=np.uint8)).save(os.path.join(folder, '{:05d}.jpg'.format(i)))
+            with open(os.path.join(base, 'labels', 'Basketball', 'v_test', '{:05d}.txt'.format(i)), 'w') as f:
+                f.write('1 10 10 40 30\n')
+        cache = FrameCache(4 * train_dur)
+        for im_ind in [num_frames - 1, num_frames]:
+            load_data_detection(base, 'Basketball/v_test/{:05d}.jpg'.format(im_ind), True, train_dur, 1, (32, 32), frame_cache=cache)
+    assert cache.hits > 0, 'no frame cache hits (%d misses)' % cache.misses
+    logging('frame cache: %d hits, %d misses' % (cache.hits, cache.misses))
+
+
+if __name__ == '__main__':
+    # python -m datasets.clip
+    test_frame_cache_hits()
+    benchmark_augmentation()
@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+import os
+import copy
+import json
+import time
+import random
+import hashlib
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+import core.distributed as du
+from core.utils import clip_to_float, logging
+
+
+"""
+Backbone feature store for fine-tuning cfam and conv_final on frozen backbones.
+
+The outputs of backbone_2d and backbone_3d are computed once per sample and view and kept in
+memory-mapped .npy files, training then streams them instead of decoding and running the clips.
+A view is either the training samples with the test-time transform (FEATURE_CACHE.AUG_SEEDS empty,
+the dataset's disable_augmentation) or the dataset augmentation replayed with a fixed seed per sample. The store lives in
+FEATURE_CACHE.DIR/<key>, the key hashes the backbone weights and everything that changes the
+inputs, so new weights or data settings build a new store.
+"""
+
+
+class SeededDataset(Dataset):
+    # replays the random augmentation of a dataset, sample idx of view `seed` always draws the same numbers
+
+    def __init__(self, dataset, seed):
+        self.dataset = dataset
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        s = (self.seed * 1000003 + idx) % 2**32
+        random.seed(s)
+        np.random.seed(s)
+        torch.manual_seed(s)
+        return self.dataset[idx]
+
+
+def _split_sample(item):
+    # clip and the fields that go with it, AVA samples are dicts and UCF24/JHMDB21 samples (.., clip, label)
+    if isinstance(item, dict):
+        return item['clip'], {k: v for k, v in item.items() if k != 'clip'}
+    return item[-2], {'label': item[-1]}
+
+
+def _as_numpy(v):
+    return v.cpu().numpy() if torch.is_tensor(v) else np.asarray(v)
+
+
+def feature_cache_key(cfg, model, dataset):
+    h = hashlib.sha1()
+    for module in [model.backbone_2d, model.backbone_3d]:
+        for name, t in sorted(module.state_dict().items()):
+            h.update(name.encode())
+            h.update(t.detach().cpu().contiguous().numpy().tobytes())
+    settings = [cfg.TRAIN.DATASET, cfg.MODEL.BACKBONE_2D, cfg.MODEL.BACKBONE_3D, cfg.DATA.NUM_FRAMES, cfg.DATA.SAMPLING_RATE,
+                cfg.DATA.TRAIN_CROP_SIZE, cfg.LISTDATA.TRAIN_FILE, list(cfg.FEATURE_CACHE.AUG_SEEDS) or 'test-transform',
+                cfg.FEATURE_CACHE.DTYPE, len(dataset)]
+    h.update(json.dumps(settings).encode())
+    return h.hexdigest()[:16]
+
+
+def test_transform_view(dataset):
+    # a copy of the training dataset that loads its samples without augmentation
+    view = copy.copy(dataset)
+    view.disable_augmentation()
+    return view
+
+
+@torch.no_grad()
+def _build_store(cfg, model, dataset, device, directory):
+    seeds = list(cfg.FEATURE_CACHE.AUG_SEEDS)
+    views = [SeededDataset(dataset, s) for s in seeds] if seeds else [test_transform_view(dataset)]
+    num_samples = len(dataset)
+    dtype = np.dtype(cfg.FEATURE_CACHE.DTYPE)
+    arrays = {}
+    dict_sample = False
+    os.makedirs(directory, exist_ok=True)
+
+    model.eval() # running statistics of the frozen backbones, like at test time
+    for v, view in enumerate(views):
+        loader = torch.utils.data.DataLoader(view, batch_size=cfg.TRAIN.BATCH_SIZE, shuffle=False,
+                                             num_workers=cfg.DATA_LOADER.NUM_WORKERS, pin_memory=True)
+        pos = 0
+        for batch in loader:
+            clip, fields = _split_sample(batch)
+            dict_sample = isinstance(batch, dict)
+            x_2d, x_3d = model.backbone_features(clip_to_float(clip.to(device, non_blocking=True), cfg))
+            outputs = {'x_2d': x_2d, 'x_3d': x_3d}
+            outputs.update(fields)
+            n = clip.size(0)
+            for name, value in outputs.items():
+                value = _as_numpy(value.float().cpu() if name in ['x_2d', 'x_3d'] else value)
+                if name not in arrays:
+                    field_dtype = dtype if name in ['x_2d', 'x_3d'] else value.dtype
+                    arrays[name] = np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+',
+                                                             dtype=field_dtype, shape=(len(views), num_samples) + value.shape[1:])
+                arrays[name][v, pos:pos+n] = value
+            pos += n
+            logging('feature cache view %d/%d: %d/%d samples' % (v+1, len(views), pos, num_samples))
+
+    for array in arrays.values():
+        array.flush()
+    meta = {'num_views': len(views), 'num_samples': num_samples, 'fields': sorted(k for k in arrays if k not in ['x_2d', 'x_3d']),
+            'dict_sample': dict_sample}
+    # written last, a store without meta.json is incomplete and rebuilt
+    with open(os.path.join(directory, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(directory, 'meta.json.tmp'), os.path.join(directory, 'meta.json'))
+
+
+class FeatureDataset(Dataset):
+    """
+    Samples of a feature store in the structure of the source dataset, with the clip replaced by
+    the backbone outputs (x_2d, x_3d). set_epoch picks the view every epoch trains on.
+    """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.directory = directory
+        self.view = 0
+        self._arrays = None # opened lazily, so every data loader worker maps the files itself
+
+    def _open(self):
+        names = ['x_2d', 'x_3d'] + self.meta['fields']
+        self._arrays = {n: np.load(os.path.join(self.directory, n + '.npy'), mmap_mode='r') for n in names}
+
+    def set_epoch(self, epoch):
+        self.view = epoch % self.meta['num_views']
+
+    def __len__(self):
+        return self.meta['num_samples']
+
+    def __getitem__(self, idx):
+        if self._arrays is None:
+            self._open()
+        a = self._arrays
+        features = (torch.from_numpy(np.array(a['x_2d'][self.view, idx], dtype=np.float32)),
+                    torch.from_numpy(np.array(a['x_3d'][self.view, idx], dtype=np.float32)))
+        fields = {n: torch.from_numpy(np.array(a[n][self.view, idx])) for n in self.meta['fields']}
+        if self.meta['dict_sample']:
+            fields['clip'] = features
+            return fields
+        return (features, fields['label'])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+
+def build_feature_cache(cfg, model, dataset, device):
+    # feature store of `dataset` for the backbones of `model`, built on the master process if missing
+    model = getattr(model, 'module', model)
+    key = feature_cache_key(cfg, model, dataset)
+    directory = os.path.join(cfg.FEATURE_CACHE.DIR, key)
+    meta_path = os.path.join(directory, 'meta.json')
+    if not os.path.exists(meta_path):
+        if du.is_master_proc():
+            logging('building backbone feature cache in %s' % directory)
+            training = model.training
+            _build_store(cfg, model, dataset, device, directory)
+            model.train(training)
+        else:
+            # a build can outlast the timeout of a collective, the other processes wait for meta.json
+            logging('waiting for the backbone feature cache in %s' % directory)
+            while not os.path.exists(meta_path):
+                time.sleep(10)
+    else:
+        logging('using backbone feature cache in %s' % directory)
+    return FeatureDataset(directory)
@@ -0,0 +1,103 @@
+import math
+import collections
+
+import torch
+from torch.utils.data import Sampler
+
+import core.distributed as du
+
+
+class FrameCache(object):
+    """
+    Size-bounded LRU cache of decoded frames, keyed by (video, frame index).
+
+    Training clips of neighbouring frames share all but a few frames, so a
+    data loader worker that gets them in one batch decodes most frames once.
+    Every worker holds its own copy of the dataset and so its own cache,
+    hits and misses count the lookups of that worker.
+    """
+
+    def __init__(self, max_frames):
+        self.max_frames = max_frames
+        self.frames = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        img = self.frames.get(key)
+        if img is not None:
+            self.frames.move_to_end(key)
+            self.hits += 1
+            return img
+        self.misses += 1
+        img = load()
+        self.frames[key] = img
+        if len(self.frames) > self.max_frames:
+            self.frames.popitem(last=False)
+        return img
+
+    def get_all(self, keys, loads, load_all):
+        # frames of keys, counted like get per key; the frames that are not cached are loaded
+        # together by load_all(their loads), e.g. on the decode threads
+        imgs = {}
+        for key in keys:
+            img = self.frames.get(key)
+            if img is not None and key not in imgs:
+                self.frames.move_to_end(key)
+                imgs[key] = img
+        missing = collections.OrderedDict((k, load) for k, load in zip(keys, loads) if k not in imgs)
+        for key, img in zip(missing, load_all(list(missing.values()))):
+            imgs[key] = img
+            self.frames[key] = img
+        while len(self.frames) > self.max_frames:
+            self.frames.popitem(last=False)
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+        return [imgs[k] for k in keys]
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+class ChunkShuffleSampler(Sampler):
+    """
+    Shuffles chunks of chunk_size consecutive samples instead of single samples. The
+    frame lists are ordered by video and frame, so the samples of a chunk share most of
+    their frames and hit the FrameCache of the worker that loads their batch. Chunks are
+    split over the processes like DistributedSampler, call set_epoch every epoch. A single
+    process reads every sample once, the last chunk may be short.
+    """
+
+    def __init__(self, dataset, chunk_size, shuffle=True, seed=0):
+        self.num_samples_total = len(dataset)
+        self.chunk_size = chunk_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.rank = du.get_rank()
+        self.world_size = du.get_world_size()
+        # with several processes the samples are padded by wrapping around, so that every process gets
+        # the same number of full chunks
+        self.chunks_per_rank = int(math.ceil(self.num_samples_total / (chunk_size * self.world_size)))
+        self.num_chunks = self.chunks_per_rank * self.world_size
+        self.pad = self.world_size > 1
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(self.num_chunks, generator=g).tolist()
+        else:
+            order = list(range(self.num_chunks))
+        end = self.num_chunks * self.chunk_size if self.pad else self.num_samples_total
+        for c in order[self.rank::self.world_size]:
+            for i in range(c * self.chunk_size, min((c + 1) * self.chunk_size, end)):
+                yield i % self.num_samples_total
+
+    def __len__(self):
+        if not self.pad:
+            return self.num_samples_total
+        return self.chunks_per_rank * self.chunk_size
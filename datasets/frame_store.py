@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+import os
+import json
+import argparse
+import multiprocessing
+
+import numpy as np
+from PIL import Image
+
+
+"""
+Packed frame store of UCF24/JHMDB21.
+
+Every video of rgb-images/<class>/<video>/<%05d>.jpg|png is packed into one uint8 array
+[T, H, W, 3] saved as <store>/<class>/<video>.npy, optionally with the frames resized like the
+test datasets do in <class>/<video>_<size>.npy. index.json lists the videos with their number of
+frames and files, the datasets open the arrays memory-mapped and slice the frames out of them.
+
+    python -m datasets.frame_store --base /path/to/ucf24 --dataset ucf24 --out /path/to/ucf24/packed --size 224
+
+Packing runs on --workers processes, one video at a time, and skips videos that are packed
+already, an interrupted run continues where it stopped.
+"""
+
+
+def _frame_ext(dataset):
+    return '.jpg' if dataset == 'ucf24' else '.png'
+
+
+def _video_path(out, video, size=None):
+    return os.path.join(out, video + ('_%d' % size if size else '') + '.npy')
+
+
+def _save_array(path, frames):
+    # write next to the target and rename, a packed file is always complete
+    tmp = path + '.tmp.npy'
+    array = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8, shape=(len(frames),) + frames[0].shape)
+    for i, f in enumerate(frames):
+        array[i] = f
+    array.flush()
+    del array
+    os.replace(tmp, path)
+
+
+def pack_video(args):
+    base_path, video, dataset, out, size = args
+    img_folder = os.path.join(base_path, 'rgb-images', video)
+    num_files = len(os.listdir(img_folder))
+    paths = [_video_path(out, video)] + ([_video_path(out, video, size)] if size else [])
+    if not all(os.path.exists(p) for p in paths):
+        ext = _frame_ext(dataset)
+        num_frames = len([n for n in os.listdir(img_folder) if n.endswith(ext)])
+        clip = [Image.open(os.path.join(img_folder, '{:05d}{}'.format(i, ext))).convert('RGB') for i in range(1, num_frames + 1)]
+        os.makedirs(os.path.dirname(paths[0]), exist_ok=True)
+        _save_array(paths[0], [np.asarray(img) for img in clip])
+        if size: # the same PIL resize as the test datasets
+            _save_array(paths[1], [np.asarray(img.resize((size, size))) for img in clip])
+    frames = np.load(paths[0], mmap_mode='r')
+    return video, {'num_frames': frames.shape[0], 'num_files': num_files, 'height': frames.shape[1], 'width': frames.shape[2]}
+
+
+def pack_dataset(base_path, dataset, out, size=None, workers=8):
+    root = os.path.join(base_path, 'rgb-images')
+    videos = sorted(os.path.join(c, v) for c in os.listdir(root) for v in os.listdir(os.path.join(root, c)))
+    index = {'sizes': [size] if size else [], 'videos': {}}
+    with multiprocessing.Pool(workers) as pool:
+        for n, (video, entry) in enumerate(pool.imap_unordered(pack_video, [(base_path, v, dataset, out, size) for v in videos])):
+            index['videos'][video] = entry
+            if n % 100 == 0:
+                print('packed %d/%d videos' % (n + 1, len(videos)))
+    with open(os.path.join(out, 'index.json.tmp'), 'w') as f:
+        json.dump(index, f)
+    os.replace(os.path.join(out, 'index.json.tmp'), os.path.join(out, 'index.json'))
+    print('packed %d videos to %s' % (len(videos), out))
+
+
+class FrameStore(object):
+    """
+    Read side of a packed store, frames(video) is the uint8 [T, H, W, 3] memmap of a video,
+    frames(video, size) the resized variant. The arrays are opened on first use in every
+    data loader worker and stay open.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'index.json')) as f:
+            index = json.load(f)
+        self.sizes = index['sizes']
+        self.videos = index['videos']
+        self._arrays = {}
+
+    def has_size(self, shape):
+        return shape is not None and shape[0] == shape[1] and shape[0] in self.sizes
+
+    def num_files(self, video):
+        # len(os.listdir) of the frame folder, the datasets derive the last frame index from it
+        return self.videos[video]['num_files']
+
+    def frames(self, video, size=None):
+        key = (video, size)
+        if key not in self._arrays:
+            self._arrays[key] = np.load(_video_path(self.root, video, size), mmap_mode='r')
+        return self._arrays[key]
+
+    def image(self, video, frame_index):
+        # frame <frame_index>, counted from 1, as the RGB PIL image the datasets decode
+        return Image.fromarray(self.frames(video)[frame_index - 1])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = {} # every worker maps the files itself
+        return state
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack the frames of UCF24/JHMDB21 into memory-mapped arrays')
+    parser.add_argument('--base', required=True, help='dataset root with rgb-images/')
+    parser.add_argument('--dataset', default='ucf24', choices=['ucf24', 'jhmdb21'])
+    parser.add_argument('--out', required=True, help='directory of the packed store, LISTDATA.FRAME_STORE')
+    parser.add_argument('--size', type=int, default=0, help='also store the frames resized to size x size, 0 for none')
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+    pack_dataset(args.base, args.dataset, args.out, args.size or None, args.workers)
@@ -10,7 +10,12 @@ import torch
 from torch.utils.data import Dataset
 from PIL import Image
 from codec.models import compress_video
+from core.utils import codec_device, logging
 from datasets.clip import *
+from datasets.dataset_utils import load_frames
+from datasets.frame_cache import FrameCache
+from datasets.frame_store import FrameStore
+from datasets.manifest import DatasetManifest
 
 
 class UCF_JHMDB_Dataset(Dataset):
@@ -18,7 +23,8 @@ class UCF_JHMDB_Dataset(Dataset):
     # clip duration = 8, i.e, for each time 8 frames are considered together
     def __init__(self, base, root, dataset='ucf24', shape=None,
                  transform=None, target_transform=None, 
-                 train=False, clip_duration=16, sampling_rate=1):
+                 train=False, clip_duration=16, sampling_rate=1, frame_cache_size=0, frame_store='', manifest='',
+                 tensor_augmentation=False, reduced_decode=False, decode_threads=0, uint8_clips=False):
         with open(root, 'r') as file:
             self.lines = file.readlines()
 
@@ -31,6 +37,23 @@ class UCF_JHMDB_Dataset(Dataset):
         self.shape = shape
         self.clip_duration = clip_duration + 9 
         self.sampling_rate = sampling_rate
+        # decoded frames of the last frame_cache_size lookups, every data loader worker fills its own copy
+        self.frame_cache = FrameCache(frame_cache_size) if frame_cache_size > 0 else None
+        self.clips_loaded = 0 # clips of this copy of the dataset, paces the frame cache log
+        # packed frames of datasets.frame_store in place of the image files
+        self.frame_store = FrameStore(frame_store) if frame_store else None
+        # frame counts and label rows of datasets.manifest in place of directory listings and label files
+        self.manifest = DatasetManifest(manifest) if manifest else None
+        # training clips augmented at once by datasets.clip.augment_clip instead of frame by frame in PIL
+        self.tensor_augmentation = tensor_augmentation
+        if train and tensor_augmentation:
+            build_hsv_tables()
+        # JPEG frames decoded at the smallest DCT scale that covers shape
+        self.reduced_decode = reduced_decode
+        # the frames of a clip decoded concurrently on this many threads of the worker
+        self.decode_threads = decode_threads
+        # uint8 clips in place of the ToTensor transform, core.utils.clip_to_float scales them on the device
+        self.uint8_clips = uint8_clips
 
     def __len__(self):
         return self.nSamples
@@ -45,17 +68,27 @@ class UCF_JHMDB_Dataset(Dataset):
             saturation = 1.5 
             exposure = 1.5
 
-            frame_idx, clip, label = load_data_detection(self.base_path, imgpath,  self.train, self.clip_duration, self.sampling_rate, self.shape, self.dataset, jitter, hue, saturation, exposure)
+            frame_idx, clip, label = load_data_detection(self.base_path, imgpath,  self.train, self.clip_duration, self.sampling_rate, self.shape, self.dataset, jitter, hue, saturation, exposure, self.frame_cache, self.frame_store, self.manifest, self.tensor_augmentation, self.reduced_decode, self.decode_threads)
 
         else: # For Testing
-            frame_idx, clip, label = load_data_detection(self.base_path, imgpath, False, self.clip_duration, self.sampling_rate, self.shape, self.dataset)
-            clip = [img.resize(self.shape) for img in clip]
+            frame_idx, clip, label = load_data_detection(self.base_path, imgpath, False, self.clip_duration, self.sampling_rate, self.shape, self.dataset, frame_cache=self.frame_cache, frame_store=self.frame_store, manifest=self.manifest, reduced_decode=self.reduced_decode, decode_threads=self.decode_threads)
+            clip = [img.resize(self.shape) for img in clip] # a copy for frames of the resized store
 
-        if self.transform is not None:
-            clip = [self.transform(img) for img in clip]
+        if self.frame_cache is not None:
+            self.log_frame_cache()
 
-        # (self.duration, -1) + self.shape = (8, -1, 224, 224)
-        clip = torch.cat(clip, 0).view((self.clip_duration, -1) + self.shape).permute(1, 0, 2, 3)
+        if self.uint8_clips:
+            if not torch.is_tensor(clip):
+                clip = torch.from_numpy(np.stack([np.asarray(img) for img in clip]))
+            clip = clip.permute(3, 0, 1, 2)
+        elif torch.is_tensor(clip): # uint8 [T, H, W, C] of the tensor augmentation, scaled like ToTensor
+            clip = clip.permute(3, 0, 1, 2).float().div(255)
+        else:
+            if self.transform is not None:
+                clip = [self.transform(img) for img in clip]
+
+            # (self.duration, -1) + self.shape = (8, -1, 224, 224)
+            clip = torch.cat(clip, 0).view((self.clip_duration, -1) + self.shape).permute(1, 0, 2, 3)
 
         if self.target_transform is not None:
             label = self.target_transform(label)
@@ -64,13 +97,98 @@ class UCF_JHMDB_Dataset(Dataset):
             return (frame_idx, clip, label)
         else:
             return (frame_idx, clip, label)
+
+    def log_frame_cache(self, every=100):
+        # hit rate of the frame cache every `every` clips, logged by worker 0 (or the main process
+        # without workers) only, the workers get the same kind of samples from the sampler
+        self.clips_loaded += 1
+        worker = torch.utils.data.get_worker_info()
+        if (worker is None or worker.id == 0) and self.clips_loaded % every == 0:
+            logging('frame cache of worker 0: %d hits, %d misses, hit rate %.1f%%' % (
+                    self.frame_cache.hits, self.frame_cache.misses, 100.0 * self.frame_cache.hit_rate()))
+
+    def disable_augmentation(self):
+        # clips of this list are loaded like test clips, for the un-augmented view of datasets.feature_cache
+        self.train = False
             
+class UCF_JHMDB_VideoDataset(Dataset):
+    """
+    Test videos of UCF24/JHMDB21 as a whole, for the video mAP evaluation. Every frame is
+    decoded and resized once, datasets.clip.sliding_clips builds the clips of all frames from
+    the returned [T, C, H, W] frames, the same clips as UCF_JHMDB_Dataset in test mode.
+    Returns (frames, labels [N, 250], frame indices [N], frame names) for the N frames of the video.
+    """
+
+    def __init__(self, base, videos, dataset='ucf24', shape=None, transform=None, frame_store='', manifest='',
+                 reduced_decode=False, decode_threads=0, uint8_clips=False):
+        self.base_path = base
+        self.videos = [v.rstrip() for v in videos]
+        self.dataset = dataset
+        self.shape = shape
+        self.transform = transform
+        self.ext = '.jpg' if dataset == 'ucf24' else '.png'
+        self.frame_store = FrameStore(frame_store) if frame_store else None
+        self.manifest = DatasetManifest(manifest) if manifest else None
+        self.reduced_decode = reduced_decode # JPEG frames decoded at the smallest DCT scale that covers shape
+        self.decode_threads = decode_threads # the frames of a video decoded concurrently on this many threads
+        self.uint8_clips = uint8_clips # uint8 frames in place of the ToTensor transform, see core.utils.clip_to_float
+
+    def __len__(self):
+        return len(self.videos)
+
+    def __getitem__(self, index):
+        video = self.videos[index]
+        img_folder = os.path.join(self.base_path, 'rgb-images', video)
+        store = self.frame_store
+        if self.manifest is not None: # frames are numbered 1..num_frames
+            names = ['{:05d}{}'.format(i, self.ext) for i in range(1, self.manifest.frame_count(video) + 1)]
+        elif store is not None: # the store packs the frames 1..num_frames
+            names = ['{:05d}{}'.format(i, self.ext) for i in range(1, store.videos[video]['num_frames'] + 1)]
+        else:
+            names = sorted(n for n in os.listdir(img_folder) if n.endswith(self.ext))
+        frame_idx = [int(n[0:5]) for n in names]
+
+        # size of the frames on disk
+        if store is not None:
+            width = store.videos[video]['width']
+        else:
+            with Image.open(os.path.join(img_folder, '{:05d}{}'.format(1, self.ext))) as img:
+                width = img.width
+
+        def load(i):
+            if store is not None and store.has_size(self.shape):
+                img = Image.fromarray(store.frames(video, self.shape[0])[i - 1])
+            else:
+                img = store.image(video, i) if store is not None else \
+                      open_frame(os.path.join(img_folder, '{:05d}{}'.format(i, self.ext)), self.shape if self.reduced_decode else None)
+                img = img.resize(self.shape)
+            if self.uint8_clips:
+                return torch.from_numpy(np.array(img)).permute(2, 0, 1)
+            return self.transform(img) if self.transform is not None else img
+
+        # clips reach back from their last frame only, frames after the last named one are never used
+        frames = torch.stack(load_frames(load, list(range(1, max(frame_idx) + 1)), self.decode_threads), 0)
+
+        labels = torch.zeros(len(names), 50*5)
+        for j, i in enumerate(frame_idx):
+            labpath = os.path.join(self.base_path, 'labels', video, '{:05d}.txt'.format(i))
+            try:
+                tmp = torch.from_numpy(read_truths_args(labpath, 8.0/width, manifest_truths(self.manifest, video, i)).astype('float32'))
+            except Exception:
+                tmp = torch.zeros(1,5)
+            tmp = tmp.view(-1)[0:50*5]
+            labels[j, 0:tmp.numel()] = tmp
+
+        return frames, labels, torch.tensor(frame_idx), [os.path.join(video, n) for n in names]
+
+
 class UCF_JHMDB_Dataset_codec(Dataset):
 
     # clip duration = 8, i.e, for each time 8 frames are considered together
     def __init__(self, base, root, dataset='ucf24', shape=None,
                  transform=None, target_transform=None, 
-                 train=False, clip_duration=16, sampling_rate=1):
+                 train=False, clip_duration=16, sampling_rate=1, frame_store='', manifest='',
+                 reduced_decode=False, decode_threads=0):
         with open(root, 'r') as file:
             self.lines = file.readlines()
 
@@ -83,6 +201,10 @@ class UCF_JHMDB_Dataset_codec(Dataset):
         self.shape = shape
         self.clip_duration = clip_duration
         self.sampling_rate = sampling_rate
+        self.frame_store = FrameStore(frame_store) if frame_store else None # packed frames of datasets.frame_store
+        self.manifest = DatasetManifest(manifest) if manifest else None # frame counts and labels of datasets.manifest
+        self.reduced_decode = reduced_decode # JPEG frames decoded at the smallest DCT scale that covers shape
+        self.decode_threads = decode_threads # the frames of a video decoded concurrently on this many threads
         self.cache = {} # cache for current video clip
         self.prev_video = '' # previous video name to determine whether its a whole new video
         self.last_frame = False
@@ -90,11 +212,16 @@ class UCF_JHMDB_Dataset_codec(Dataset):
     def __len__(self):
         return self.nSamples
 
+    def shard(self, start, end):
+        # keep the contiguous frames [start, end), so that each process compresses its videos in order
+        self.lines = self.lines[start:end]
+        self.nSamples = len(self.lines)
+
     def __getitem__(self, index):
         assert index <= len(self), 'index range error'
         imgpath = self.lines[index].rstrip()
         
-        frame_idx, clip, label, additional = load_data_detection_from_cache(self.base_path, imgpath, self.train, self.clip_duration, self.sampling_rate, self.cache, self.dataset)
+        frame_idx, clip, label, additional = load_data_detection_from_cache(self.base_path, imgpath, self.train, self.clip_duration, self.sampling_rate, self.cache, self.dataset, self.frame_store, self.manifest)
         
         # (self.duration, -1) + self.shape = (8, -1, 224, 224)
         clip = torch.cat(clip, 0).view((self.clip_duration, -1) + self.shape).permute(1, 0, 2, 3)
@@ -130,26 +257,32 @@ class UCF_JHMDB_Dataset_codec(Dataset):
             if 'clip' in self.cache: del self.cache['clip']
             if 'img_loss' in self.cache: del self.cache['img_loss']
             self.cache.clear()
-            clip = read_video_clip(self.base_path, imgpath, self.shape, self.dataset)
+            clip = read_video_clip(self.base_path, imgpath, self.shape, self.dataset, frame_store=self.frame_store, manifest=self.manifest,
+                                   reduced_decode=self.reduced_decode, decode_threads=self.decode_threads)
             if (self.transform is not None) and (model_codec.name not in ['x265', 'x264']):
-                self.cache['clip'] = [self.transform(img).cuda(0) for img in clip]
+                self.cache['clip'] = [self.transform(img).to(codec_device(0)) for img in clip]
         compress_video(model_codec, im_ind, self.cache, startNewClip)
         
     
-def read_video_clip(base_path, imgpath, shape, dataset_use='ucf24', jitter=0.2, hue=0.1, saturation=1.5, exposure=1.5):
+def read_video_clip(base_path, imgpath, shape, dataset_use='ucf24', jitter=0.2, hue=0.1, saturation=1.5, exposure=1.5, frame_store=None, manifest=None,
+                    reduced_decode=False, decode_threads=0):
     # load whole video as a clip for further processing
     # all frames in a video should be processed with the same augmentation or no augmentation
     # the data will be loaded from the current clip
     
     im_split = imgpath.split('/')
 
-    img_folder = os.path.join(base_path, 'rgb-images', im_split[0], im_split[1])
+    video = im_split[0] + '/' + im_split[1]
     if dataset_use == 'ucf24':
-        max_num = len(os.listdir(img_folder))
+        max_num = num_frame_files(base_path, video, frame_store, manifest)
     elif dataset_use == 'jhmdb21':
-        max_num = len(os.listdir(img_folder)) - 1
+        max_num = num_frame_files(base_path, video, frame_store, manifest) - 1
 
-    clip = []
+    if frame_store is not None and frame_store.has_size(shape): # already resized
+        frames = frame_store.frames(video, shape[0])
+        return [Image.fromarray(frames[i]) for i in range(max_num)]
+
+    paths = []
 
     for i in range(max_num):
         
@@ -158,13 +291,16 @@ def read_video_clip(base_path, imgpath, shape, dataset_use='ucf24', jitter=0.2,
         elif dataset_use == 'jhmdb21':
             path_tmp = os.path.join(base_path, 'rgb-images', im_split[0], im_split[1] ,'{:05d}.png'.format(i+1))
 
-        clip.append(Image.open(path_tmp).convert('RGB'))
-    
-    clip = [img.resize(shape) for img in clip]
-    
-    return clip
+        paths.append(path_tmp)
+
+    def load(i):
+        img = frame_store.image(video, i+1) if frame_store is not None else open_frame(paths[i], shape if reduced_decode else None)
+        return img.resize(shape)
+
+    # decoded and resized on decode_threads threads (datasets.dataset_utils.load_frames)
+    return load_frames(load, list(range(max_num)), decode_threads)
     
-def load_data_detection_from_cache(base_path, imgpath, train, train_dur, sample_rate, cache, dataset_use='ucf24'):
+def load_data_detection_from_cache(base_path, imgpath, train, train_dur, sample_rate, cache, dataset_use='ucf24', frame_store=None, manifest=None):
     # load 8/16 frames from video clips
     
     im_split = imgpath.split('/')
@@ -172,11 +308,11 @@ def load_data_detection_from_cache(base_path, imgpath, train, train_dur, sample_
     im_ind = int(im_split[num_parts-1][0:5])
     labpath = os.path.join(base_path, 'labels', im_split[0], im_split[1] ,'{:05d}.txt'.format(im_ind))
     
-    img_folder = os.path.join(base_path, 'rgb-images', im_split[0], im_split[1])
+    video = im_split[0] + '/' + im_split[1]
     if dataset_use == 'ucf24':
-        max_num = len(os.listdir(img_folder))
+        max_num = num_frame_files(base_path, video, frame_store, manifest)
     elif dataset_use == 'jhmdb21':
-        max_num = len(os.listdir(img_folder)) - 1
+        max_num = num_frame_files(base_path, video, frame_store, manifest) - 1
     
     clip_tmp = cache['clip']
     
@@ -198,7 +334,7 @@ def load_data_detection_from_cache(base_path, imgpath, train, train_dur, sample_
     _,h,w = clip[0].shape
     label = torch.zeros(50*5)
     try:
-        tmp = torch.from_numpy(read_truths_args(labpath, 8.0/w).astype('float32'))
+        tmp = torch.from_numpy(read_truths_args(labpath, 8.0/w, manifest_truths(manifest, video, im_ind)).astype('float32'))
     except Exception:
         tmp = torch.zeros(1,5)
 
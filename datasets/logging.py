@@ -3,6 +3,7 @@
 
 """Logging."""
 
+import builtins
 import time
 import os
 import logging
@@ -10,6 +11,19 @@ import functools
 import sys
 from fvcore.common.file_io import PathManager
 
+import core.distributed as du
+
+
+def _suppress_print():
+    """
+    Suppresses printing from the current process.
+    """
+
+    def print_pass(*objects, sep=" ", end="\n", file=sys.stdout, flush=False):
+        pass
+
+    builtins.print = print_pass
+
 
 @functools.lru_cache(maxsize=None)
 def _cached_log_stream(filename):
@@ -24,6 +38,13 @@ def setup_logging(output_dir=None):
     # Set up logging format.
     _FORMAT = "[%(levelname)s: %(filename)s: %(lineno)4d]: %(message)s"
 
+    if not du.is_master_proc():
+        # Suppress logging for non-master processes.
+        _suppress_print()
+        logging.root.handlers = []
+        logging.getLogger().setLevel(logging.ERROR)
+        return
+
     logging.root.handlers = []
 
     logger = logging.getLogger()
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+import os
+import argparse
+
+import numpy as np
+from PIL import Image
+
+from core.utils import read_truths
+
+
+"""
+Manifest of a UCF24/JHMDB21 tree, built once so that the datasets need no os.listdir and no
+label text parsing per sample.
+
+For every video of rgb-images/<class>/<video> it records the number of files in the frame
+folder, the number of frames and the frame size, and for every frame the rows of
+labels/<class>/<video>/<%05d>.txt as read by read_truths. Everything is stored in flat arrays
+of one .npz file, the boxes of all frames in one array with per-frame offsets.
+
+    python -m datasets.manifest --base /path/to/ucf24 --dataset ucf24 --out /path/to/ucf24/manifest.npz
+"""
+
+
+def build_manifest(base_path, dataset, out):
+    ext = '.jpg' if dataset == 'ucf24' else '.png'
+    root = os.path.join(base_path, 'rgb-images')
+    videos = sorted(os.path.join(c, v) for c in os.listdir(root) for v in os.listdir(os.path.join(root, c)))
+    num_files, num_frames, width, height, frame_offset = [], [], [], [], [0]
+    has_label, row_offset, rows = [], [0], []
+    for n, video in enumerate(videos):
+        names = os.listdir(os.path.join(root, video))
+        frames = [f for f in names if f.endswith(ext)]
+        with Image.open(os.path.join(root, video, '{:05d}{}'.format(1, ext))) as img: # reads the header only
+            w, h = img.size
+        label_folder = os.path.join(base_path, 'labels', video)
+        labels = os.listdir(label_folder) if os.path.isdir(label_folder) else []
+        label_idx = [int(l[0:5]) for l in labels if l.endswith('.txt')]
+        # one slot per frame index up to the last frame or label of the video
+        slots = max([len(frames)] + label_idx)
+        label_set = set(label_idx)
+        for i in range(1, slots + 1):
+            truths = read_truths(os.path.join(label_folder, '{:05d}.txt'.format(i))) if i in label_set else np.array([])
+            has_label.append(i in label_set)
+            rows.append(truths.reshape(-1, 5))
+            row_offset.append(row_offset[-1] + len(rows[-1]))
+        num_files.append(len(names))
+        num_frames.append(len(frames))
+        width.append(w)
+        height.append(h)
+        frame_offset.append(frame_offset[-1] + slots)
+        if n % 100 == 0:
+            print('manifest: %d/%d videos' % (n + 1, len(videos)))
+
+    tmp = out + '.tmp.npz'
+    np.savez(tmp, videos=np.array(videos), num_files=np.array(num_files, dtype=np.int32),
+             num_frames=np.array(num_frames, dtype=np.int32), width=np.array(width, dtype=np.int32),
+             height=np.array(height, dtype=np.int32), frame_offset=np.array(frame_offset, dtype=np.int64),
+             has_label=np.array(has_label, dtype=bool), row_offset=np.array(row_offset, dtype=np.int64),
+             rows=np.concatenate(rows, 0) if rows else np.zeros((0, 5)))
+    os.replace(tmp, out)
+    print('manifest of %d videos is saved to %s' % (len(videos), out))
+
+
+class DatasetManifest(object):
+    """
+    Read side of a manifest, loaded once at dataset construction. Only the video names
+    become python objects, frames are looked up in the flat arrays.
+    """
+
+    def __init__(self, path):
+        data = np.load(path)
+        self.video_index = {v: i for i, v in enumerate(data['videos'].tolist())}
+        for name in ['num_files', 'num_frames', 'width', 'height', 'frame_offset', 'has_label', 'row_offset', 'rows']:
+            setattr(self, name, data[name])
+
+    def num_frame_files(self, video):
+        # len(os.listdir) of the frame folder, the datasets derive the last frame index from it
+        return int(self.num_files[self.video_index[video]])
+
+    def frame_count(self, video):
+        return int(self.num_frames[self.video_index[video]])
+
+    def frame_size(self, video):
+        v = self.video_index[video]
+        return int(self.width[v]), int(self.height[v])
+
+    def truths(self, video, frame_index):
+        # rows of the label file of frame <frame_index> like read_truths, None if the frame has no label file
+        v = self.video_index[video]
+        p = self.frame_offset[v] + frame_index - 1
+        if frame_index < 1 or p >= self.frame_offset[v + 1] or not self.has_label[p]:
+            return None
+        return self.rows[self.row_offset[p]:self.row_offset[p + 1]].copy() # callers modify the rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the frame and label manifest of UCF24/JHMDB21')
+    parser.add_argument('--base', required=True, help='dataset root with rgb-images/ and labels/')
+    parser.add_argument('--dataset', default='ucf24', choices=['ucf24', 'jhmdb21'])
+    parser.add_argument('--out', required=True, help='manifest file, LISTDATA.MANIFEST')
+    args = parser.parse_args()
+    build_manifest(args.base, args.dataset, args.out)
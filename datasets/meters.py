@@ -13,7 +13,7 @@ from fvcore.common.timer import Timer
 import json
 
 from datasets import logging
-from datasets import ava_helper
+from datasets import ava_helper, ava_index
 from datasets.ava_eval_helper import (
     run_evaluation,
     read_csv,
@@ -50,6 +50,13 @@ class AVAMeter(object):
         self.mode = mode
         self.output_json = os.path.join(self.cfg.BACKUP_DIR, output_json)
         self.full_ava_test = cfg.AVA.FULL_TEST_ON_VAL
+        if cfg.AVA.INDEX_DIR:
+            # compiled once by ava_index and kept by the process for the meters of all epochs
+            (self.categories, self.class_whitelist, self.excluded_keys,
+             self.full_groundtruth) = ava_index.load_groundtruth(cfg)
+            self.mini_groundtruth = get_ava_mini_groundtruth(self.full_groundtruth)
+            _, self.video_idx_to_name = ava_index.load_image_lists(cfg, self.mode == 'train')
+            return
         self.excluded_keys = read_exclusions(
             os.path.join(cfg.AVA.ANNOTATION_DIR, cfg.AVA.EXCLUSION_FILE)
         )
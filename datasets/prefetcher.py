@@ -0,0 +1,130 @@
+import queue
+import threading
+
+import torch
+
+from core.utils import clip_to_device
+from core.profiler import record_phase
+
+
+def batch_to_device(batch, cfg, device):
+    # tensors of a (nested) batch on the device, clips [B, C, D, H, W] in the layout of the backbones,
+    # other entries (e.g. the frame names of the UCF24/JHMDB21 test batches) are passed through
+    if torch.is_tensor(batch):
+        if batch.dim() == 5:
+            return clip_to_device(batch, cfg, device)
+        return batch.to(device, non_blocking=True)
+    if isinstance(batch, dict):
+        return type(batch)((k, batch_to_device(v, cfg, device)) for k, v in batch.items())
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(batch_to_device(v, cfg, device) for v in batch)
+    return batch
+
+
+def _record_stream(batch, stream):
+    # tell the caching allocator that the current stream uses tensors allocated on the copy stream
+    if torch.is_tensor(batch):
+        batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for v in batch.values():
+            _record_stream(v, stream)
+    elif isinstance(batch, (list, tuple)):
+        for v in batch:
+            _record_stream(v, stream)
+
+
+class DataPrefetcher(object):
+    """
+    Iterates a DataLoader one step ahead, batches come out on the device.
+
+    On GPUs the next batch is copied with non-blocking copies on a side stream
+    while the current step runs, the loader should use pinned memory. On the
+    CPU a background thread pulls (and for NUM_WORKERS 0 collates) the next
+    batches and converts them, e.g. to channels_last_3d, ahead of time.
+    len(), sampler and dataset are those of the wrapped loader. The copies are
+    recorded as the 'h2d' phase of an active core.profiler.StepProfiler.
+    """
+
+    def __init__(self, loader, cfg, device, depth=2):
+        self.loader = loader
+        self.cfg = cfg
+        self.device = device
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._cuda_iter()
+        return self._thread_iter()
+
+    def _cuda_iter(self):
+        stream = torch.cuda.Stream(self.device)
+        it = iter(self.loader)
+
+        def preload():
+            try:
+                batch = next(it)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream), record_phase('h2d'): # events on the copy stream
+                return batch_to_device(batch, self.cfg, self.device)
+
+        next_batch = preload()
+        while next_batch is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            batch = next_batch
+            _record_stream(batch, current)
+            next_batch = preload() # copies of the next batch overlap the step on this one
+            yield batch
+
+    def _thread_iter(self):
+        batches = queue.Queue(maxsize=self.depth)
+        done = object()
+        stop = threading.Event()
+
+        def put(item):
+            # False once the consumer has left, a full queue would block forever
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                for batch in self.loader:
+                    with record_phase('h2d', tid='prefetch'):
+                        batch = batch_to_device(batch, self.cfg, self.device)
+                    if not put(batch):
+                        return
+                put(done)
+            except BaseException as e: # raised again in the training thread
+                put(e)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is done:
+                    break
+                if isinstance(batch, BaseException):
+                    raise batch
+                yield batch
+        finally:
+            # a loop left early stops the thread, it must not hold on to the loader iterator
+            stop.set()
+            thread.join()
@@ -18,138 +18,186 @@ from core.optimization import *
 from cfg import parser
 from core.utils import *
 from core.region_loss import RegionLoss, RegionLoss_Ava
-from core.model import YOWO, get_fine_tuning_parameters
-
-
-####### Load configuration arguments
-# ---------------------------------------------------------------
-args  = parser.parse_args()
-cfg   = parser.load_config(args)
-
-
-####### Check backup directory, create if necessary
-# ---------------------------------------------------------------
-if not os.path.exists(cfg.BACKUP_DIR):
-    os.makedirs(cfg.BACKUP_DIR)
-
-
-####### Create model
-# ---------------------------------------------------------------
-model = YOWO(cfg)
-model = model.cuda()
-model = nn.DataParallel(model, device_ids=None) # in multi-gpu case
-# print(model)
-pytorch_total_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
-logging('Total number of trainable parameters: {}'.format(pytorch_total_params))
-
-seed = int(time.time())
-torch.manual_seed(seed)
-use_cuda = True
-if use_cuda:
-    os.environ['CUDA_VISIBLE_DEVICES'] = '0,1' # TODO: add to config e.g. 0,1,2,3
-    torch.cuda.manual_seed(seed)
-
-
-####### Create optimizer
-# ---------------------------------------------------------------
-parameters = get_fine_tuning_parameters(model, cfg)
-optimizer = torch.optim.Adam(parameters, lr=cfg.TRAIN.LEARNING_RATE, weight_decay=cfg.SOLVER.WEIGHT_DECAY)
-best_score   = 0 # initialize best score
-# optimizer = optim.SGD(parameters, lr=cfg.TRAIN.LEARNING_RATE/batch_size, momentum=cfg.SOLVER.MOMENTUM, dampening=0, weight_decay=cfg.SOLVER.WEIGHT_DECAY)
-
-
-####### Load resume path if necessary
-# ---------------------------------------------------------------
-if cfg.TRAIN.RESUME_PATH:
-    print("===================================================================")
-    print('loading checkpoint {}'.format(cfg.TRAIN.RESUME_PATH))
-    checkpoint = torch.load(cfg.TRAIN.RESUME_PATH)
-    cfg.TRAIN.BEGIN_EPOCH = checkpoint['epoch'] + 1
-    best_score = checkpoint['score']
-    model.load_state_dict(checkpoint['state_dict'])
-    optimizer.load_state_dict(checkpoint['optimizer'])
-    print("Loaded model score: ", checkpoint['score'])
-    print("===================================================================")
-    del checkpoint
-
-
-####### Create backup directory if necessary
-# ---------------------------------------------------------------
-if not os.path.exists(cfg.BACKUP_DIR):
-    os.mkdir(cfg.BACKUP_DIR)
-
-
-####### Data loader, training scheme and loss function are different for AVA and UCF24/JHMDB21 datasets
-# ---------------------------------------------------------------
-dataset = cfg.TRAIN.DATASET
-assert dataset == 'ucf24' or dataset == 'jhmdb21' or dataset == 'ava', 'invalid dataset'
-
-if dataset == 'ava':
-    train_dataset = Ava(cfg, split='train', only_detection=False)
-    test_dataset  = Ava(cfg, split='val', only_detection=False)
-
-    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=cfg.TRAIN.BATCH_SIZE, shuffle=True, 
-                                               num_workers=cfg.DATA_LOADER.NUM_WORKERS, drop_last=True, pin_memory=True)
-    
-    test_loader  = torch.utils.data.DataLoader(test_dataset, batch_size=cfg.TRAIN.BATCH_SIZE, shuffle=False,
-                                               num_workers=cfg.DATA_LOADER.NUM_WORKERS, drop_last=False, pin_memory=True)
-
-    loss_module   = RegionLoss_Ava(cfg).cuda()
-
-    train = getattr(sys.modules[__name__], 'train_ava')
-    test  = getattr(sys.modules[__name__], 'test_ava')
-
-
-
-elif dataset in ['ucf24', 'jhmdb21']:
-    train_dataset = list_dataset.UCF_JHMDB_Dataset(cfg.LISTDATA.BASE_PTH, cfg.LISTDATA.TRAIN_FILE, dataset=dataset,
-                       shape=(cfg.DATA.TRAIN_CROP_SIZE, cfg.DATA.TRAIN_CROP_SIZE),
-                       transform=transforms.Compose([transforms.ToTensor()]), 
-                       train=True, clip_duration=cfg.DATA.NUM_FRAMES, sampling_rate=cfg.DATA.SAMPLING_RATE)
-    test_dataset  = list_dataset.UCF_JHMDB_Dataset(cfg.LISTDATA.BASE_PTH, cfg.LISTDATA.TEST_FILE, dataset=dataset,
-                       shape=(cfg.DATA.TRAIN_CROP_SIZE, cfg.DATA.TRAIN_CROP_SIZE),
-                       transform=transforms.Compose([transforms.ToTensor()]), 
-                       train=False, clip_duration=cfg.DATA.NUM_FRAMES, sampling_rate=cfg.DATA.SAMPLING_RATE)
-
-    train_loader  = torch.utils.data.DataLoader(train_dataset, batch_size= cfg.TRAIN.BATCH_SIZE, shuffle=True,
-                                               num_workers=cfg.DATA_LOADER.NUM_WORKERS, drop_last=True, pin_memory=True)
-    test_loader   = torch.utils.data.DataLoader(test_dataset, batch_size= cfg.TRAIN.BATCH_SIZE, shuffle=False,
-                                               num_workers=cfg.DATA_LOADER.NUM_WORKERS, drop_last=False, pin_memory=True)
-
-    loss_module   = RegionLoss(cfg).cuda()
-
-    train = getattr(sys.modules[__name__], 'train_ucf24_jhmdb21')
-    test  = getattr(sys.modules[__name__], 'test_ucf24_jhmdb21')
-
-
-####### Training and Testing Schedule
-# ---------------------------------------------------------------
-if cfg.TRAIN.EVALUATE:
-    logging('evaluating ...')
-    test(cfg, 0, model, test_loader)
-else:
-    for epoch in range(cfg.TRAIN.BEGIN_EPOCH, cfg.TRAIN.END_EPOCH + 1):
-        # Adjust learning rate
-        lr_new = adjust_learning_rate(optimizer, epoch, cfg)
-        
-        # Train and test model
-        logging('training at epoch %d, lr %f' % (epoch, lr_new))
-        train(cfg, epoch, model, train_loader, loss_module, optimizer)
-        logging('testing at epoch %d' % (epoch))
-        score = test(cfg, epoch, model, test_loader)
-
-        # Save the model to backup directory
-        is_best = score > best_score
-        if is_best:
-            print("New best score is achieved: ", score)
-            print("Previous score was: ", best_score)
-            best_score = score
-
-        state = {
-            'epoch': epoch,
-            'state_dict': model.state_dict(),
-            'optimizer': optimizer.state_dict(),
-            'score': score
-            }
-        save_checkpoint(state, is_best, cfg.BACKUP_DIR, cfg.TRAIN.DATASET, cfg.DATA.NUM_FRAMES)
-        logging('Weights are saved to backup directory: %s' % (cfg.BACKUP_DIR))
\ No newline at end of file
+from core.model import YOWO, get_fine_tuning_parameters, freeze_parameters, set_channels_last, freeze_backbones
+from datasets.feature_cache import build_feature_cache
+from datasets.prefetcher import DataPrefetcher
+from datasets.frame_cache import ChunkShuffleSampler
+from datasets.dataset_utils import get_decode_threads
+import core.distributed as du
+from core.profiler import build_profiler
+from core.checkpoint import CheckpointManager
+from datasets.logging import setup_logging
+from torch.utils.data.distributed import DistributedSampler
+
+
+def main(cfg):
+    ####### Check backup directory, create if necessary
+    # ---------------------------------------------------------------
+    os.makedirs(cfg.BACKUP_DIR, exist_ok=True)
+
+
+    ####### Select devices before anything touches CUDA
+    # ---------------------------------------------------------------
+    setup_logging()
+    device = setup_devices(cfg)
+
+    seed = int(time.time()) + du.get_rank()
+    torch.manual_seed(seed)
+    if device.type == 'cuda':
+        torch.cuda.manual_seed(seed)
+
+
+    ####### Create model
+    # ---------------------------------------------------------------
+    model = YOWO(cfg)
+    model = model.to(device)
+    if cfg.TRAIN.CHANNELS_LAST:
+        model = set_channels_last(model)
+    model = freeze_parameters(model, cfg) # layers outside the fine tuned modules
+    if cfg.FEATURE_CACHE.ENABLE:
+        model = freeze_backbones(model)
+    model = du.wrap_model(model, cfg, device) # DistributedDataParallel when launched on several processes
+    # print(model)
+    pytorch_total_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    logging('Total number of trainable parameters: {}'.format(pytorch_total_params))
+    profiler = build_profiler(cfg, model, device) # a no-op unless cfg.PROFILE.ENABLE
+
+
+    ####### Create optimizer
+    # ---------------------------------------------------------------
+    parameters = get_fine_tuning_parameters(model, cfg)
+    optimizer = torch.optim.Adam(parameters, lr=cfg.TRAIN.LEARNING_RATE, weight_decay=cfg.SOLVER.WEIGHT_DECAY)
+    best_score   = 0 # initialize best score
+    # optimizer = optim.SGD(parameters, lr=cfg.TRAIN.LEARNING_RATE/batch_size, momentum=cfg.SOLVER.MOMENTUM, dampening=0, weight_decay=cfg.SOLVER.WEIGHT_DECAY)
+
+
+    ####### Load resume path if necessary
+    # ---------------------------------------------------------------
+    if cfg.TRAIN.RESUME_PATH:
+        print("===================================================================")
+        print('loading checkpoint {}'.format(cfg.TRAIN.RESUME_PATH))
+        checkpoint = torch.load(cfg.TRAIN.RESUME_PATH, map_location='cpu')
+        cfg.TRAIN.BEGIN_EPOCH = checkpoint['epoch'] + 1
+        best_score = checkpoint['score']
+        model.load_state_dict(checkpoint['state_dict'])
+        if len(checkpoint['optimizer']['param_groups']) == len(optimizer.param_groups):
+            optimizer.load_state_dict(checkpoint['optimizer'])
+        else: # checkpoints with one param group per tensor
+            print('optimizer state does not match the param groups, starting with a new optimizer state')
+        print("Loaded model score: ", checkpoint['score'])
+        print("===================================================================")
+        del checkpoint
+
+
+    ####### Create backup directory if necessary
+    # ---------------------------------------------------------------
+    if not os.path.exists(cfg.BACKUP_DIR):
+        os.mkdir(cfg.BACKUP_DIR)
+    checkpointer = CheckpointManager(cfg.BACKUP_DIR, 'yowo_%s_%df' % (cfg.TRAIN.DATASET, cfg.DATA.NUM_FRAMES),
+                                     keep=cfg.TRAIN.KEEP_CHECKPOINTS, async_write=cfg.TRAIN.ASYNC_CHECKPOINT)
+
+
+    ####### Data loader, training scheme and loss function are different for AVA and UCF24/JHMDB21 datasets
+    # ---------------------------------------------------------------
+    dataset = cfg.TRAIN.DATASET
+    assert dataset == 'ucf24' or dataset == 'jhmdb21' or dataset == 'ava', 'invalid dataset'
+
+    if dataset == 'ava':
+        train_dataset = Ava(cfg, split='train', only_detection=False)
+        test_dataset  = Ava(cfg, split='val', only_detection=False)
+
+        loss_module   = RegionLoss_Ava(cfg).to(device)
+
+        train = getattr(sys.modules[__name__], 'train_ava')
+        test  = getattr(sys.modules[__name__], 'test_ava')
+
+
+
+    elif dataset in ['ucf24', 'jhmdb21']:
+        train_dataset = list_dataset.UCF_JHMDB_Dataset(cfg.LISTDATA.BASE_PTH, cfg.LISTDATA.TRAIN_FILE, dataset=dataset,
+                           shape=(cfg.DATA.TRAIN_CROP_SIZE, cfg.DATA.TRAIN_CROP_SIZE),
+                           transform=transforms.Compose([transforms.ToTensor()]), 
+                           train=True, clip_duration=cfg.DATA.NUM_FRAMES, sampling_rate=cfg.DATA.SAMPLING_RATE,
+                           frame_cache_size=cfg.DATA_LOADER.FRAME_CACHE_SIZE, frame_store=cfg.LISTDATA.FRAME_STORE,
+                           manifest=cfg.LISTDATA.MANIFEST, tensor_augmentation=cfg.DATA.TENSOR_AUGMENTATION,
+                           reduced_decode=cfg.DATA.REDUCED_DECODE,
+                           decode_threads=get_decode_threads(cfg), uint8_clips=cfg.DATA_LOADER.UINT8_CLIPS)
+        test_dataset  = list_dataset.UCF_JHMDB_Dataset(cfg.LISTDATA.BASE_PTH, cfg.LISTDATA.TEST_FILE, dataset=dataset,
+                           shape=(cfg.DATA.TRAIN_CROP_SIZE, cfg.DATA.TRAIN_CROP_SIZE),
+                           transform=transforms.Compose([transforms.ToTensor()]), 
+                           train=False, clip_duration=cfg.DATA.NUM_FRAMES, sampling_rate=cfg.DATA.SAMPLING_RATE,
+                           frame_cache_size=cfg.DATA_LOADER.FRAME_CACHE_SIZE, frame_store=cfg.LISTDATA.FRAME_STORE,
+                           manifest=cfg.LISTDATA.MANIFEST, reduced_decode=cfg.DATA.REDUCED_DECODE,
+                           decode_threads=get_decode_threads(cfg), uint8_clips=cfg.DATA_LOADER.UINT8_CLIPS)
+
+        loss_module   = RegionLoss(cfg).to(device)
+
+        train = getattr(sys.modules[__name__], 'train_ucf24_jhmdb21')
+        test  = getattr(sys.modules[__name__], 'test_ucf24_jhmdb21')
+
+
+    # the frozen backbones run once over the training set, training streams their stored outputs
+    if cfg.FEATURE_CACHE.ENABLE and not cfg.TRAIN.EVALUATE:
+        train_dataset = build_feature_cache(cfg, model, train_dataset, device)
+
+    # every process loads its own part of the data
+    if cfg.DATA_LOADER.CHUNK_SIZE > 0: # neighbouring frames stay together for the frame cache
+        train_sampler = ChunkShuffleSampler(train_dataset, cfg.DATA_LOADER.CHUNK_SIZE, shuffle=True)
+    else:
+        train_sampler = DistributedSampler(train_dataset, shuffle=True) if du.get_world_size() > 1 else None
+    test_sampler  = du.InferenceSampler(test_dataset) if du.get_world_size() > 1 else None
+    pin_memory    = cfg.DATA_LOADER.PIN_MEMORY and device.type == 'cuda'
+    train_loader  = torch.utils.data.DataLoader(train_dataset, batch_size=cfg.TRAIN.BATCH_SIZE, shuffle=train_sampler is None,
+                                                sampler=train_sampler, num_workers=cfg.DATA_LOADER.NUM_WORKERS, drop_last=True, pin_memory=pin_memory)
+    test_loader   = torch.utils.data.DataLoader(test_dataset, batch_size=cfg.TRAIN.BATCH_SIZE, shuffle=False,
+                                                sampler=test_sampler, num_workers=cfg.DATA_LOADER.NUM_WORKERS, drop_last=False, pin_memory=pin_memory)
+    if cfg.DATA_LOADER.PREFETCH: # batches come out on the device, the copies overlap the previous step
+        train_loader = DataPrefetcher(train_loader, cfg, device)
+        test_loader  = DataPrefetcher(test_loader, cfg, device)
+
+
+    ####### Training and Testing Schedule
+    # ---------------------------------------------------------------
+    if cfg.TRAIN.EVALUATE:
+        logging('evaluating ...')
+        test(cfg, 0, model, test_loader)
+    else:
+        for epoch in range(cfg.TRAIN.BEGIN_EPOCH, cfg.TRAIN.END_EPOCH + 1):
+            # Adjust learning rate
+            lr_new = adjust_learning_rate(optimizer, epoch, cfg)
+            if train_sampler is not None:
+                train_sampler.set_epoch(epoch)
+            if hasattr(train_dataset, 'set_epoch'):
+                train_dataset.set_epoch(epoch)
+
+            # Train and test model
+            logging('training at epoch %d, lr %f' % (epoch, lr_new))
+            train(cfg, epoch, model, train_loader, loss_module, optimizer, profiler)
+            logging('testing at epoch %d' % (epoch))
+            score = test(cfg, epoch, model, test_loader)
+
+            # Save the model to backup directory
+            is_best = score > best_score
+            if is_best:
+                print("New best score is achieved: ", score)
+                print("Previous score was: ", best_score)
+                best_score = score
+
+            state = {
+                'epoch': epoch,
+                'state_dict': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'score': score
+                }
+            checkpointer.save(state, is_best) # written in the background while the next epoch trains
+            logging('Weights are saved to backup directory: %s' % (cfg.BACKUP_DIR))
+        profiler.close()
+        checkpointer.close()
+
+
+if __name__ == '__main__':
+    ####### Load configuration arguments, one process per device with cfg.NUM_GPUS > 1
+    # ---------------------------------------------------------------
+    args  = parser.parse_args()
+    cfg   = parser.load_config(args)
+    du.launch_job(cfg, args.init_method, main)
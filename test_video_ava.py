@@ -33,8 +33,9 @@ cfg   = parser.load_config(args)
 
 ####### Create model
 # ---------------------------------------------------------------
+device = setup_devices(cfg)
 model = YOWO(cfg)
-model = model.cuda()
+model = model.to(device)
 model = nn.DataParallel(model, device_ids=None) # in multi-gpu case
 
 
@@ -43,7 +44,7 @@ model = nn.DataParallel(model, device_ids=None) # in multi-gpu case
 if cfg.TRAIN.RESUME_PATH:
     print("===================================================================")
     print('loading checkpoint {}'.format(cfg.TRAIN.RESUME_PATH))
-    checkpoint = torch.load(cfg.TRAIN.RESUME_PATH)
+    checkpoint = torch.load(cfg.TRAIN.RESUME_PATH, map_location='cpu')
     cfg.TRAIN.BEGIN_EPOCH = checkpoint['epoch'] + 1
     best_score = checkpoint['score']
     model.load_state_dict(checkpoint['state_dict'])
@@ -125,7 +126,7 @@ while(cap.isOpened()):
 
     imgs = np.ascontiguousarray(imgs)
     imgs = torch.from_numpy(imgs)
-    imgs = torch.unsqueeze(imgs, 0)
+    imgs = torch.unsqueeze(imgs, 0).to(device)
 
 
     # Model inference
@@ -133,19 +134,11 @@ while(cap.isOpened()):
         output = model(imgs)
 
         preds = []
-        all_boxes = get_region_boxes_ava(output, conf_thresh_valid, num_classes, anchors, num_anchors, 0, 1)
-        for i in range(output.size(0)):
-            boxes = all_boxes[i]
-            boxes = nms(boxes, nms_thresh)
-            
-            for box in boxes:
-                x1 = float(box[0]-box[2]/2.0)
-                y1 = float(box[1]-box[3]/2.0)
-                x2 = float(box[0]+box[2]/2.0)
-                y2 = float(box[1]+box[3]/2.0)
-                det_conf = float(box[4])
-                cls_out = [det_conf * x.cpu().numpy() for x in box[5]]
-                preds.append([[x1,y1,x2,y2], cls_out])
+        boxes, det_confs, cls_scores, box_batch_idx = get_region_boxes_ava_arrays(output, conf_thresh_valid, num_classes, anchors, num_anchors)
+        corners = np.concatenate([boxes[:, :2] - boxes[:, 2:]/2.0, boxes[:, :2] + boxes[:, 2:]/2.0], 1).tolist()
+        keep = nms_tensor(torch.from_numpy(boxes), torch.from_numpy(det_confs), nms_thresh, torch.from_numpy(box_batch_idx))
+        for j in keep.tolist():
+            preds.append([corners[j], cls_scores[j]])
 
     # for line in preds:
     # 	print(line)